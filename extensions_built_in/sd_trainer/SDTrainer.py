@@ -20,6 +20,7 @@ from toolkit.guidance import get_targeted_guidance_loss, get_guidance_loss, Guid
 from toolkit.image_utils import show_tensors, show_latents
 from toolkit.ip_adapter import IPAdapter
 from toolkit.custom_adapter import CustomAdapter
+from toolkit.optimizer import zero_non_finite_grads
 from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.stable_diffusion_model import StableDiffusion, BlankNetwork
@@ -983,6 +984,10 @@ class SDTrainer(BaseSDTrainProcess):
                 if file_item.is_reg:
                     loss_multiplier[idx] = loss_multiplier[idx] * self.train_config.reg_weight
                     is_reg = True
+            if self.train_config.batch_token_budget is not None:
+                # batch sizes vary with the token budget. The loss is a mean over the batch, scale it so
+                # every image has the same weight as it would in a batch of batch_size
+                loss_multiplier = loss_multiplier * (len(batch.file_items) / self.train_config.batch_size)
 
             adapter_images = None
             sigmas = None
@@ -1216,21 +1221,35 @@ class SDTrainer(BaseSDTrainProcess):
                                 self.sd.text_encoder.eval()
                             if isinstance(self.adapter, CustomAdapter):
                                 self.adapter.is_unconditional_run = False
-                            conditional_embeds = self.sd.encode_prompt(
-                                conditioned_prompts, prompt_2,
-                                dropout_prob=self.train_config.prompt_dropout_prob,
-                                long_prompts=self.do_long_prompts).to(
-                                self.device_torch,
-                                dtype=dtype)
-                            if self.train_config.do_cfg:
-                                if isinstance(self.adapter, CustomAdapter):
-                                    self.adapter.is_unconditional_run = True
-                                unconditional_embeds = self.sd.encode_prompt(
-                                    self.batch_negative_prompt,
+                            if self.text_embedding_cache is not None:
+                                conditional_embeds = self.text_embedding_cache.encode_prompt(
+                                    conditioned_prompts,
+                                    dropout_prob=self.train_config.prompt_dropout_prob).to(
+                                    self.device_torch,
+                                    dtype=dtype)
+                            else:
+                                conditional_embeds = self.sd.encode_prompt(
+                                    conditioned_prompts, prompt_2,
                                     dropout_prob=self.train_config.prompt_dropout_prob,
                                     long_prompts=self.do_long_prompts).to(
                                     self.device_torch,
                                     dtype=dtype)
+                            if self.train_config.do_cfg:
+                                if isinstance(self.adapter, CustomAdapter):
+                                    self.adapter.is_unconditional_run = True
+                                if self.text_embedding_cache is not None:
+                                    unconditional_embeds = self.text_embedding_cache.encode_prompt(
+                                        self.batch_negative_prompt,
+                                        dropout_prob=self.train_config.prompt_dropout_prob).to(
+                                        self.device_torch,
+                                        dtype=dtype)
+                                else:
+                                    unconditional_embeds = self.sd.encode_prompt(
+                                        self.batch_negative_prompt,
+                                        dropout_prob=self.train_config.prompt_dropout_prob,
+                                        long_prompts=self.do_long_prompts).to(
+                                        self.device_torch,
+                                        dtype=dtype)
                                 if isinstance(self.adapter, CustomAdapter):
                                     self.adapter.is_unconditional_run = False
 
@@ -1521,10 +1540,10 @@ class SDTrainer(BaseSDTrainProcess):
                             mask_multiplier=mask_multiplier,
                             prior_pred=prior_pred,
                         )
-                # check if nan
-                if torch.isnan(loss):
-                    print("loss is nan")
-                    loss = torch.zeros_like(loss).requires_grad_(True)
+                # check if nan. Done on the device so we do not wait on the gpu every step,
+                # nan steps are counted and reported when the metrics are logged
+                loss_is_nan = torch.isnan(loss)
+                loss = torch.where(loss_is_nan, torch.zeros_like(loss), loss)
 
 
                 with self.timer('backward'):
@@ -1545,16 +1564,25 @@ class SDTrainer(BaseSDTrainProcess):
                         self.scaler.scale(loss).backward()
         # flush()
 
+        grad_norm = None
         if not self.is_grad_accumulation_step:
+            if not self.do_grad_scale:
+                # the nan loss above still backpropagates nan into the grads. The grad scaler skips
+                # those steps on its own, otherwise zero them so the step does not touch the weights
+                zero_non_finite_grads(self.params)
             # fix this for multi params
             if self.train_config.optimizer != 'adafactor':
                 if self.do_grad_scale:
                     self.scaler.unscale_(self.optimizer)
                 if isinstance(self.params[0], dict):
+                    grad_norms = []
                     for i in range(len(self.params)):
-                        torch.nn.utils.clip_grad_norm_(self.params[i]['params'], self.train_config.max_grad_norm)
+                        grad_norms.append(
+                            torch.nn.utils.clip_grad_norm_(self.params[i]['params'], self.train_config.max_grad_norm)
+                        )
+                    grad_norm = torch.linalg.vector_norm(torch.stack(grad_norms))
                 else:
-                    torch.nn.utils.clip_grad_norm_(self.params, self.train_config.max_grad_norm)
+                    grad_norm = torch.nn.utils.clip_grad_norm_(self.params, self.train_config.max_grad_norm)
             # only step if we are not accumulating
             with self.timer('optimizer_step'):
                 # self.optimizer.step()
@@ -1585,9 +1613,12 @@ class SDTrainer(BaseSDTrainProcess):
                 # Let's make sure we don't update any embedding weights besides the newly added token
                 self.adapter.restore_embeddings()
 
+        # left on the device, the train loop only reads them back when logging
         loss_dict = OrderedDict(
-            {'loss': loss.item()}
+            {'loss': loss.detach(), 'nan_count': loss_is_nan}
         )
+        if grad_norm is not None:
+            loss_dict['grad_norm'] = grad_norm
 
         self.end_of_training_loop()
 
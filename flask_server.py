@@ -1,3 +1,9 @@
+import os
+
+# number gpus like nvidia-smi and the scheduler do, the caption model pool picks its gpu by that index.
+# Has to be set before cuda is initialized
+os.environ.setdefault("CUDA_DEVICE_ORDER", "PCI_BUS_ID")
+
 from flask import Flask, request, jsonify
 from test_response import webhook_response
 from server.request_queue import JobStatus
@@ -28,17 +34,24 @@ def submit():
         if not image_urls:
             return jsonify({"error": "No image urls provided"}), 400
         
+        priority = parse_priority(data.get('priority', 0))
+        if priority is None:
+            return jsonify({"error": "Priority must be an integer"}), 400
+
         if not is_test:
-            from main import train
+            from server.job_scheduler import get_job_scheduler
             dict_to_pass = {
                 "job_id" : job_id,
                 "lora_name" : lora_name,
                 "webhook_url" : webhook_url if webhook_url else None,
                 "images_urls" : image_urls,
-                "example_prompts" : example_prompts if example_prompts else None
+                "example_prompts" : example_prompts if example_prompts else None,
+                "low_vram" : data.get('low_vram', True),
             }
-            threading.Thread(target=train, args=(dict_to_pass,)).start()
-            return jsonify({"status": "success", "job_id": job_id, "status_code" : 200, "message" : "Job Started"}), 200
+            # queued, a gpu worker picks it up when a device has room for it
+            if not get_job_scheduler().submit(job_id, dict_to_pass, priority=priority):
+                return jsonify({"error": f"Job {job_id} already exists"}), 409
+            return jsonify({"status": "success", "job_id": job_id, "status_code" : 200, "message" : "Job Queued"}), 200
 
         threading.Thread(target=send_test_response, args=(job_id,lora_name,image_urls,webhook_url,example_prompts,)).start()
 
@@ -48,6 +61,76 @@ def submit():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    from server.job_scheduler import get_job_scheduler
+    jobs = get_job_scheduler().store.list(status=request.args.get('status', None))
+    return jsonify({"jobs": [job_summary(job) for job in jobs]}), 200
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    from server.job_scheduler import get_job_scheduler
+    job = get_job_scheduler().store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_summary(job)), 200
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    from server.job_scheduler import get_job_scheduler
+    if not get_job_scheduler().cancel(job_id):
+        return jsonify({"error": "Job not found or already done"}), 404
+    return jsonify({"status": "success", "job_id": job_id, "message": "Job Cancelled"}), 200
+
+
+@app.route('/jobs/<job_id>/priority', methods=['POST'])
+def set_job_priority(job_id):
+    from server.job_scheduler import get_job_scheduler
+    data = request.get_json()
+    if data is None or 'priority' not in data:
+        return jsonify({"error": "No priority provided"}), 400
+    priority = parse_priority(data['priority'])
+    if priority is None:
+        return jsonify({"error": "Priority must be an integer"}), 400
+    if not get_job_scheduler().set_priority(job_id, priority):
+        return jsonify({"error": "Job not found or not waiting"}), 404
+    return jsonify({"status": "success", "job_id": job_id, "priority": priority}), 200
+
+
+def parse_priority(value):
+    # accepts ints and integer strings that fit in a sqlite integer, None for anything else
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float) and not value.is_integer():
+        return None
+    try:
+        priority = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not -2 ** 63 <= priority < 2 ** 63:
+        return None
+    return priority
+
+
+def job_summary(job: dict):
+    from server.request_processor import active_jobs
+    summary = {
+        "job_id": job["job_id"],
+        "lora_name": job["request"].get("lora_name"),
+        "status": job["status"],
+        "priority": job["priority"],
+        "low_vram": job["low_vram"],
+        "device": job["device"],
+        "error_message": job["error_message"],
+        "progress": 100 if job["status"] == JobStatus.FINISHED.value else 0,
+    }
+    if job["job_id"] in active_jobs:
+        summary["progress"] = active_jobs[job["job_id"]].job_progress
+    return summary
+
+
 def send_test_response(job_id: str,lora_name,image_urls,webhook_url,example_prompts):
     from server.request_queue import TrainingRequest,TrainingResponse,Job
     training_request = TrainingRequest()
@@ -71,4 +154,7 @@ def send_test_response(job_id: str,lora_name,image_urls,webhook_url,example_prom
     job.job_results.append(TrainingResponse(epoch_model_s3_url=lora_url,current_epoch_number=10,total_epochs=10))
     webhook_response(webhook_url, True, 200, "Job Started", job.dict())
 if __name__ == '__main__':
+    from server.job_scheduler import get_job_scheduler
+    # picks queued jobs back up after a restart
+    get_job_scheduler()
     app.run(host='0.0.0.0', port=8001)
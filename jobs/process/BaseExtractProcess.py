@@ -31,6 +31,14 @@ class BaseExtractProcess(BaseProcess):
         self.torch_dtype = get_torch_dtype(self.dtype)
         self.extract_unet = self.get_conf('extract_unet', self.job.extract_unet)
         self.extract_text_encoder = self.get_conf('extract_text_encoder', self.job.extract_text_encoder)
+        # layers with the same shape are decomposed together in batches of this size
+        self.svd_batch_size = self.get_conf('svd_batch_size', 8, as_type=int)
+        # randomized low rank svd for fixed mode. Much faster, slightly less accurate
+        self.svd_lowrank = self.get_conf('svd_lowrank', False)
+        # extra ranks sampled by the low rank svd, more is more accurate
+        self.svd_oversample = self.get_conf('svd_oversample', 10, as_type=int)
+        # worker threads to spread the layers over when extracting on cpu
+        self.num_workers = self.get_conf('num_workers', 1, as_type=int)
 
     def run(self):
         # here instead of init because child init needs to go first
@@ -24,8 +24,9 @@ from huggingface_hub.utils import HfFolder
 from toolkit.basic import value_map
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
-from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
+from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch, get_dataloader_datasets
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.batch_prefetcher import DevicePrefetcher
 from toolkit.ema import ExponentialMovingAverage
 from toolkit.embedding import Embedding
 from toolkit.image_utils import show_tensors, show_latents, reduce_contrast
@@ -37,7 +38,14 @@ from toolkit.lycoris_special import LycorisSpecialNetwork
 from toolkit.network_mixins import Network
 from toolkit.optimizer import get_optimizer
 from toolkit.paths import CONFIG_ROOT
+from toolkit.async_saver import AsyncCheckpointWriter, snapshot_to_cpu
 from toolkit.progress_bar import ToolkitProgressBar
+from toolkit.metrics_accumulator import MetricsAccumulator
+from toolkit.progress_events import emit_progress_event
+from toolkit.job_cancel import is_job_cancel_requested
+from toolkit.warm_model import is_warm_models_enabled, get_warm_model_key, get_warm_model, store_warm_model, \
+    release_warm_model
+from toolkit.prompt_utils import TextEmbeddingCache
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
 from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adapter_from_diffusers, \
@@ -50,7 +58,8 @@ from toolkit.stable_diffusion_model import StableDiffusion
 from jobs.process import BaseTrainProcess
 from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_base_model_info_to_meta, \
     parse_metadata_from_safetensors
-from toolkit.train_tools import get_torch_dtype, LearnableSNRGamma, apply_learnable_snr_gos, apply_snr_weight
+from toolkit.train_tools import get_torch_dtype, LearnableSNRGamma, apply_learnable_snr_gos, apply_snr_weight, \
+    get_timestep_indices
 import gc
 
 from tqdm import tqdm
@@ -94,6 +103,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        self.async_saver: Union[AsyncCheckpointWriter, None] = None
+        if self.save_config.async_save:
+            self.async_saver = AsyncCheckpointWriter(max_queue_size=self.save_config.async_save_queue_size)
+        # on device loss and metric buffers, set up when training starts
+        self.metrics: Union[MetricsAccumulator, None] = None
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
@@ -158,11 +172,35 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         is_training_adapter = self.adapter_config is not None and self.adapter_config.train
 
+        # text embeddings can only be cached if every dataset asks for it and nothing alters the text encoding
+        all_dataset_configs = (self.datasets or []) + (self.datasets_reg or [])
+        self.is_caching_text_embeddings = len(all_dataset_configs) > 0 and all(
+            [dataset.cache_text_embeddings for dataset in all_dataset_configs]
+        )
+        if self.is_caching_text_embeddings:
+            if self.train_config.train_text_encoder or self.embed_config is not None or self.adapter_config is not None:
+                print("WARNING: cache_text_embeddings is not supported when training the text encoder, "
+                      "embeddings or adapters. Text embeddings will not be cached")
+                self.is_caching_text_embeddings = False
+            elif self.train_config.short_and_long_captions or self.train_config.short_and_long_captions_encoder_split \
+                    or self.train_config.prompt_saturation_chance > 0.0 or self.train_config.negative_prompt is not None:
+                print("WARNING: cache_text_embeddings is not supported with short_and_long_captions, "
+                      "prompt_saturation_chance or negative_prompt. Text embeddings will not be cached")
+                self.is_caching_text_embeddings = False
+        self.text_embedding_cache: Union[TextEmbeddingCache, None] = None
+
         self.do_lorm = self.get_conf('do_lorm', False)
         self.lorm_extract_mode = self.get_conf('lorm_extract_mode', 'ratio')
         self.lorm_extract_mode_param = self.get_conf('lorm_extract_mode_param', 0.25)
         # 'ratio', 0.25)
 
+        # in worker mode the base model is kept loaded between jobs. Only for plain LoRA training
+        # since anything else could change the base model
+        self.use_warm_model = is_warm_models_enabled() and not self.do_lorm \
+            and self.network_config is not None and self.network_config.type.lower() == 'lora' \
+            and self.embed_config is None and self.adapter_config is None \
+            and not self.train_config.train_text_encoder and not self.train_config.train_refiner
+
         # get the device state preset based on what we are training
         self.train_device_state_preset = get_train_sd_device_state_preset(
             device=self.device_torch,
@@ -173,6 +211,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             train_adapter=is_training_adapter,
             train_embedding=self.embed_config is not None,
             train_refiner=self.train_config.train_refiner,
+            cached_text_embeddings=self.is_caching_text_embeddings,
         )
 
         # fine_tuning here is for training actual SD network, not LoRA, embeddings, etc. it is (Dreambooth, etc)
@@ -269,7 +308,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.ema.eval()
 
         # send to be generated
-        self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+        self.sd.generate_images(
+            gen_img_config_list, sampler=sample_config.sampler, max_batch_size=sample_config.batch_size
+        )
 
         if self.ema is not None:
             self.ema.train()
@@ -385,6 +426,26 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # override in subclass
         pass
 
+    def _write_optimizer_state(self, optimizer_state, file_path):
+        try:
+            torch.save(optimizer_state, file_path)
+        except Exception as e:
+            print(e)
+            print("Could not save optimizer")
+
+    def _emit_saved_checkpoints(self, saved_paths, step):
+        for path in saved_paths:
+            emit_progress_event('checkpoint_saved', path=path, step=step)
+
+    def _write_async_save(self, save_jobs, file_path, saved_paths, step):
+        # runs on the async saver thread
+        for fn, args in save_jobs:
+            fn(*args)
+        print(f"Saved to {file_path}")
+        self.clean_up_saves()
+        self.post_save_hook(file_path)
+        self._emit_saved_checkpoints(saved_paths, step)
+
     def save(self, step=None):
         flush()
         if self.ema is not None:
@@ -404,6 +465,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
         file_path = os.path.join(self.save_root, filename)
 
         save_meta = copy.deepcopy(self.meta)
+        # writes handed to the async saver. State is snapshotted to host memory before returning
+        async_save_jobs = []
+        # model files written by this save, reported as progress events once they are on disk
+        saved_paths = []
         # get extra meta
         if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
             additional_save_meta = self.adapter.get_additional_save_metadata()
@@ -427,13 +492,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
                 # if we are doing embedding training as well, add that
                 embedding_dict = self.embedding.state_dict() if self.embedding else None
-                self.network.save_weights(
-                    file_path,
-                    dtype=get_torch_dtype(self.save_config.dtype),
-                    metadata=save_meta,
-                    extra_state_dict=embedding_dict
-                )
+                if self.async_saver is not None:
+                    save_dict = self.network.get_save_dict(
+                        dtype=get_torch_dtype(self.save_config.dtype),
+                        extra_state_dict=embedding_dict,
+                        to_pinned_memory=True
+                    )
+                    async_save_jobs.append((self.network.write_weights, (save_dict, file_path, save_meta)))
+                else:
+                    self.network.save_weights(
+                        file_path,
+                        dtype=get_torch_dtype(self.save_config.dtype),
+                        metadata=save_meta,
+                        extra_state_dict=embedding_dict
+                    )
                 self.network.multiplier = prev_multiplier
+                saved_paths.append(file_path)
                 # if we have an embedding as well, pair it with the network
 
             # even if added to lora, still save the trigger version
@@ -448,6 +522,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     # replace extension
                     emb_file_path = os.path.splitext(emb_file_path)[0] + ".pt"
                 self.embedding.save(emb_file_path)
+                saved_paths.append(emb_file_path)
 
             if self.adapter is not None and self.adapter_config.train:
                 adapter_name = self.job.name
@@ -500,6 +575,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         dtype=get_torch_dtype(self.save_config.dtype),
                         direct_save=self.adapter_config.train_only_image_encoder
                     )
+                if self.adapter_config.type == 'control_net':
+                    saved_paths.append(name_or_path)
+                else:
+                    saved_paths.append(file_path)
         else:
             if self.save_config.save_format == "diffusers":
                 # saving as a folder path
@@ -517,12 +596,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     save_meta,
                     get_torch_dtype(self.save_config.dtype)
                 )
+                saved_paths.append(file_path)
             if self.train_config.train_unet or self.train_config.train_text_encoder:
                 self.sd.save(
                     file_path,
                     save_meta,
                     get_torch_dtype(self.save_config.dtype)
                 )
+                saved_paths.append(file_path)
 
         # save learnable params as json if we have thim
         if self.snr_gos:
@@ -538,17 +619,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         # save optimizer
         if self.optimizer is not None:
-            try:
-                filename = f'optimizer.pt'
-                file_path = os.path.join(self.save_root, filename)
-                torch.save(self.optimizer.state_dict(), file_path)
-            except Exception as e:
-                print(e)
-                print("Could not save optimizer")
+            filename = f'optimizer.pt'
+            file_path = os.path.join(self.save_root, filename)
+            if self.async_saver is not None:
+                optimizer_state = snapshot_to_cpu(self.optimizer.state_dict())
+                async_save_jobs.append((self._write_optimizer_state, (optimizer_state, file_path)))
+            else:
+                self._write_optimizer_state(self.optimizer.state_dict(), file_path)
 
-        self.print(f"Saved to {file_path}")
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+        if self.async_saver is not None:
+            # blocks only if the previous checkpoints are still being written
+            self.async_saver.submit(self._write_async_save, async_save_jobs, file_path, saved_paths, self.step_num)
+        else:
+            self.print(f"Saved to {file_path}")
+            self.clean_up_saves()
+            self.post_save_hook(file_path)
+            self._emit_saved_checkpoints(saved_paths, self.step_num)
 
         if self.ema is not None:
             self.ema.train()
@@ -587,11 +673,47 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 params,
                 self.train_config.ema_config.ema_decay,
                 use_feedback=self.train_config.ema_config.use_feedback,
+                update_every=self.train_config.ema_config.update_every,
+                offload_to_cpu=self.train_config.ema_config.offload_to_cpu,
             )
 
     def before_dataset_load(self):
         pass
 
+    def cache_text_embeddings(self):
+        self.text_embedding_cache = TextEmbeddingCache(self.sd)
+        if isinstance(self.sd.text_encoder, list):
+            text_encoder_list = self.sd.text_encoder
+        else:
+            text_encoder_list = [self.sd.text_encoder]
+        for te in text_encoder_list:
+            te.to(self.sd.te_device_torch)
+        num_encoded = 0
+        for data_loader in [self.data_loader, self.data_loader_reg]:
+            if data_loader is None:
+                continue
+            for dataset in get_dataloader_datasets(data_loader):
+                is_reg = dataset.dataset_config.is_reg
+                prompts = []
+                # a dropped caption still gets the trigger added in process_general_training_batch
+                for caption in [''] + dataset.get_unique_captions():
+                    if self.trigger_word is not None:
+                        caption = self.sd.inject_trigger_into_prompt(
+                            caption,
+                            trigger=self.trigger_word,
+                            add_if_not_present=not is_reg,
+                        )
+                    prompts.append(caption)
+                num_encoded += self.text_embedding_cache.cache_prompts(
+                    prompts,
+                    dataset.get_text_embedding_cache_dir()
+                )
+        self.print(f"Cached {len(self.text_embedding_cache)} text embeddings ({num_encoded} newly encoded)")
+        # the text encoders are only needed for sampling now. generate_images moves them back when needed
+        for te in text_encoder_list:
+            te.to('cpu')
+        flush()
+
     def get_params(self):
         # you can extend this in subclass to get params
         # otherwise params will be gathered through normal means
@@ -717,7 +839,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         schedule_timesteps = self.sd.noise_scheduler.timesteps.to(self.device)
         timesteps = timesteps.to(self.device)
 
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(schedule_timesteps, timesteps)
 
         sigma = sigmas[step_indices].flatten()
         while len(sigma.shape) < n_dim:
@@ -751,6 +873,16 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         return noise
 
+    @property
+    def use_device_prefetcher(self) -> bool:
+        return self.train_config.prefetch_to_device and self.device_torch.type == 'cuda'
+
+    def iter_dataloader(self, dataloader: DataLoader):
+        if self.use_device_prefetcher:
+            # batches come out already on the device
+            return DevicePrefetcher(iter(dataloader), self.device_torch)
+        return iter(dataloader)
+
     def process_general_training_batch(self, batch: 'DataLoaderBatchDTO'):
         with torch.no_grad():
             with self.timer('prepare_prompt'):
@@ -979,8 +1111,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 #     )
                 #     timestep_indices = (u * self.sd.noise_scheduler.config.num_train_timesteps).long()
                 # convert the timestep_indices to a timestep
-                timesteps = [self.sd.noise_scheduler.timesteps[x.item()] for x in timestep_indices]
-                timesteps = torch.stack(timesteps, dim=0)
+                # index on the device so we do not wait on the gpu to read each index back
+                schedule_timesteps = self.sd.noise_scheduler.timesteps
+                timesteps = schedule_timesteps[timestep_indices.to(schedule_timesteps.device)]
 
                 # get noise
                 noise = self.get_noise(latents, batch_size, dtype=dtype)
@@ -1188,6 +1321,17 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.sd.adapter = self.adapter
 
     def run(self):
+        try:
+            self.run_training()
+        except BaseException:
+            if self.async_saver is not None:
+                # finish writing the checkpoints already queued and stop the writer, without hiding the error
+                self.async_saver.close(raise_errors=False)
+            raise
+        if self.async_saver is not None:
+            self.async_saver.close()
+
+    def run_training(self):
         # torch.autograd.set_detect_anomaly(True)
         # run base process run
         BaseTrainProcess.run(self)
@@ -1222,15 +1366,37 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 model_config_to_load.refiner_name_or_path = previous_refiner_save
                 self.load_training_state_from_metadata(previous_refiner_save)
 
-        self.sd = StableDiffusion(
-            device=self.device,
-            model_config=model_config_to_load,
-            dtype=self.train_config.dtype,
-            custom_pipeline=self.custom_pipeline,
-            noise_scheduler=sampler,
-        )
-        # run base sd process run
-        self.sd.load_model()
+        warm_model_key = None
+        self.sd = None
+        if self.use_warm_model:
+            warm_model_key = get_warm_model_key(
+                self.get_conf('model', {}),
+                device=self.device,
+                dtype=self.train_config.dtype,
+                noise_scheduler=self.train_config.noise_scheduler,
+                custom_pipeline=self.custom_pipeline,
+            )
+            self.sd = get_warm_model(warm_model_key)
+            if self.sd is not None:
+                self.print("Using warm base model from the previous job")
+
+        if self.sd is None:
+            self.sd = StableDiffusion(
+                device=self.device,
+                model_config=model_config_to_load,
+                dtype=self.train_config.dtype,
+                custom_pipeline=self.custom_pipeline,
+                noise_scheduler=sampler,
+            )
+            # run base sd process run
+            self.sd.load_model()
+            if warm_model_key is not None:
+                store_warm_model(warm_model_key, self.sd)
+
+        # sample prompts only need to be encoded once if nothing we train changes the text encoding
+        self.sd.clear_sample_cache()
+        self.sd.cache_sample_prompt_embeds = not self.train_config.train_text_encoder \
+            and self.embed_config is None and self.adapter_config is None
 
         dtype = get_torch_dtype(self.train_config.dtype)
 
@@ -1564,12 +1730,21 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.before_dataset_load()
         # load datasets if passed in the root process
         if self.datasets is not None:
-            self.data_loader = get_dataloader_from_datasets(self.datasets, self.train_config.batch_size, self.sd)
+            self.data_loader = get_dataloader_from_datasets(
+                self.datasets, self.train_config.batch_size, self.sd, token_budget=self.train_config.batch_token_budget,
+                pin_memory=self.use_device_prefetcher
+            )
         if self.datasets_reg is not None:
-            self.data_loader_reg = get_dataloader_from_datasets(self.datasets_reg, self.train_config.batch_size,
-                                                                self.sd)
+            # same budget so reg steps carry the same amount of work as train steps
+            self.data_loader_reg = get_dataloader_from_datasets(
+                self.datasets_reg, self.train_config.batch_size, self.sd,
+                token_budget=self.train_config.batch_token_budget,
+                pin_memory=self.use_device_prefetcher
+            )
 
         flush()
+        if self.is_caching_text_embeddings:
+            self.cache_text_embeddings()
         ### HOOK ###
         self.hook_before_train_loop()
 
@@ -1592,17 +1767,23 @@ class BaseSDTrainProcess(BaseTrainProcess):
             iterable=range(0, self.train_config.steps),
         )
         self.progress_bar.pause()
+        emit_progress_event(
+            'train_start',
+            name=self.job.name,
+            start_step=self.step_num,
+            total_steps=self.train_config.steps
+        )
 
         if self.data_loader is not None:
             dataloader = self.data_loader
-            dataloader_iterator = iter(dataloader)
+            dataloader_iterator = self.iter_dataloader(dataloader)
         else:
             dataloader = None
             dataloader_iterator = None
 
         if self.data_loader_reg is not None:
             dataloader_reg = self.data_loader_reg
-            dataloader_iterator_reg = iter(dataloader_reg)
+            dataloader_iterator_reg = self.iter_dataloader(dataloader_reg)
         else:
             dataloader_reg = None
             dataloader_iterator_reg = None
@@ -1629,7 +1810,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         start_step_num = self.step_num
         did_first_flush = False
+        self.metrics = MetricsAccumulator(self.device_torch, size=self.logging_config.log_every or 100)
+        is_cancelled = False
         for step in range(start_step_num, self.train_config.steps):
+            if is_job_cancel_requested():
+                # worker mode, stop here and clean up normally so the base model stays loaded
+                self.print(f"Job cancelled at step {self.step_num}")
+                is_cancelled = True
+                break
             self.timer.start('train_loop')
             if self.train_config.do_random_cfg:
                 self.train_config.do_cfg = True
@@ -1657,7 +1845,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         with self.timer('reset_batch:reg'):
                             # hit the end of an epoch, reset
                             self.progress_bar.pause()
-                            dataloader_iterator_reg = iter(dataloader_reg)
+                            dataloader_iterator_reg = self.iter_dataloader(dataloader_reg)
                             trigger_dataloader_setup_epoch(dataloader_reg)
 
                         with self.timer('get_batch:reg'):
@@ -1672,7 +1860,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         with self.timer('reset_batch'):
                             # hit the end of an epoch, reset
                             self.progress_bar.pause()
-                            dataloader_iterator = iter(dataloader)
+                            dataloader_iterator = self.iter_dataloader(dataloader)
                             trigger_dataloader_setup_epoch(dataloader)
                             self.epoch_num += 1
                             if self.train_config.gradient_accumulation_steps == -1:
@@ -1722,11 +1910,39 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 else:
                     learning_rate = optimizer.param_groups[0]['lr']
 
-                prog_bar_string = f"lr: {learning_rate:.1e}"
-                for key, value in loss_dict.items():
-                    prog_bar_string += f" {key}: {value:.3e}"
-
-                self.progress_bar.set_postfix_str(prog_bar_string)
+                # metrics stay on the device and are only read back at logging boundaries
+                self.metrics.add({**loss_dict, 'lr': learning_rate})
+                is_log_step = self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0
+                is_performance_log_step = self.performance_log_every > 0 and \
+                    self.step_num % self.performance_log_every == 0
+                metrics = None
+                if is_log_step or is_performance_log_step or is_save_step or step == self.train_config.steps - 1:
+                    metrics = self.metrics.flush()
+                    prog_bar_string = f"lr: {learning_rate:.1e}"
+                    for key, value in metrics.items():
+                        if key == 'lr':
+                            continue
+                        if key == 'nan_count':
+                            if value['sum'] > 0:
+                                prog_bar_string += f" nan: {int(value['sum'])}"
+                            continue
+                        prog_bar_string += f" {key}: {value['mean']:.3e}"
+                    self.progress_bar.set_postfix_str(prog_bar_string)
+                    if 'nan_count' in metrics and metrics['nan_count']['sum'] > 0:
+                        self.print(f"loss was nan for {int(metrics['nan_count']['sum'])} steps")
+
+                step_event = dict(
+                    # number of completed steps
+                    step=self.step_num + 1,
+                    total_steps=self.train_config.steps,
+                    lr=learning_rate,
+                    it_per_sec=self.progress_bar.format_dict.get('rate', None)
+                )
+                if metrics is not None:
+                    step_event['loss'] = {
+                        key: value['mean'] for key, value in metrics.items() if key != 'lr'
+                    }
+                emit_progress_event('step', **step_event)
 
                 # if the batch is a DataLoaderBatchDTO, then we need to clean it up
                 if isinstance(batch, DataLoaderBatchDTO):
@@ -1753,17 +1969,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         self.ensure_params_requires_grad()
                         self.progress_bar.unpause()
 
-                    if self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0:
+                    if is_log_step:
                         self.progress_bar.pause()
                         with self.timer('log_to_tensorboard'):
                             # log to tensorboard
                             if self.writer is not None:
-                                for key, value in loss_dict.items():
-                                    self.writer.add_scalar(f"{key}", value, self.step_num)
+                                for key, value in metrics.items():
+                                    if key == 'lr':
+                                        continue
+                                    if key == 'nan_count':
+                                        self.writer.add_scalar(f"{key}", value['sum'], self.step_num)
+                                    else:
+                                        self.writer.add_scalar(f"{key}", value['mean'], self.step_num)
                                 self.writer.add_scalar(f"lr", learning_rate, self.step_num)
                             self.progress_bar.unpause()
 
-                    if self.performance_log_every > 0 and self.step_num % self.performance_log_every == 0:
+                    if is_performance_log_step:
                         self.progress_bar.pause()
                         # print the timers and clear them
                         self.timer.print()
@@ -1789,11 +2010,21 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.progress_bar.close()
         if self.train_config.free_u:
             self.sd.pipeline.disable_freeu()
-        if not self.train_config.disable_sampling:
+        if not self.train_config.disable_sampling and not is_cancelled:
             self.sample(self.step_num)
         print("")
-        self.save()
-        if self.save_config.push_to_hub:
+        if not is_cancelled:
+            self.save()
+        if self.async_saver is not None:
+            # make sure every checkpoint is on disk before we push or exit
+            self.async_saver.wait()
+        emit_progress_event('train_end', step=self.step_num, total_steps=self.train_config.steps)
+        if warm_model_key is not None:
+            # take the network back off so the base model can be reused by the next job
+            self.network.remove_from_model()
+            self.sd.network = None
+            release_warm_model(warm_model_key, self.sd)
+        if self.save_config.push_to_hub and not is_cancelled:
             if("HF_TOKEN" not in os.environ):
                 interpreter_login(new_session=False, write_permission=True)
             self.push_to_hub(
@@ -55,7 +55,11 @@ class ExtractLoconProcess(BaseExtractProcess):
             self.sparsity,
             not self.disable_cp,
             extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
+            extract_text_encoder=self.extract_text_encoder,
+            batch_size=self.svd_batch_size,
+            lowrank=self.svd_lowrank,
+            oversample=self.svd_oversample,
+            num_workers=self.num_workers
         )
 
         self.add_meta(extract_diff_meta)
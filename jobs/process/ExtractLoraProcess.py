@@ -61,7 +61,11 @@ class ExtractLoraProcess(BaseExtractProcess):
             small_conv=False,
             linear_only=self.conv_param > 0.0000000001,
             extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
+            extract_text_encoder=self.extract_text_encoder,
+            batch_size=self.svd_batch_size,
+            lowrank=self.svd_lowrank,
+            oversample=self.svd_oversample,
+            num_workers=self.num_workers
         )
 
         self.add_meta(extract_diff_meta)
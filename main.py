@@ -8,9 +8,10 @@ from server.utils import (
     webhook_response,
 )
 from server.request_processor import process_request
+from server.webhook_dispatcher import close_webhook_dispatcher
 
 
-def train(training_request_dict: dict):
+def train(training_request_dict: dict, device=None):
     job=None
     try:
         training_request_defaults = TrainingRequest()
@@ -33,7 +34,7 @@ def train(training_request_dict: dict):
         if len(images_urls) == 0:
             return webhook_response(webhook_url, False, 400, "No image urls provided!")
 
-        dataset_path = save_images_and_generate_metadata(job_id, images_urls, lora_name)
+        dataset_path = save_images_and_generate_metadata(job_id, images_urls, lora_name, device=device)
 
         training_request = TrainingRequest()
         training_request.lora_name = lora_name
@@ -41,6 +42,10 @@ def train(training_request_dict: dict):
         training_request.dataset_folder = dataset_path
         training_request.webhook_url = webhook_url
         training_request.example_prompts = example_prompts
+        training_request.low_vram = training_request_dict.get(
+            "low_vram", training_request_defaults.low_vram
+        )
+        training_request.gpu_device = device
         config_file_path = generate_config_file(training_request)
         training_request.config_file = config_file_path
 
@@ -54,23 +59,28 @@ def train(training_request_dict: dict):
         print(ex)
         webhook_response(webhook_url, False, 500, str(ex),None if job is None else job.dict())
         raise Exception(ex)
+    finally:
+        # deliver anything still queued for this job
+        close_webhook_dispatcher(webhook_url, training_request_dict.get("job_id"))
+        close_webhook_dispatcher(webhook_url)
 
 
-training_request_dict = {
-    "job_id": "alkjdiersdkjk",
-    "lora_name": "Irfan",
-    "webhook_url": "https://webhook.site/6292251e-6223-4091-8e32-8ca191b2ede6",
-    "images_urls": [
-        "https://i.ibb.co/gJnQY2P/5.jpg",
-        "https://i.ibb.co/pRg3FXj/8.jpg",
-        "https://i.ibb.co/ZYXfQjR/12.jpg",
-        "https://i.ibb.co/7yzxRHd/13.jpg",
-        "https://i.ibb.co/R6MqCcV/14.jpg",
-        "https://i.ibb.co/prQwJ55/22.jpg",
-        "https://i.ibb.co/TTQfVSY/25.jpg",
-        "https://i.ibb.co/QFDsytx/30.jpg",
-        "https://i.ibb.co/hRxDx5z/34.jpg",
-        "https://i.ibb.co/mCGnTkX/48.jpg",
-    ],
-}
-train(training_request_dict)
+if __name__ == "__main__":
+    training_request_dict = {
+        "job_id": "alkjdiersdkjk",
+        "lora_name": "Irfan",
+        "webhook_url": "https://webhook.site/6292251e-6223-4091-8e32-8ca191b2ede6",
+        "images_urls": [
+            "https://i.ibb.co/gJnQY2P/5.jpg",
+            "https://i.ibb.co/pRg3FXj/8.jpg",
+            "https://i.ibb.co/ZYXfQjR/12.jpg",
+            "https://i.ibb.co/7yzxRHd/13.jpg",
+            "https://i.ibb.co/R6MqCcV/14.jpg",
+            "https://i.ibb.co/prQwJ55/22.jpg",
+            "https://i.ibb.co/TTQfVSY/25.jpg",
+            "https://i.ibb.co/QFDsytx/30.jpg",
+            "https://i.ibb.co/hRxDx5z/34.jpg",
+            "https://i.ibb.co/mCGnTkX/48.jpg",
+        ],
+    }
+    train(training_request_dict)
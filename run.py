@@ -36,13 +36,66 @@ def print_end_message(jobs_completed, jobs_failed):
     print("========================================")
 
 
+def run_worker(name=None):
+    import gc
+    import traceback
+    import torch
+    from toolkit.progress_events import emit_progress_event
+    import queue
+    import threading
+    from toolkit.warm_model import enable_warm_models, clear_warm_models
+    from toolkit.job_cancel import WORKER_CANCEL_COMMAND, request_job_cancel, set_current_job, \
+        is_job_cancel_requested
+    enable_warm_models()
+
+    # stdin is read on a thread so a cancel can come in while a job is training
+    config_files = queue.Queue()
+
+    def read_stdin():
+        for stdin_line in sys.stdin:
+            stdin_line = stdin_line.strip()
+            if stdin_line.startswith(WORKER_CANCEL_COMMAND):
+                request_job_cancel(stdin_line[len(WORKER_CANCEL_COMMAND):].strip())
+            elif len(stdin_line) > 0:
+                config_files.put(stdin_line)
+        # server went away
+        config_files.put(None)
+
+    threading.Thread(target=read_stdin, daemon=True).start()
+    print("Worker ready, waiting for config files")
+    while True:
+        config_file = config_files.get()
+        if config_file is None:
+            break
+        set_current_job(config_file)
+        try:
+            job = get_job(config_file, name)
+            job.run()
+            job.cleanup()
+            if is_job_cancel_requested():
+                # the trainer stopped early and took its network back off, the base model is still good
+                emit_progress_event('job_end', config_file=config_file, success=False, error="Job cancelled")
+            else:
+                emit_progress_event('job_end', config_file=config_file, success=True)
+        except Exception as e:
+            print(f"Error running job: {e}")
+            traceback.print_exc()
+            # the job may have left its network on the base model
+            clear_warm_models()
+            emit_progress_event('job_end', config_file=config_file, success=False, error=str(e))
+        finally:
+            set_current_job(None)
+            gc.collect()
+            torch.cuda.empty_cache()
+
+
 def main():
     parser = argparse.ArgumentParser()
 
     # require at lease one config file
     parser.add_argument(
         'config_file_list',
-        nargs='+',
+        nargs='*',
         type=str,
         help='Name of config file (eg: person_v1 for config/person_v1.json/yaml), or full path if it is not in config folder, you can pass multiple config files and run them all sequentially'
     )
@@ -61,8 +114,19 @@ def main():
         default=None,
         help='Name to replace [name] tag in config file, useful for shared config file'
     )
+
+    # keep the process alive and run config files read from stdin, one per line
+    parser.add_argument(
+        '-w', '--worker',
+        action='store_true',
+        help='Run as a worker that reads config files from stdin and keeps the base model loaded between jobs'
+    )
     args = parser.parse_args()
 
+    if args.worker:
+        run_worker(args.name)
+        return
+
     config_file_list = args.config_file_list
     if len(config_file_list) == 0:
         raise Exception("You must provide at least one config file")
@@ -0,0 +1,94 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import AutoModelForCausalLM, AutoProcessor
+
+import server.server_settings as server_settings
+
+CAPTION_MODEL_PATH = "multimodalart/Florence-2-large-no-flash-attn"
+
+
+class CaptionModelPool:
+    """
+    Keeps the caption model loaded between jobs. It lives on the gpu only while captioning,
+    then waits in cpu memory so the training subprocess gets the whole gpu. It is unloaded
+    completely after being idle for idle_timeout seconds. There is one pool per gpu, so jobs
+    caption on the gpu they were scheduled on.
+    """
+
+    def __init__(self, model_path=CAPTION_MODEL_PATH, idle_timeout=600, device=None):
+        self.model_path = model_path
+        self.idle_timeout = idle_timeout
+        if not torch.cuda.is_available():
+            self.device = "cpu"
+        elif device is None:
+            self.device = "cuda"
+        else:
+            self.device = f"cuda:{device}"
+        self.torch_dtype = torch.float16
+        self.model = None
+        self.processor = None
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+        self._evict_timer = None
+
+    def _load(self):
+        print(f"Loading caption model {self.model_path}")
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.model_path,
+            torch_dtype=self.torch_dtype,
+            trust_remote_code=True,
+        )
+        self.processor = AutoProcessor.from_pretrained(
+            self.model_path, trust_remote_code=True
+        )
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            if self._evict_timer is not None:
+                self._evict_timer.cancel()
+                self._evict_timer = None
+            if self.model is None:
+                self._load()
+            self.model.to(self.device)
+            try:
+                yield self.model, self.processor
+            finally:
+                # hand the gpu back before training starts
+                self.model.to("cpu")
+                if self.device != "cpu":
+                    with torch.cuda.device(self.device):
+                        torch.cuda.empty_cache()
+                self.last_used = time.time()
+                self._evict_timer = threading.Timer(self.idle_timeout, self._evict_if_idle)
+                self._evict_timer.daemon = True
+                self._evict_timer.start()
+
+    def _evict_if_idle(self):
+        with self._lock:
+            if self.model is None or time.time() - self.last_used < self.idle_timeout:
+                return
+            print(f"Unloading idle caption model {self.model_path}")
+            del self.model
+            del self.processor
+            self.model = None
+            self.processor = None
+            self._evict_timer = None
+
+
+caption_model_pools = {}
+_caption_model_pools_lock = threading.Lock()
+
+
+def get_caption_model_pool(device=None) -> CaptionModelPool:
+    # device is the gpu index the job was scheduled on, None for the default device
+    with _caption_model_pools_lock:
+        if device not in caption_model_pools:
+            caption_model_pools[device] = CaptionModelPool(
+                idle_timeout=server_settings.CAPTION_MODEL_IDLE_TIMEOUT,
+                device=device,
+            )
+        return caption_model_pools[device]
@@ -0,0 +1,52 @@
+import os
+import subprocess
+
+# gpu memory is read with nvidia-smi so the server process never creates a cuda context of its own.
+# nvidia-smi numbers gpus in pci bus order, the training processes are started with the same order
+
+
+def query_nvidia_smi(query, fields):
+    output = subprocess.check_output(
+        ["nvidia-smi", f"--query-{query}={','.join(fields)}", "--format=csv,noheader,nounits"],
+        text=True,
+        timeout=30,
+    )
+    rows = []
+    for line in output.strip().splitlines():
+        if len(line.strip()) == 0:
+            continue
+        rows.append([value.strip() for value in line.split(",")])
+    return rows
+
+
+def get_gpu_devices():
+    try:
+        return [int(index) for index, in query_nvidia_smi("gpu", ["index"])]
+    except (FileNotFoundError, subprocess.SubprocessError):
+        return []
+
+
+def get_gpu_free_memory(device):
+    # free bytes on a gpu
+    for index, memory_free in query_nvidia_smi("gpu", ["index", "memory.free"]):
+        if int(index) == device:
+            # reported in MiB
+            return int(memory_free) * 1024 ** 2
+    raise ValueError(f"Unknown gpu {device}")
+
+
+def get_process_group_gpu_memory(device, pgid):
+    # bytes the processes in a process group hold on a gpu
+    uuid_to_index = {uuid: int(index) for index, uuid in query_nvidia_smi("gpu", ["index", "uuid"])}
+    used_bytes = 0
+    for gpu_uuid, pid, used_memory in query_nvidia_smi("compute-apps", ["gpu_uuid", "pid", "used_memory"]):
+        if uuid_to_index.get(gpu_uuid) != device:
+            continue
+        try:
+            if os.getpgid(int(pid)) != pgid:
+                continue
+            # reported in MiB, [N/A] when the driver does not know
+            used_bytes += int(used_memory) * 1024 ** 2
+        except (ProcessLookupError, ValueError):
+            continue
+    return used_bytes
@@ -0,0 +1,243 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import server.server_settings as server_settings
+from server.gpu_info import get_gpu_devices, get_gpu_free_memory, get_process_group_gpu_memory
+from server.request_queue import JobStatus
+
+
+class JobStore:
+    """
+    SQLite backed job queue. Waiting jobs survive a server restart, and jobs that were
+    processing when the server went down are put back in the queue.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    request TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    low_vram INTEGER NOT NULL DEFAULT 1,
+                    device INTEGER,
+                    error_message TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def add(self, job_id, request_dict, priority=0, low_vram=True):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, request, status, priority, low_vram, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(request_dict), JobStatus.WAITING.value, priority, int(low_vram), now, now),
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row_to_dict(row) if row is not None else None
+
+    def list(self, status=None):
+        with self._lock:
+            if status is None:
+                rows = self._conn.execute("SELECT * FROM jobs ORDER BY created_at").fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, created_at", (status,)
+                ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def claim_next(self, device, fits):
+        # highest priority waiting job that fits on the device, oldest first. fits is called with the
+        # store locked, it must not block
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, created_at",
+                (JobStatus.WAITING.value,),
+            ).fetchall()
+            for row in rows:
+                if not fits(bool(row["low_vram"])):
+                    continue
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, device = ?, updated_at = ? WHERE job_id = ?",
+                    (JobStatus.PROCESSING.value, device, time.time(), row["job_id"]),
+                )
+                job = self._row_to_dict(row)
+                job["status"] = JobStatus.PROCESSING.value
+                job["device"] = device
+                return job
+        return None
+
+    def update_status(self, job_id, status, error_message=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error_message = ?, updated_at = ? WHERE job_id = ?",
+                (status, error_message, time.time(), job_id),
+            )
+
+    def set_priority(self, job_id, priority):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET priority = ?, updated_at = ? WHERE job_id = ? AND status = ?",
+                (priority, time.time(), job_id, JobStatus.WAITING.value),
+            )
+        return cursor.rowcount > 0
+
+    def requeue_interrupted(self):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, device = NULL, updated_at = ? WHERE status = ?",
+                (JobStatus.WAITING.value, time.time(), JobStatus.PROCESSING.value),
+            )
+        return cursor.rowcount
+
+    @staticmethod
+    def _row_to_dict(row):
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        job["low_vram"] = bool(job["low_vram"])
+        return job
+
+
+class GpuScheduler:
+    """
+    Runs queued jobs with one worker per gpu. A worker only takes a job when the device has
+    enough free memory for it, based on the low_vram flag.
+    """
+
+    def __init__(self, store: JobStore, run_job, devices=None):
+        self.store = store
+        # run_job(request_dict, device) raises on failure
+        self.run_job = run_job
+        if devices is None:
+            devices = get_gpu_devices()
+            if len(devices) == 0:
+                devices = [None]
+        self.devices = devices
+        # one per worker, a shared event could be cleared by one worker before another saw it
+        self._wake = {device: threading.Event() for device in devices}
+        self._workers = []
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        requeued = self.store.requeue_interrupted()
+        if requeued > 0:
+            print(f"Requeued {requeued} jobs interrupted by a restart")
+        for device in self.devices:
+            worker = threading.Thread(target=self._worker, args=(device,), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job_id, request_dict, priority=0):
+        low_vram = request_dict.get("low_vram", True)
+        try:
+            self.store.add(job_id, request_dict, priority=priority, low_vram=low_vram)
+        except sqlite3.IntegrityError:
+            # job_id is already taken
+            return False
+        self._wake_workers()
+        return True
+
+    def cancel(self, job_id):
+        # imported here so the scheduler does not pull in the training pipeline on import
+        from server.request_processor import cancel_training
+
+        job = self.store.get(job_id)
+        if job is None:
+            return False
+        if job["status"] == JobStatus.WAITING.value:
+            self.store.update_status(job_id, JobStatus.CANCELLED.value)
+            return True
+        if job["status"] == JobStatus.PROCESSING.value:
+            self.store.update_status(job_id, JobStatus.CANCELLED.value)
+            cancel_training(job_id)
+            return True
+        return False
+
+    def set_priority(self, job_id, priority):
+        updated = self.store.set_priority(job_id, priority)
+        self._wake_workers()
+        return updated
+
+    def _wake_workers(self):
+        for wake in self._wake.values():
+            wake.set()
+
+    def _get_available_bytes(self, device):
+        from server.request_processor import training_workers
+
+        free_bytes = get_gpu_free_memory(device)
+        worker = training_workers.get(device, None)
+        if worker is not None and worker.is_alive():
+            # the idle warm worker runs the job itself, so the memory it holds is available to it
+            free_bytes += get_process_group_gpu_memory(device, worker.process.pid)
+        return free_bytes
+
+    @staticmethod
+    def _fits(available_bytes, low_vram):
+        if available_bytes is None:
+            return True
+        required_gb = (
+            server_settings.VRAM_REQUIRED_LOW_VRAM_GB if low_vram else server_settings.VRAM_REQUIRED_GB
+        )
+        return available_bytes >= required_gb * 1024 ** 3
+
+    def _worker(self, device):
+        wake = self._wake[device]
+        while True:
+            # cleared before looking, so a job submitted from here on always wakes the wait below
+            wake.clear()
+            available_bytes = None
+            if device is not None:
+                try:
+                    # read before claiming, the store stays locked while claiming
+                    available_bytes = self._get_available_bytes(device)
+                except Exception as e:
+                    print(f"Could not read free memory on device {device}: {e}")
+                    wake.wait(server_settings.SCHEDULER_POLL_INTERVAL)
+                    continue
+            job = self.store.claim_next(device, lambda low_vram: self._fits(available_bytes, low_vram))
+            if job is None:
+                # wait for a submit or poll again in case memory frees up
+                wake.wait(server_settings.SCHEDULER_POLL_INTERVAL)
+                continue
+            job_id = job["job_id"]
+            print(f"Starting job {job_id} on device {device}")
+            try:
+                self.run_job(job["request"], device)
+                if self.store.get(job_id)["status"] != JobStatus.CANCELLED.value:
+                    self.store.update_status(job_id, JobStatus.FINISHED.value)
+            except Exception as e:
+                if self.store.get(job_id)["status"] != JobStatus.CANCELLED.value:
+                    self.store.update_status(job_id, JobStatus.FAILED.value, error_message=str(e))
+
+
+_job_scheduler = None
+
+
+def get_job_scheduler() -> GpuScheduler:
+    global _job_scheduler
+    if _job_scheduler is None:
+        from main import train
+
+        store = JobStore(server_settings.JOB_DB_PATH)
+        _job_scheduler = GpuScheduler(store, lambda request_dict, device: train(request_dict, device=device))
+        _job_scheduler.start()
+    return _job_scheduler
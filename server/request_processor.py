@@ -1,10 +1,11 @@
 import os
-import re
 import copy
-import select
+import json
+import signal
 import subprocess
+from collections import deque
 import requests
-from threading import Thread
+from threading import Lock, Thread, Timer
 from PIL import Image
 import server.server_settings as server_settings
 from server.request_queue import (
@@ -16,81 +17,176 @@ from server.request_queue import (
 )
 from server.s3_utils import upload_media_to_s3
 from server.utils import webhook_response
+from toolkit.job_cancel import WORKER_CANCEL_COMMAND
+from toolkit.progress_events import PROGRESS_FD_ENV
 
+# training subprocesses by job id, so they can be cancelled
+running_processes = {}
+# warm workers by the job id they are running, cancelled without stopping the worker
+running_workers = {}
+cancelled_jobs = set()
+# jobs currently training, for live progress in the status endpoint
+active_jobs = {}
+
+
+def read_progress_events(events, job: Job):
+    # returns the job_end event in worker mode, None if the stream ended first
+    for line in events:
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if event.get("event") == "job_end":
+            return event
+        handle_progress_event(job, event)
+    return None
 
-def background_training(job: Job):
-    yaml_path = job.job_request.config_file
-    command = f"bash -c 'cd {server_settings.BASE_DIR} && source venv/bin/activate && python -u run.py {yaml_path}'"
-    print(command)
 
+def start_training_process(command, gpu_device, stdin=None):
+    # the trainer writes json lines progress events to the write end of this pipe
+    events_read_fd, events_write_fd = os.pipe()
+    env = os.environ.copy()
+    env[PROGRESS_FD_ENV] = str(events_write_fd)
+    if gpu_device is not None:
+        # the scheduler numbers gpus like nvidia-smi does
+        env["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu_device)
     try:
         process = subprocess.Popen(
             command,
             shell=True,
-            stdout=subprocess.PIPE,
+            stdin=stdin,
             stderr=subprocess.PIPE,
             text=True,
+            env=env,
+            pass_fds=(events_write_fd,),
+            # own process group so cancel can stop bash and python together
+            start_new_session=True,
         )
+    finally:
+        # only the child keeps the write end open, so we get EOF when it exits
+        os.close(events_write_fd)
 
-        # Use select to read from stdout and stderr without blocking
-        logs_count = 0
-        safetensors_files = set()
-        stderr_output = []
-        while True:
-            reads = [process.stdout.fileno(), process.stderr.fileno()]
-            ret = select.select(reads, [], [])
-            for fd in ret[0]:
-                if fd == process.stdout.fileno():
-                    read = process.stdout.readline()
-                    if read:
-                        output = read.strip()
-                        print(output)
-                        percentage = 0
-                        if f"/{job.job_request.steps}" in output:
-                            percentage_value = get_progress_percentage(output)
-                            percentage = percentage_value if percentage_value else 0
-                            logs_count += 1
-                        job.job_progress = percentage
-                        webhook_response(
-                            job.job_request.webhook_url,
-                            True,
-                            200,
-                            "Job Progress",
-                            job.dict(),
-                        )
-                        if logs_count % 20 == 0:
-                            process_response(job, safetensors_files)
-                if fd == process.stderr.fileno():
-                    read = process.stderr.readline()
-                    if read:
-                        output = read.strip()
-                        print(output)
-                        stderr_output.append(output)
-                        percentage = 0
-                        if f"/{job.job_request.steps}" in output:
-                            percentage_value = get_progress_percentage(output)
-                            percentage = percentage_value if percentage_value else 0
-                            logs_count += 1
-                        job.job_progress = percentage
-                        webhook_response(
-                            job.job_request.webhook_url,
-                            True,
-                            200,
-                            "Job Progress",
-                            job.dict(),
-                        )
-                        if logs_count % 20 == 0:
-                            process_response(job, safetensors_files)
-                print(job.job_progress)
-            if process.poll() is not None:
-                break
-
-        return_code = process.poll()
-        if return_code != 0:
-            stderr_combined = "\n".join(stderr_output)
-            raise subprocess.CalledProcessError(
-                return_code, command, output=stderr_combined
-            )
+    # logs are only echoed, keep the tail for the error message
+    stderr_output = deque(maxlen=200)
+    stderr_thread = Thread(
+        target=drain_stderr, args=(process.stderr, stderr_output), daemon=True
+    )
+    stderr_thread.start()
+    return process, os.fdopen(events_read_fd, "r"), stderr_output, stderr_thread
+
+
+class TrainingWorker:
+    """
+    Long lived run.py --worker process for one gpu. It keeps the base model loaded, so back
+    to back jobs skip loading and quantizing it.
+    """
+
+    def __init__(self, gpu_device):
+        self.gpu_device = gpu_device
+        self.command = f"bash -c 'cd {server_settings.BASE_DIR} && source venv/bin/activate && python -u run.py --worker'"
+        self.process = None
+        self.events = None
+        self.stderr_output = None
+        self.lock = Lock()
+        self.stdin_lock = Lock()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        print(self.command)
+        self.process, self.events, self.stderr_output, _ = start_training_process(
+            self.command, self.gpu_device, stdin=subprocess.PIPE
+        )
+
+    def run_job(self, job: Job):
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+            running_processes[job.job_id] = self.process
+            running_workers[job.job_id] = self
+            try:
+                self.write_line(job.job_request.config_file)
+                job_end = read_progress_events(self.events, job)
+            finally:
+                running_processes.pop(job.job_id, None)
+                running_workers.pop(job.job_id, None)
+            if job_end is None:
+                # worker died, it is started again for the next job
+                self.process.wait()
+                stderr_combined = "\n".join(self.stderr_output)
+                raise subprocess.CalledProcessError(
+                    self.process.returncode, self.command, output=stderr_combined
+                )
+            if not job_end["success"]:
+                raise Exception(job_end["error"])
+
+    def write_line(self, line):
+        with self.stdin_lock:
+            self.process.stdin.write(line + "\n")
+            self.process.stdin.flush()
+
+    def cancel(self, job: Job):
+        # the trainer stops at the next step and keeps the base model loaded for the next job
+        process = self.process
+        try:
+            self.write_line(f"{WORKER_CANCEL_COMMAND} {job.job_request.config_file}")
+        except (BrokenPipeError, OSError, AttributeError):
+            pass
+        # stop the whole worker if it does not respond, the next job starts a new one
+        timer = Timer(
+            server_settings.WORKER_CANCEL_TIMEOUT,
+            kill_if_running,
+            args=(job.job_id, process),
+        )
+        timer.daemon = True
+        timer.start()
+
+
+training_workers = {}
+
+
+def get_training_worker(gpu_device) -> TrainingWorker:
+    if gpu_device not in training_workers:
+        training_workers[gpu_device] = TrainingWorker(gpu_device)
+    return training_workers[gpu_device]
+
+
+def run_training_process(job: Job):
+    yaml_path = job.job_request.config_file
+    command = f"bash -c 'cd {server_settings.BASE_DIR} && source venv/bin/activate && python -u run.py {yaml_path}'"
+    print(command)
+
+    process, events, stderr_output, stderr_thread = start_training_process(
+        command, job.job_request.gpu_device
+    )
+    running_processes[job.job_id] = process
+    with events:
+        read_progress_events(events, job)
+
+    return_code = process.wait()
+    stderr_thread.join()
+    running_processes.pop(job.job_id, None)
+    if return_code != 0:
+        stderr_combined = "\n".join(stderr_output)
+        raise subprocess.CalledProcessError(
+            return_code, command, output=stderr_combined
+        )
+
+
+def background_training(job: Job):
+    try:
+        try:
+            if server_settings.WARM_MODEL_WORKERS:
+                get_training_worker(job.job_request.gpu_device).run_job(job)
+            else:
+                run_training_process(job)
+        finally:
+            if job.job_id in cancelled_jobs:
+                cancelled_jobs.discard(job.job_id)
+                job.job_status = JobStatus.CANCELLED.value
+                raise Exception("Job cancelled")
 
         print("Job is Finished")
         job.job_progress = 100
@@ -104,56 +200,91 @@ def background_training(job: Job):
 
     except Exception as e:
         print(e)
-        job.job_status = JobStatus.FAILED.value
+        if job.job_status != JobStatus.CANCELLED.value:
+            job.job_status = JobStatus.FAILED.value
         job.error_message = str(e)
         raise Exception(str(e))
 
 
+def kill_if_running(job_id, process):
+    if running_processes.get(job_id) is process and process.poll() is None:
+        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+
+
+def cancel_training(job_id):
+    cancelled_jobs.add(job_id)
+    worker = running_workers.get(job_id)
+    if worker is not None:
+        job = active_jobs.get(job_id)
+        if job is not None:
+            worker.cancel(job)
+            return
+    process = running_processes.get(job_id)
+    if process is not None:
+        kill_if_running(job_id, process)
+
+
+def drain_stderr(stream, stderr_output: deque):
+    for read in stream:
+        output = read.strip()
+        print(output)
+        stderr_output.append(output)
+
+
+def handle_progress_event(job: Job, event: dict):
+    event_type = event.get("event")
+    if event_type == "step":
+        percentage = event["step"] / event["total_steps"] * 100
+        # only report whole percent changes, steps can come in much faster than webhooks
+        if int(percentage) != int(job.job_progress or 0):
+            job.job_progress = percentage
+            webhook_response(
+                job.job_request.webhook_url,
+                True,
+                200,
+                "Job Progress",
+                job.dict(),
+            )
+        else:
+            job.job_progress = percentage
+    elif event_type == "checkpoint_saved":
+        if event["path"].endswith(".safetensors"):
+            process_checkpoint(job, event["path"])
+    elif event_type == "sample_saved":
+        print(f"Sample saved: {event['path']}")
+
+
 def process_request(job: Job):
+    if job.job_id in cancelled_jobs:
+        # cancelled while the dataset was being prepared
+        cancelled_jobs.discard(job.job_id)
+        job.job_status = JobStatus.CANCELLED.value
+        raise Exception("Job cancelled")
     job.job_status = JobStatus.PROCESSING.value
+    active_jobs[job.job_id] = job
     webhook_response(job.job_request.webhook_url, True, 200, "Job Started", job.dict())
-    background_training(job)
-
-
-def get_progress_percentage(output_line):
-    # Regex pattern to find the diffusion process progress
-    pattern = re.compile(r"(\d+)/(\d+)\s+\[")
-    match = pattern.search(output_line)
-    if match:
-        current, total = map(int, match.groups())
-        percentage = (current / total) * 100
-        return percentage
-    return None
+    try:
+        background_training(job)
+    finally:
+        active_jobs.pop(job.job_id, None)
 
 
-def process_response(job: Job, safetensors_files: set):
-    safetensors_files_path = os.path.join(
-        job.job_request.dataset_folder,job.job_request.lora_name
+def process_checkpoint(job: Job, saved_checkout_path: str):
+    new_file = os.path.basename(saved_checkout_path)
+    print(f"New file found: {new_file}")
+    epoch_response = TrainingResponse(
+        total_epochs=job.job_epochs,
+        current_epoch_number=len(job.job_results) + 1,
     )
-    current_files = (
-        {f for f in os.listdir(safetensors_files_path) if f.endswith(".safetensors")}
-        if os.path.exists(safetensors_files_path)
-        else set()
+    epoch_model_s3_path = f"{job.job_s3_folder}{new_file}"
+    print("Going to upload model in S3 at ", epoch_response)
+    print("Local Path of uploaded model is ", saved_checkout_path)
+    epoch_response.epoch_model_s3_path = epoch_model_s3_path
+    Thread(
+        target=upload_media_to_s3,
+        args=(saved_checkout_path, epoch_model_s3_path),
+    ).start()
+    webhook_response(
+        job.job_request.webhook_url, True, 200, "Epoch Completed", job.dict()
     )
-    new_files = current_files - safetensors_files
-    if new_files:
-        for new_file in new_files:
-            print(f"New file found: {new_file}")
-            epoch_response = TrainingResponse(
-                total_epochs=job.job_epochs,
-                current_epoch_number=len(job.job_results) + 1,
-            )
-            epoch_model_s3_path = f"{job.job_s3_folder}{new_file}"
-            saved_checkout_path = os.path.join(safetensors_files_path, new_file)
-            print("Going to upload model in S3 at ", epoch_response)
-            print("Local Path of uploaded model is ", saved_checkout_path)
-            epoch_response.epoch_model_s3_path = epoch_model_s3_path
-            Thread(
-                target=upload_media_to_s3,
-                args=(saved_checkout_path, epoch_model_s3_path),
-            ).start()
-            webhook_response(
-                job.job_request.webhook_url, True, 200, "Epoch Completed", job.dict()
-            )
-            job.job_results.append(epoch_response)
-        safetensors_files.update(new_files)
+    job.job_results.append(epoch_response)
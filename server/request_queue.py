@@ -23,6 +23,7 @@ class TrainingRequest(BaseModel):
     config_file: str = ""
     example_prompts: list = []
     webhook_url: str | None = None
+    gpu_device: int | None = None  # set by the scheduler
 
 
 class JobStatus(Enum):
@@ -30,6 +31,7 @@ class JobStatus(Enum):
     PROCESSING = "processing"
     FINISHED = "finished"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 
 class TrainingResponse(BaseModel):
@@ -58,12 +60,3 @@ class Job(BaseModel):
         if self.job_id:
             self.job_s3_folder = f"loras/{datetime.now().strftime('%Y-%m-%d')}/{self.job_id}/"
 
-
-class JobQueue:
-    def __init__(self):
-        self.pending: List[Job] = []
-        self.history: List[Job] = []
-        self.last_job_id = None
-
-
-job_queue = JobQueue()
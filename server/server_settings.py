@@ -7,4 +7,24 @@ AWS_REGION=config("AWS_REGION")
 AWS_BUCKET_NAME=config("AWS_BUCKET_NAME")
 
 BASE_DIR = "/var/www/flux-lora-training"
-DATASET_DIR = os.path.join(BASE_DIR,"datasets")
\ No newline at end of file
+DATASET_DIR = os.path.join(BASE_DIR,"datasets")
+
+# scheduler
+JOB_DB_PATH = config("JOB_DB_PATH", default=os.path.join(BASE_DIR, "jobs.sqlite3"))
+# free gpu memory a job needs before a worker will start it
+VRAM_REQUIRED_GB = config("VRAM_REQUIRED_GB", default=24, cast=float)
+VRAM_REQUIRED_LOW_VRAM_GB = config("VRAM_REQUIRED_LOW_VRAM_GB", default=18, cast=float)
+SCHEDULER_POLL_INTERVAL = config("SCHEDULER_POLL_INTERVAL", default=10, cast=float)
+
+# keep a run.py --worker process per gpu so the base model stays loaded between jobs
+WARM_MODEL_WORKERS = config("WARM_MODEL_WORKERS", default=False, cast=bool)
+# seconds a warm worker gets to stop a cancelled job before the whole worker is killed
+WORKER_CANCEL_TIMEOUT = config("WORKER_CANCEL_TIMEOUT", default=60, cast=float)
+# quantized transformer and t5 weights are saved here so cold starts skip quantization
+QUANTIZED_CACHE_DIR = config("QUANTIZED_CACHE_DIR", default=os.path.join(BASE_DIR, "cache/quantized"))
+
+# ingestion
+DOWNLOAD_WORKERS = config("DOWNLOAD_WORKERS", default=8, cast=int)
+CAPTION_BATCH_SIZE = config("CAPTION_BATCH_SIZE", default=8, cast=int)
+# seconds the caption model stays loaded after the last job
+CAPTION_MODEL_IDLE_TIMEOUT = config("CAPTION_MODEL_IDLE_TIMEOUT", default=600, cast=int)
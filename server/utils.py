@@ -1,5 +1,5 @@
 import os
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import uuid
 import json
 import yaml
@@ -7,47 +7,62 @@ import requests
 import torch
 from io import BytesIO
 from PIL import Image
-from transformers import AutoModelForCausalLM, AutoProcessor
 import server.server_settings as server_settings
+from server.caption_model_pool import get_caption_model_pool
 from server.request_queue import TrainingRequest, ModelTypes
+from server.webhook_dispatcher import get_webhook_dispatcher
 
 
-def save_images_and_generate_metadata(job_id, image_urls, lora_name):
-    dataset_path = os.path.join(server_settings.DATASET_DIR, lora_name, job_id)
-    os.makedirs(dataset_path, exist_ok=True)
+def download_image(session, url, image_path):
+    # runs in the download pool, decoding and re-encoding happen off the main thread
+    response = session.get(url, timeout=60)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    image = Image.open(BytesIO(response.content))
+    image = image.convert("RGB")
+    image.save(image_path, format="JPEG")
+    return image
 
-    metadata_file_path = os.path.join(dataset_path, "metadata.jsonl")
 
-    # Prepare the model and processor for captioning
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    torch_dtype = torch.float16
-    model = AutoModelForCausalLM.from_pretrained(
-        "multimodalart/Florence-2-large-no-flash-attn",
-        torch_dtype=torch_dtype,
-        trust_remote_code=True,
-    ).to(device)
-    processor = AutoProcessor.from_pretrained(
-        "multimodalart/Florence-2-large-no-flash-attn", trust_remote_code=True
-    )
-
-    with open(metadata_file_path, "w") as metadata_file:
-        # Download and process each image
+def download_images(image_urls, dataset_path):
+    images = {}
+    with requests.Session() as session, ThreadPoolExecutor(
+        max_workers=server_settings.DOWNLOAD_WORKERS
+    ) as pool:
+        futures = {}
         for idx, url in enumerate(image_urls):
+            image_path = os.path.join(dataset_path, f"{idx}.jpg")
+            futures[pool.submit(download_image, session, url, image_path)] = (
+                idx,
+                url,
+                image_path,
+            )
+        for future in as_completed(futures):
+            idx, url, image_path = futures[future]
             try:
-                response = requests.get(url)
-                response.raise_for_status()  # Raise an exception for HTTP errors
-                image = Image.open(BytesIO(response.content))
-                image = image.convert("RGB")
-                image_path = os.path.join(dataset_path, f"{idx}.jpg")
-                image.save(image_path, format="JPEG")
+                images[idx] = future.result()
                 print(f"Downloaded and saved image {idx} from {url} to {image_path}")
-
-                # Generate caption
-                prompt = "<DETAILED_CAPTION>"
-                inputs = processor(text=prompt, images=image, return_tensors="pt").to(
-                    device, torch_dtype
-                )
-
+            except requests.RequestException as e:
+                print(f"Failed to download {url}: {e}")
+            except IOError as e:
+                print(f"Failed to process image from {url}: {e}")
+    # keep the original order
+    return [(idx, images[idx]) for idx in sorted(images.keys())]
+
+
+def caption_images(images, device=None):
+    prompt = "<DETAILED_CAPTION>"
+    batch_size = server_settings.CAPTION_BATCH_SIZE
+    captions = []
+    # caption on the gpu the job was scheduled on
+    caption_model_pool = get_caption_model_pool(device)
+    with caption_model_pool.acquire() as (model, processor):
+        for i in range(0, len(images), batch_size):
+            batch = images[i : i + batch_size]
+            inputs = processor(
+                text=[prompt] * len(batch), images=batch, return_tensors="pt"
+            ).to(caption_model_pool.device, caption_model_pool.torch_dtype)
+
+            with torch.no_grad():
                 generated_ids = model.generate(
                     input_ids=inputs["input_ids"],
                     pixel_values=inputs["pixel_values"],
@@ -55,35 +70,42 @@ def save_images_and_generate_metadata(job_id, image_urls, lora_name):
                     num_beams=3,
                 )
 
-                generated_text = processor.batch_decode(
-                    generated_ids, skip_special_tokens=False
-                )[0]
+            generated_texts = processor.batch_decode(
+                generated_ids, skip_special_tokens=False
+            )
+            for image, generated_text in zip(batch, generated_texts):
                 parsed_answer = processor.post_process_generation(
                     generated_text, task=prompt, image_size=(image.width, image.height)
                 )
-                caption_text = parsed_answer["<DETAILED_CAPTION>"].replace(
-                    "The image shows ", ""
+                captions.append(
+                    parsed_answer["<DETAILED_CAPTION>"].replace("The image shows ", "")
                 )
+    return captions
 
-                # Add lora_name to the caption and save metadata
-                caption_text = f"{lora_name}, {caption_text}"
-                metadata = {"file_name": f"{idx}.jpg", "prompt": caption_text}
 
-                metadata_file.write(json.dumps(metadata) + "\n")
-                print(f"Image file Downloaded and Saved : ", image_path)
+def save_images_and_generate_metadata(job_id, image_urls, lora_name, device=None):
+    dataset_path = os.path.join(server_settings.DATASET_DIR, lora_name, job_id)
+    os.makedirs(dataset_path, exist_ok=True)
 
-            except requests.RequestException as e:
-                print(f"Failed to download {url}: {e}")
-            except IOError as e:
-                print(f"Failed to process image from {url}: {e}")
+    metadata_file_path = os.path.join(dataset_path, "metadata.jsonl")
+
+    # Download and process all images concurrently
+    downloaded = download_images(image_urls, dataset_path)
+
+    # Generate captions in batches
+    captions = caption_images([image for _, image in downloaded], device) if downloaded else []
+
+    with open(metadata_file_path, "w") as metadata_file:
+        for (idx, image), caption_text in zip(downloaded, captions):
+            # Add lora_name to the caption and save metadata
+            caption_text = f"{lora_name}, {caption_text}"
+            metadata = {"file_name": f"{idx}.jpg", "prompt": caption_text}
+
+            metadata_file.write(json.dumps(metadata) + "\n")
+            print(f"Image file Downloaded and Saved : ", os.path.join(dataset_path, f"{idx}.jpg"))
 
-    # Clean up the model from memory
-    model.to("cpu")
-    del model
-    del processor
-    torch.cuda.empty_cache()  # Explicitly clear GPU memory
     print(
-        f"Downloaded and saved {len(image_urls)} images with metadata to {metadata_file_path}"
+        f"Downloaded and saved {len(downloaded)} images with metadata to {metadata_file_path}"
     )
     return dataset_path
 
@@ -111,6 +133,7 @@ def generate_config_file(training_request: TrainingRequest):
     # Update the config with user inputs
     config["config"]["name"] = training_request.lora_name
     config["config"]["process"][0]["model"]["low_vram"] = training_request.low_vram
+    config["config"]["process"][0]["model"]["quantized_cache_dir"] = server_settings.QUANTIZED_CACHE_DIR
     config["config"]["process"][0]["train"]["skip_first_sample"] = True
     config["config"]["process"][0]["train"]["steps"] = int(training_request.steps)
     config["config"]["process"][0]["train"]["lr"] = float(
@@ -127,6 +150,8 @@ def generate_config_file(training_request: TrainingRequest):
     config["config"]["process"][0]["trigger_word"] = training_request.lora_name
     config["config"]["process"][0]["save"]["push_to_hub"] = push_to_hub
     config["config"]["process"][0]["save"]["save_every"] = training_request.save_step
+    # checkpoints are written in the background so frequent saves do not stall training
+    config["config"]["process"][0]["save"]["async_save"] = True
     config["config"]["process"][0]["trigger_word"] = training_request.lora_name
 
     if len(training_request.example_prompts) > 0:
@@ -166,15 +191,9 @@ def generate_config_file(training_request: TrainingRequest):
 
 
 def webhook_response(webhook_url, status, code, message, data=None):
-    def send(webhook_url, status, code, message, data=None):
-        response_data = {
-            "status": status,
-            "code": code,
-            "message": message,
-            "data": data,
-        }
-        if webhook_url and "http" in webhook_url:
-            requests.post(webhook_url, json=response_data)
-
-    Thread(target=send, args=(webhook_url, status, code, message, data)).start()
+    if not webhook_url or "http" not in webhook_url:
+        return None
+    # one dispatcher per job keeps updates ordered and reuses the connection
+    job_id = data.get("job_id") if isinstance(data, dict) else None
+    get_webhook_dispatcher(webhook_url, job_id).send(status, code, message, data)
     return None
@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import deque
+
+import requests
+
+# intermediate states that can be dropped in favor of a newer one
+COALESCED_MESSAGES = {"Job Progress"}
+
+
+class WebhookDispatcher:
+    """
+    Delivers webhooks for one job from a single long lived worker over a pooled session.
+    Progress updates are coalesced so only the latest one is sent per interval. Everything
+    else is delivered in order and retried with backoff.
+    """
+
+    def __init__(
+        self,
+        webhook_url,
+        progress_interval=2.0,
+        max_retries=5,
+        retry_backoff=1.0,
+        timeout=10.0,
+    ):
+        self.webhook_url = webhook_url
+        self.progress_interval = progress_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+
+        self._condition = threading.Condition()
+        # (payload, enqueued_at, retry)
+        self._pending = deque()
+        self._latest_progress = None
+        self._last_progress_sent = 0.0
+        self._closing = False
+
+        self.metrics = {
+            "delivered": 0,
+            "failed": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def is_enabled(self):
+        return bool(self.webhook_url) and "http" in self.webhook_url
+
+    def send(self, status, code, message, data=None):
+        if not self.is_enabled:
+            return
+        payload = {
+            "status": status,
+            "code": code,
+            "message": message,
+            "data": data,
+        }
+        item = (payload, time.time())
+        with self._condition:
+            if self._closing:
+                raise RuntimeError("Webhook dispatcher is closed")
+            if message in COALESCED_MESSAGES:
+                if self._latest_progress is not None:
+                    self.metrics["coalesced"] += 1
+                self._latest_progress = item
+            else:
+                # progress that came before this event is delivered before it
+                if self._latest_progress is not None:
+                    self._pending.append((*self._latest_progress, False))
+                    self._latest_progress = None
+                self._pending.append((*item, True))
+            self._condition.notify()
+
+    def _next_item(self):
+        with self._condition:
+            while True:
+                if len(self._pending) > 0:
+                    return self._pending.popleft()
+                if self._latest_progress is not None:
+                    wait_time = self._last_progress_sent + self.progress_interval - time.time()
+                    if wait_time <= 0 or self._closing:
+                        item = self._latest_progress
+                        self._latest_progress = None
+                        self._last_progress_sent = time.time()
+                        return (*item, False)
+                    self._condition.wait(wait_time)
+                elif self._closing:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                return
+            payload, enqueued_at, retry = item
+            self._deliver(payload, enqueued_at, retry)
+
+    def _deliver(self, payload, enqueued_at, retry):
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.metrics["retries"] += 1
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                response = self.session.post(
+                    self.webhook_url, json=payload, timeout=self.timeout
+                )
+                # client errors will not get better by trying again
+                if response.status_code < 500 and response.status_code != 429:
+                    latency = time.time() - enqueued_at
+                    self.metrics["delivered"] += 1
+                    self.metrics["latency_total"] += latency
+                    self.metrics["latency_max"] = max(self.metrics["latency_max"], latency)
+                    return
+                print(f"Webhook {payload['message']} returned {response.status_code}")
+            except requests.RequestException as e:
+                print(f"Webhook {payload['message']} failed: {e}")
+        self.metrics["failed"] += 1
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        latency_total = metrics.pop("latency_total")
+        metrics["latency_avg"] = latency_total / metrics["delivered"] if metrics["delivered"] > 0 else 0.0
+        return metrics
+
+    def close(self, timeout=None):
+        # delivers everything still pending, including the latest progress
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        self.session.close()
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def get_webhook_dispatcher(webhook_url, job_id=None) -> WebhookDispatcher:
+    key = (webhook_url, job_id)
+    with _dispatchers_lock:
+        if key not in _dispatchers:
+            _dispatchers[key] = WebhookDispatcher(webhook_url)
+        return _dispatchers[key]
+
+
+def close_webhook_dispatcher(webhook_url, job_id=None, timeout=None):
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.pop((webhook_url, job_id), None)
+    if dispatcher is not None:
+        dispatcher.close(timeout)
+        print(f"Webhook metrics for job {job_id}: {dispatcher.get_metrics()}")
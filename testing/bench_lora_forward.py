@@ -0,0 +1,99 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitModuleMixin, ToolkitNetworkMixin
+
+# compares the fused lora forward to the unfused one on cpu tensors
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', type=int, default=3072)
+parser.add_argument('--tokens', type=int, default=1024)
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--rank', type=int, default=16)
+parser.add_argument('--layers', type=int, default=8)
+parser.add_argument('--iters', type=int, default=20)
+parser.add_argument('--threads', type=int, default=None)
+args = parser.parse_args()
+
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+
+class BenchNetwork(ToolkitNetworkMixin, torch.nn.Module):
+    # just enough of a network to drive the modules
+    def __init__(self):
+        torch.nn.Module.__init__(self)
+        ToolkitNetworkMixin.__init__(self)
+        self.unet_loras = []
+
+
+torch.manual_seed(0)
+network = BenchNetwork()
+base_layers = [torch.nn.Linear(args.dim, args.dim) for _ in range(args.layers)]
+for i, layer in enumerate(base_layers):
+    layer.requires_grad_(False)
+    module = LoRAModule(f"lora_unet_{i}", layer, lora_dim=args.rank, alpha=args.rank, network=network)
+    # non zero up weights so both paths actually add something
+    torch.nn.init.normal_(module.lora_up.weight, std=0.01)
+    module.apply_to()
+    network.unet_loras.append(module)
+network._update_torch_multiplier()
+
+
+def run(x):
+    for layer in base_layers:
+        x = layer(x)
+    return x
+
+
+def set_forward(impl):
+    for module in network.unet_loras:
+        module.forward_impl = impl
+
+
+def bench(impl, backward: bool):
+    set_forward(impl)
+    x = torch.randn(args.batch_size, args.tokens, args.dim)
+    times = []
+    for i in range(args.iters + 3):
+        start = time.perf_counter()
+        if backward:
+            run(x).float().mean().backward()
+            for module in network.unet_loras:
+                module.zero_grad(set_to_none=True)
+        else:
+            with torch.no_grad():
+                run(x)
+        if i >= 3:
+            # first few are warmup
+            times.append(time.perf_counter() - start)
+    return sum(times) / len(times) * 1000
+
+
+network.is_active = True
+print(f"{args.layers} layers, {args.batch_size}x{args.tokens}x{args.dim}, rank {args.rank}")
+
+x = torch.randn(args.batch_size, args.tokens, args.dim)
+with torch.no_grad():
+    set_forward(ToolkitModuleMixin.unfused_forward)
+    unfused_out = run(x)
+    set_forward(ToolkitModuleMixin.fused_forward)
+    fused_out = run(x)
+print(f"max abs difference: {(unfused_out - fused_out).abs().max().item():.3e}")
+
+for backward in [False, True]:
+    label = "forward + backward" if backward else "forward"
+    base_ms = bench(ToolkitModuleMixin.bypass_forward, backward) if not backward else None
+    unfused_ms = bench(ToolkitModuleMixin.unfused_forward, backward)
+    fused_ms = bench(ToolkitModuleMixin.fused_forward, backward)
+    print(f"{label}:")
+    if base_ms is not None:
+        print(f"  base only: {base_ms:.2f} ms")
+    print(f"  unfused:   {unfused_ms:.2f} ms")
+    print(f"  fused:     {fused_ms:.2f} ms ({unfused_ms / fused_ms:.2f}x)")
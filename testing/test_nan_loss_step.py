@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizer import zero_non_finite_grads
+
+# runs a nan loss through a train step the way SDTrainer does and checks the weights are left alone
+
+torch.manual_seed(0)
+model = torch.nn.Linear(8, 4)
+params = list(model.parameters())
+optimizer = torch.optim.SGD(params, lr=0.1)
+
+
+def train_step(inputs):
+    loss = model(inputs).pow(2).mean()
+    loss_is_nan = torch.isnan(loss)
+    loss = torch.where(loss_is_nan, torch.zeros_like(loss), loss)
+    loss.backward()
+    zero_non_finite_grads(params)
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+    return loss_is_nan
+
+
+before = [param.detach().clone() for param in params]
+nan_inputs = torch.randn(2, 8)
+nan_inputs[0, 0] = float('nan')
+assert train_step(nan_inputs).item()
+for param, param_before in zip(params, before):
+    assert torch.isfinite(param).all(), "nan loss put nan in the weights"
+    assert torch.equal(param, param_before), "nan loss changed the weights"
+
+# a finite loss still trains
+assert not train_step(torch.randn(2, 8)).item()
+assert any(not torch.equal(param, param_before) for param, param_before in zip(params, before))
+
+# param groups are handled the same way
+optimizer = torch.optim.SGD([{'params': params}], lr=0.1)
+params = [{'params': params}]
+before = [param.detach().clone() for param in model.parameters()]
+train_step(nan_inputs)
+for param, param_before in zip(model.parameters(), before):
+    assert torch.equal(param, param_before), "nan loss changed the weights of a param group"
+
+print("nan loss steps leave the weights unchanged")
@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.webhook_dispatcher import WebhookDispatcher
+
+# runs the dispatcher against a local stand in for the webhook receiver
+
+received = []
+fail_next = {'count': 2}
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        payload = json.loads(body)
+        # fail the first epoch event a couple of times to exercise the retries
+        if payload['message'] == 'Epoch Completed' and fail_next['count'] > 0:
+            fail_next['count'] -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        received.append(payload)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = HTTPServer(('127.0.0.1', 0), WebhookHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+dispatcher = WebhookDispatcher(url, progress_interval=0.5, retry_backoff=0.05)
+dispatcher.send(True, 200, "Job Started", {"job_id": "test"})
+for step in range(1000):
+    dispatcher.send(True, 200, "Job Progress", {"job_id": "test", "job_progress": step / 10})
+dispatcher.send(True, 200, "Epoch Completed", {"job_id": "test"})
+dispatcher.send(True, 200, "Job Completed", {"job_id": "test"})
+dispatcher.close()
+server.shutdown()
+
+messages = [payload['message'] for payload in received]
+print(f"Received {len(messages)} webhooks: {messages}")
+print(f"Metrics: {dispatcher.get_metrics()}")
+
+assert messages[0] == "Job Started"
+assert messages[-2:] == ["Epoch Completed", "Job Completed"]
+assert received[-3]['data']['job_progress'] == 99.9, "latest progress must be sent before the terminal events"
+assert len(messages) < 10, "progress updates should be coalesced"
+print("OK")
@@ -0,0 +1,100 @@
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Any, Callable, Union
+
+import torch
+
+
+def snapshot_to_cpu(state: Any, dtype: Union[torch.dtype, None] = None) -> Any:
+    # copies every tensor in a (nested) state dict to host memory so it can be written while training
+    # keeps modifying the originals. Gpu tensors are copied into pinned buffers without blocking, then
+    # synchronized once at the end
+    has_cuda = False
+
+    def _copy(value):
+        nonlocal has_cuda
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            if dtype is not None and value.is_floating_point():
+                value = value.to(dtype)
+            if value.is_cuda:
+                has_cuda = True
+                buffer = torch.empty(value.shape, dtype=value.dtype, device='cpu', pin_memory=True)
+                buffer.copy_(value, non_blocking=True)
+                return buffer
+            return value.clone()
+        elif isinstance(value, OrderedDict):
+            return OrderedDict((k, _copy(v)) for k, v in value.items())
+        elif isinstance(value, dict):
+            return {k: _copy(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [_copy(v) for v in value]
+        elif isinstance(value, tuple):
+            return tuple(_copy(v) for v in value)
+        return value
+
+    snapshot = _copy(state)
+    if has_cuda:
+        torch.cuda.synchronize()
+    return snapshot
+
+
+class AsyncCheckpointWriter:
+    """
+    Runs checkpoint writes on a single background thread. The queue is bounded so training blocks
+    instead of piling up host memory when saves are requested faster than the disk can keep up.
+    The thread is not a daemon, so the interpreter does not exit while a checkpoint is half written.
+    Call close when done with it.
+    """
+
+    def __init__(self, max_queue_size: int = 1):
+        self.queue = queue.Queue(maxsize=max(1, max_queue_size))
+        self.errors = []
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                if not threading.main_thread().is_alive():
+                    # nobody closed us and the main thread is gone, everything queued is written
+                    return
+                continue
+            try:
+                if item is None:
+                    return
+                fn, args, kwargs = item
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Error in async checkpoint save: {e}")
+                traceback.print_exc()
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        if not self.thread.is_alive():
+            raise RuntimeError("Async checkpoint writer is not running")
+        self.queue.put((fn, args, kwargs))
+
+    def wait(self):
+        # block until everything queued so far is on disk
+        self.queue.join()
+        if len(self.errors) > 0:
+            errors = self.errors
+            self.errors = []
+            raise errors[0]
+
+    def close(self, raise_errors: bool = True):
+        # writes everything still queued, then stops the thread
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if raise_errors and len(self.errors) > 0:
+            errors = self.errors
+            self.errors = []
+            raise errors[0]
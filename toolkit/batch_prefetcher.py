@@ -0,0 +1,51 @@
+from typing import Iterator, Union
+
+import torch
+
+from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+
+
+class DevicePrefetcher:
+    """
+    Wraps a dataloader iterator and copies the next batch to the device on a side cuda stream while
+    the current step runs, so the trainer gets batches that are already on the device. Batches should
+    come out of the dataloader pinned for the copy to actually overlap.
+    """
+
+    def __init__(self, iterator: Iterator[DataLoaderBatchDTO], device: Union[str, torch.device]):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self.next_batch: Union[DataLoaderBatchDTO, None] = None
+        # the first batch is only pulled on the first next so epoch setup after iter() still applies
+        self.is_started = False
+
+    def _preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.stream is None:
+            self.next_batch = batch.to(self.device)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = batch.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> DataLoaderBatchDTO:
+        if not self.is_started:
+            self.is_started = True
+            self._preload()
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch.record_stream(current_stream)
+        # start copying the next one while this one is used
+        self._preload()
+        return batch
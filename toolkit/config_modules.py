@@ -5,6 +5,7 @@ import random
 
 import torch
 
+from toolkit.progress_events import emit_progress_event
 from toolkit.prompt_utils import PromptEmbeds
 
 ImgExt = Literal['jpg', 'png', 'webp']
@@ -26,6 +27,10 @@ class SaveConfig:
         self.push_to_hub: bool = kwargs.get("push_to_hub", False)
         self.hf_repo_id: Optional[str] = kwargs.get("hf_repo_id", None)
         self.hf_private: Optional[str] = kwargs.get("hf_private", False)
+        # write checkpoints on a background thread. Training only waits for the state to be copied to host memory
+        self.async_save: bool = kwargs.get('async_save', False)
+        # number of checkpoints that can wait to be written before training blocks
+        self.async_save_queue_size: int = kwargs.get('async_save_queue_size', 1)
 
 class LogingConfig:
     def __init__(self, **kwargs):
@@ -53,6 +58,8 @@ class SampleConfig:
         self.refiner_start_at = kwargs.get('refiner_start_at',
                                            0.5)  # step to start using refiner on sample if it exists
         self.extra_values = kwargs.get('extra_values', [])
+        # max samples to generate at once, lowered to fit in free vram
+        self.batch_size: int = kwargs.get('batch_size', 4)
 
 
 class LormModuleSettingsConfig:
@@ -236,6 +243,11 @@ class TrainConfig:
         self.min_denoising_steps: int = kwargs.get('min_denoising_steps', 0)
         self.max_denoising_steps: int = kwargs.get('max_denoising_steps', 1000)
         self.batch_size: int = kwargs.get('batch_size', 1)
+        # size bucketed batches to this many latent tokens (16x16 pixel patches) instead of batch_size.
+        # 4096 is 4 images at 512x512 or 1 at 1024x1024. Loss is scaled so every image counts the same
+        self.batch_token_budget: Union[int, None] = kwargs.get('batch_token_budget', None)
+        # copy the next batch to the gpu on a side stream while the current step runs
+        self.prefetch_to_device: bool = kwargs.get('prefetch_to_device', True)
         self.dtype: str = kwargs.get('dtype', 'fp32')
         self.xformers = kwargs.get('xformers', False)
         self.sdp = kwargs.get('sdp', False)
@@ -416,10 +428,18 @@ class ModelConfig:
 
         # only for flux for now
         self.quantize = kwargs.get("quantize", False)
+        # folder to cache quantized weights in so they are only quantized once. Disabled if None
+        self.quantized_cache_dir = kwargs.get("quantized_cache_dir", None)
         self.low_vram = kwargs.get("low_vram", False)
         self.attn_masking = kwargs.get("attn_masking", False)
         if self.attn_masking and not self.is_flux:
             raise ValueError("attn_masking is only supported with flux models currently")
+        # pad t5 to the longest prompt in the batch, rounded up to one of text_length_buckets, instead of
+        # always to 512 tokens. The padding is masked out in the transformer
+        self.dynamic_text_length = kwargs.get("dynamic_text_length", False)
+        self.text_length_buckets = sorted(kwargs.get("text_length_buckets", [64, 128, 256, 512]))
+        if self.dynamic_text_length and not self.is_flux:
+            raise ValueError("dynamic_text_length is only supported with flux models currently")
         pass
 
 
@@ -429,6 +449,10 @@ class EMAConfig:
         self.ema_decay: float = kwargs.get('ema_decay', 0.999)
         # feeds back the decay difference into the parameter
         self.use_feedback: bool = kwargs.get('use_feedback', False)
+        # only average in the weights every n steps, the decay is adjusted to match
+        self.update_every: int = kwargs.get('update_every', 1)
+        # keep the ema weights in cpu memory, they are updated in the background
+        self.offload_to_cpu: bool = kwargs.get('offload_to_cpu', False)
 
 
 class ReferenceDatasetConfig:
@@ -559,7 +583,16 @@ class DatasetConfig:
         self.cache_latents: bool = kwargs.get('cache_latents', False)
         # cache latents to disk will store them on disk. If both are true, it will save to disk, but keep in memory
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
+        # number of images run through the vae at once and threads decoding images ahead of it when caching latents
+        self.latent_cache_batch_size: int = kwargs.get('latent_cache_batch_size', 1)
+        self.latent_cache_num_workers: int = kwargs.get('latent_cache_num_workers', 4)
+        # files: one safetensors per image. consolidated: one memory mapped shard per folder with an index
+        self.latent_cache_format: str = kwargs.get('latent_cache_format', 'files')
+        if self.latent_cache_format not in ['files', 'consolidated']:
+            raise ValueError(f"Unknown latent_cache_format: {self.latent_cache_format}")
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
+        # encodes each unique caption once and stores it on disk so the text encoders can be unloaded
+        self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
 
@@ -575,6 +608,12 @@ class DatasetConfig:
             self.cache_latents = False
             self.cache_latents_to_disk = False
 
+        has_random_captions = self.shuffle_tokens or self.token_dropout_rate > 0 or len(self.random_triggers) > 0
+        if has_random_captions and self.cache_text_embeddings:
+            print(f"WARNING: shuffle_tokens, token_dropout_rate and random_triggers are not supported with caching "
+                  f"text embeddings. Setting cache_text_embeddings to False")
+            self.cache_text_embeddings = False
+
         # legacy compatability
         legacy_caption_type = kwargs.get('caption_type', None)
         if legacy_caption_type:
@@ -737,7 +776,9 @@ class GenerateImageConfig:
         os.makedirs(self.output_folder, exist_ok=True)
         self.set_gen_time()
         # TODO save image gen header info for A1111 and us, our seeds probably wont match
-        image.save(self.get_image_path(count, max_count))
+        image_path = self.get_image_path(count, max_count)
+        image.save(image_path)
+        emit_progress_event('sample_saved', path=image_path)
         # do prompt file
         if self.add_prompt_file:
             self.save_prompt_file(count, max_count)
@@ -12,14 +12,16 @@ import torch
 from PIL import Image
 from PIL.ImageOps import exif_transpose
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader, ConcatDataset
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Sampler
 from tqdm import tqdm
 import albumentations as A
 
 from toolkit.buckets import get_bucket_for_image_size, BucketResolution
 from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
-from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin
+from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, \
+    TextEmbeddingCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.dataset_manifest import DatasetManifest, scan_image_files
 
 import platform
 
@@ -366,7 +368,7 @@ class PairedImageDataset(Dataset):
         return img, prompt, (self.neg_weight, self.pos_weight)
 
 
-class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, CaptionMixin, Dataset):
+class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, TextEmbeddingCachingMixin, BucketsMixin, CaptionMixin, Dataset):
 
     def __init__(
             self,
@@ -385,6 +387,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         self.is_caching_latents_to_memory = dataset_config.cache_latents
         self.is_caching_latents_to_disk = dataset_config.cache_latents_to_disk
         self.is_caching_clip_vision_to_disk = dataset_config.cache_clip_vision_to_disk
+        self.is_caching_text_embeddings = dataset_config.cache_text_embeddings
         self.epoch_num = 0
 
         self.sd = sd
@@ -405,13 +408,15 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
 
         # check if dataset_path is a folder or json
         if os.path.isdir(self.dataset_path):
-            file_list = [os.path.join(root, file) for root, _, files in os.walk(self.dataset_path) for file in files if file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+            # keep the stat from the listing, the manifest uses it to find changed files
+            scanned_files = scan_image_files(self.dataset_path)
         else:
             # assume json
             with open(self.dataset_path, 'r') as f:
                 self.caption_dict = json.load(f)
                 # keys are file paths
-                file_list = list(self.caption_dict.keys())
+                scanned_files = [(file, None) for file in self.caption_dict.keys()]
+        file_list = [file for file, _ in scanned_files]
 
         if self.dataset_config.num_repeats > 1:
             # repeat the list
@@ -440,22 +445,31 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         dataset_folder = self.dataset_path
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
-        dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        if os.path.exists(dataset_size_file):
-            with open(dataset_size_file, 'r') as f:
-                self.size_database = json.load(f)
-        else:
-            self.size_database = {}
+        # only new or changed files are read, everything else comes from the manifest
+        manifest = DatasetManifest(dataset_folder)
+        manifest_entries = manifest.update(
+            scanned_files,
+            # captions come from the json for json datasets
+            caption_ext=self.dataset_config.caption_ext if self.caption_dict is None else None,
+            prune=self.caption_dict is None,
+        )
+        manifest.save()
 
         bad_count = 0
         for file in tqdm(file_list):
+            if file not in manifest_entries:
+                # could not be read, already reported by the manifest
+                bad_count += 1
+                continue
+            manifest_entry = manifest_entries[file]
             try:
                 file_item = FileItemDTO(
                     sd=self.sd,
                     path=file,
                     dataset_config=dataset_config,
                     dataloader_transforms=self.transform,
-                    size_database=self.size_database,
+                    image_size=(manifest_entry['width'], manifest_entry['height']),
+                    manifest_entry=manifest_entry,
                 )
                 self.file_list.append(file_item)
             except Exception as e:
@@ -464,10 +478,6 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 print(e)
                 bad_count += 1
 
-        # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
-
         print(f"  -  Found {len(self.file_list)} images")
         # print(f"  -  Found {bad_count} images that are too small")
         assert len(self.file_list) > 0, f"no images found in {self.dataset_path}"
@@ -478,7 +488,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the x axis
-                new_file_item = copy.deepcopy(file_item)
+                new_file_item = file_item.shallow_copy()
                 new_file_item.flip_x = True
                 self.file_list.append(new_file_item)
 
@@ -488,7 +498,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the y axis
-                new_file_item = copy.deepcopy(file_item)
+                new_file_item = file_item.shallow_copy()
                 new_file_item.flip_y = True
                 self.file_list.append(new_file_item)
 
@@ -522,7 +532,8 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         return len(self.file_list)
 
     def _get_single_item(self, index) -> 'FileItemDTO':
-        file_item = copy.deepcopy(self.file_list[index])
+        # the loaded image, caption and tensors only live on this per fetch copy
+        file_item = self.file_list[index].shallow_copy()
         file_item.load_and_process_image(self.transform)
         file_item.load_caption(self.caption_dict)
         return file_item
@@ -542,10 +553,78 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             return self._get_single_item(item)
 
 
+# images are counted in 16x16 pixel patches for the token budget, the size of a packed flux latent token
+TOKEN_BUDGET_PATCH_SIZE = 16
+
+
+class BucketItemDataset(Dataset):
+    # single items from bucketed datasets, indexed by (dataset index, file index) from BucketTokenBatchSampler
+    def __init__(self, datasets: List['AiToolkitDataset']):
+        self.datasets = datasets
+
+    def __len__(self):
+        return sum([len(dataset.file_list) for dataset in self.datasets])
+
+    def __getitem__(self, item):
+        dataset_idx, file_idx = item
+        return self.datasets[dataset_idx]._get_single_item(file_idx)
+
+
+class BucketTokenBatchSampler(Sampler):
+    """
+    Batches images from the same resolution bucket across all datasets, sizing each batch so it holds
+    about token_budget latent tokens. Small resolutions get bigger batches, so the gpu has about the
+    same amount of work every step no matter which bucket it comes from.
+    """
+
+    def __init__(self, datasets: List['AiToolkitDataset'], token_budget: int):
+        super().__init__(None)
+        self.datasets = datasets
+        self.token_budget = token_budget
+
+    def get_batch_size(self, width: int, height: int) -> int:
+        num_tokens = (width // TOKEN_BUDGET_PATCH_SIZE) * (height // TOKEN_BUDGET_PATCH_SIZE)
+        return max(1, self.token_budget // max(1, num_tokens))
+
+    def get_merged_buckets(self):
+        # same resolution buckets from every dataset, as (dataset index, file index) pairs
+        merged_buckets = {}
+        for dataset_idx, dataset in enumerate(self.datasets):
+            for key, bucket in dataset.buckets.items():
+                if key not in merged_buckets:
+                    merged_buckets[key] = (bucket.width, bucket.height, [])
+                merged_buckets[key][2].extend([(dataset_idx, file_idx) for file_idx in bucket.file_list_idx])
+        return merged_buckets
+
+    def build_batches(self):
+        batches = []
+        for width, height, items in self.get_merged_buckets().values():
+            random.shuffle(items)
+            batch_size = self.get_batch_size(width, height)
+            for start_idx in range(0, len(items), batch_size):
+                batches.append(items[start_idx:start_idx + batch_size])
+        random.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        num_batches = 0
+        for width, height, items in self.get_merged_buckets().values():
+            batch_size = self.get_batch_size(width, height)
+            num_batches += (len(items) + batch_size - 1) // batch_size
+        return num_batches
+
+    def __iter__(self):
+        # buckets can be rebuilt between epochs, so batches are built fresh every time
+        for batch in self.build_batches():
+            yield batch
+
+
 def get_dataloader_from_datasets(
         dataset_options,
         batch_size=1,
         sd: 'StableDiffusion' = None,
+        token_budget: int = None,
+        pin_memory: bool = False,
 ) -> DataLoader:
     if dataset_options is None or len(dataset_options) == 0:
         return None
@@ -585,7 +664,8 @@ def get_dataloader_from_datasets(
     def dto_collation(batch: List['FileItemDTO']):
         # create DTO batch
         batch = DataLoaderBatchDTO(
-            file_items=batch
+            file_items=batch,
+            pin_memory=pin_memory
         )
         return batch
 
@@ -599,20 +679,36 @@ def get_dataloader_from_datasets(
         dataloader_kwargs['num_workers'] = dataset_config_list[0].num_workers
         dataloader_kwargs['prefetch_factor'] = dataset_config_list[0].prefetch_factor
 
+    if pin_memory and torch.cuda.is_available():
+        # pinned batches can be copied to the gpu asynchronously, see DevicePrefetcher. Pinned host memory
+        # is locked for every batch in flight, so only pin when something uses it
+        dataloader_kwargs['pin_memory'] = True
+
     if has_buckets:
         # make sure they all have buckets
         for dataset in datasets:
             assert dataset.dataset_config.buckets, f"buckets not found on dataset {dataset.dataset_config.folder_path}, you either need all buckets or none"
 
-        data_loader = DataLoader(
-            concatenated_dataset,
-            batch_size=None,  # we batch in the datasets for now
-            drop_last=False,
-            shuffle=True,
-            collate_fn=dto_collation,  # Use the custom collate function
-            **dataloader_kwargs
-        )
+        if token_budget is not None:
+            # batch across datasets by the token budget instead of batching in the datasets
+            data_loader = DataLoader(
+                BucketItemDataset(datasets),
+                batch_sampler=BucketTokenBatchSampler(datasets, token_budget),
+                collate_fn=dto_collation,
+                **dataloader_kwargs
+            )
+        else:
+            data_loader = DataLoader(
+                concatenated_dataset,
+                batch_size=None,  # we batch in the datasets for now
+                drop_last=False,
+                shuffle=True,
+                collate_fn=dto_collation,  # Use the custom collate function
+                **dataloader_kwargs
+            )
     else:
+        if token_budget is not None:
+            print("batch_token_budget only works with bucketed datasets, using the batch size")
         data_loader = DataLoader(
             concatenated_dataset,
             batch_size=batch_size,
@@ -1,9 +1,11 @@
+import copy
 import os
 import weakref
 from _weakref import ReferenceType
 from typing import TYPE_CHECKING, List, Union
 import torch
 import random
+from torch.utils.data import get_worker_info
 
 from PIL import Image
 from PIL.ImageOps import exif_transpose
@@ -44,8 +46,12 @@ class FileItemDTO(
         self.path = kwargs.get('path', '')
         self.dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
         size_database = kwargs.get('size_database', {})
+        image_size = kwargs.get('image_size', None)
         filename = os.path.basename(self.path)
-        if filename in size_database:
+        if image_size is not None:
+            # already read by the dataset manifest
+            w, h = image_size
+        elif filename in size_database:
             w, h = size_database[filename]
         else:
             # process width and height
@@ -81,6 +87,11 @@ class FileItemDTO(
         self.is_reg = self.dataset_config.is_reg
         self.tensor: Union[torch.Tensor, None] = None
 
+    def shallow_copy(self) -> 'FileItemDTO':
+        # loading and cleanup only ever rebind attributes on the item, they never modify them in place,
+        # so a copy can share the config, transforms and in memory latents instead of deep copying them
+        return copy.copy(self)
+
     def cleanup(self):
         self.tensor = None
         self.cleanup_latent()
@@ -90,10 +101,35 @@ class FileItemDTO(
         self.cleanup_unconditional()
 
 
+def stack_tensors(tensors: List[torch.Tensor], pin_memory: bool = False) -> torch.Tensor:
+    # when collating in the main process for the device prefetcher, stack straight into page locked memory
+    # so the copy to the gpu can be async without another copy. Workers cannot pin, the dataloader pin
+    # thread does it for them
+    base = tensors[0]
+    if pin_memory and base.device.type == 'cpu' and torch.cuda.is_available() and get_worker_info() is None:
+        out = torch.empty((len(tensors), *base.shape), dtype=base.dtype, pin_memory=True)
+        return torch.stack(tensors, out=out)
+    return torch.stack(tensors)
+
+
 class DataLoaderBatchDTO:
+    # tensors moved to the device by to(), everything else stays on the cpu
+    device_tensor_names = [
+        'tensor',
+        'latents',
+        'control_tensor',
+        'clip_image_tensor',
+        'mask_tensor',
+        'unaugmented_tensor',
+        'unconditional_tensor',
+        'unconditional_latents',
+    ]
+
     def __init__(self, **kwargs):
         try:
             self.file_items: List['FileItemDTO'] = kwargs.get('file_items', None)
+            # only worth it when the batch is copied to the gpu asynchronously
+            pin_memory = kwargs.get('pin_memory', False)
             is_latents_cached = self.file_items[0].is_latent_cached
             self.tensor: Union[torch.Tensor, None] = None
             self.latents: Union[torch.Tensor, None] = None
@@ -109,11 +145,11 @@ class DataLoaderBatchDTO:
             self.extra_values: Union[torch.Tensor, None] = torch.tensor([x.extra_values for x in self.file_items]) if len(self.file_items[0].extra_values) > 0 else None
             if not is_latents_cached:
                 # only return a tensor if latents are not cached
-                self.tensor: torch.Tensor = torch.cat([x.tensor.unsqueeze(0) for x in self.file_items])
+                self.tensor: torch.Tensor = stack_tensors([x.tensor for x in self.file_items], pin_memory=pin_memory)
             # if we have encoded latents, we concatenate them
             self.latents: Union[torch.Tensor, None] = None
             if is_latents_cached:
-                self.latents = torch.cat([x.get_latent().unsqueeze(0) for x in self.file_items])
+                self.latents = stack_tensors([x.get_latent() for x in self.file_items], pin_memory=pin_memory)
             self.control_tensor: Union[torch.Tensor, None] = None
             # if self.file_items[0].control_tensor is not None:
             # if any have a control tensor, we concatenate them
@@ -130,7 +166,7 @@ class DataLoaderBatchDTO:
                         control_tensors.append(torch.zeros_like(base_control_tensor))
                     else:
                         control_tensors.append(x.control_tensor)
-                self.control_tensor = torch.cat([x.unsqueeze(0) for x in control_tensors])
+                self.control_tensor = stack_tensors(control_tensors, pin_memory=pin_memory)
 
             self.loss_multiplier_list: List[float] = [x.loss_multiplier for x in self.file_items]
 
@@ -147,7 +183,7 @@ class DataLoaderBatchDTO:
                         clip_image_tensors.append(torch.zeros_like(base_clip_image_tensor))
                     else:
                         clip_image_tensors.append(x.clip_image_tensor)
-                self.clip_image_tensor = torch.cat([x.unsqueeze(0) for x in clip_image_tensors])
+                self.clip_image_tensor = stack_tensors(clip_image_tensors, pin_memory=pin_memory)
 
             if any([x.mask_tensor is not None for x in self.file_items]):
                 # find one to use as a base
@@ -162,7 +198,7 @@ class DataLoaderBatchDTO:
                         mask_tensors.append(torch.zeros_like(base_mask_tensor))
                     else:
                         mask_tensors.append(x.mask_tensor)
-                self.mask_tensor = torch.cat([x.unsqueeze(0) for x in mask_tensors])
+                self.mask_tensor = stack_tensors(mask_tensors, pin_memory=pin_memory)
 
             # add unaugmented tensors for ones with augments
             if any([x.unaugmented_tensor is not None for x in self.file_items]):
@@ -178,7 +214,7 @@ class DataLoaderBatchDTO:
                         unaugmented_tensor.append(torch.zeros_like(base_unaugmented_tensor))
                     else:
                         unaugmented_tensor.append(x.unaugmented_tensor)
-                self.unaugmented_tensor = torch.cat([x.unsqueeze(0) for x in unaugmented_tensor])
+                self.unaugmented_tensor = stack_tensors(unaugmented_tensor, pin_memory=pin_memory)
 
             # add unconditional tensors
             if any([x.unconditional_tensor is not None for x in self.file_items]):
@@ -194,7 +230,7 @@ class DataLoaderBatchDTO:
                         unconditional_tensor.append(torch.zeros_like(base_unconditional_tensor))
                     else:
                         unconditional_tensor.append(x.unconditional_tensor)
-                self.unconditional_tensor = torch.cat([x.unsqueeze(0) for x in unconditional_tensor])
+                self.unconditional_tensor = stack_tensors(unconditional_tensor, pin_memory=pin_memory)
 
             if any([x.clip_image_embeds is not None for x in self.file_items]):
                 self.clip_image_embeds = []
@@ -216,6 +252,29 @@ class DataLoaderBatchDTO:
             print(e)
             raise e
 
+    def pin_memory(self):
+        # called by the dataloader pin thread when pin_memory is set
+        for name in self.device_tensor_names:
+            value = getattr(self, name)
+            if value is not None and value.device.type == 'cpu' and not value.is_pinned():
+                setattr(self, name, value.pin_memory())
+        return self
+
+    def to(self, device: Union[str, torch.device], non_blocking: bool = False):
+        for name in self.device_tensor_names:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.to(device, non_blocking=non_blocking))
+        return self
+
+    def record_stream(self, stream: 'torch.cuda.Stream'):
+        # the tensors were allocated on a side stream, mark them as used on stream so their memory
+        # is not reused while it still needs them
+        for name in self.device_tensor_names:
+            value = getattr(self, name)
+            if value is not None and value.is_cuda:
+                value.record_stream(stream)
+
     def get_is_reg_list(self):
         return [x.is_reg for x in self.file_items]
 
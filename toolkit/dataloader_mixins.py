@@ -4,7 +4,8 @@ import json
 import math
 import os
 import random
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING, List, Dict, Union
 
 import cv2
@@ -16,6 +17,7 @@ from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
 
 from toolkit.basic import flush, value_map
 from toolkit.buckets import get_bucket_for_image_size, get_resolution
+from toolkit.latent_cache import ConsolidatedLatentCache, get_consolidated_latent_cache
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.prompt_utils import inject_trigger_into_prompt
 from torchvision import transforms
@@ -283,6 +285,8 @@ class CaptionProcessingDTOMixin:
 
             dataset_config: DatasetConfig = kwargs.get('dataset_config', None)
             self.extra_values: List[float] = dataset_config.extra_values
+            # shared dataset manifest entry, has the caption file contents when available
+            self.manifest_entry: Union[dict, None] = kwargs.get('manifest_entry', None)
 
     # todo allow for loading from sd-scripts style dict
     def load_caption(self: 'FileItemDTO', caption_dict: Union[dict, None]):
@@ -300,28 +304,35 @@ class CaptionProcessingDTOMixin:
             prompt_path = f"{path_no_ext}.{prompt_ext}"
             short_caption = None
 
-            if os.path.exists(prompt_path):
+            caption_file_text = None
+            if self.manifest_entry is not None and 'caption' in self.manifest_entry:
+                # read from the caption file when the dataset was loaded, None if there is no caption file
+                caption_file_text = self.manifest_entry['caption']
+            elif os.path.exists(prompt_path):
                 with open(prompt_path, 'r', encoding='utf-8') as f:
-                    prompt = f.read()
-                    short_caption = None
-                    if prompt_path.endswith('.json'):
-                        # replace any line endings with commas for \n \r \r\n
-                        prompt = prompt.replace('\r\n', ' ')
-                        prompt = prompt.replace('\n', ' ')
-                        prompt = prompt.replace('\r', ' ')
-
-                        prompt_json = json.loads(prompt)
-                        if 'caption' in prompt_json:
-                            prompt = prompt_json['caption']
-                        if 'caption_short' in prompt_json:
-                            short_caption = prompt_json['caption_short']
-
-                        if 'extra_values' in prompt_json:
-                            self.extra_values = prompt_json['extra_values']
-
-                    prompt = clean_caption(prompt)
-                    if short_caption is not None:
-                        short_caption = clean_caption(short_caption)
+                    caption_file_text = f.read()
+
+            if caption_file_text is not None:
+                prompt = caption_file_text
+                short_caption = None
+                if prompt_path.endswith('.json'):
+                    # replace any line endings with commas for \n \r \r\n
+                    prompt = prompt.replace('\r\n', ' ')
+                    prompt = prompt.replace('\n', ' ')
+                    prompt = prompt.replace('\r', ' ')
+
+                    prompt_json = json.loads(prompt)
+                    if 'caption' in prompt_json:
+                        prompt = prompt_json['caption']
+                    if 'caption_short' in prompt_json:
+                        short_caption = prompt_json['caption_short']
+
+                    if 'extra_values' in prompt_json:
+                        self.extra_values = prompt_json['extra_values']
+
+                prompt = clean_caption(prompt)
+                if short_caption is not None:
+                    short_caption = clean_caption(short_caption)
             else:
                 prompt = ''
                 if self.dataset_config.default_caption is not None:
@@ -341,7 +352,8 @@ class CaptionProcessingDTOMixin:
             trigger=None,
             to_replace_list=None,
             add_if_not_present=False,
-            short_caption=False
+            short_caption=False,
+            use_dropout=True
     ):
         if short_caption:
             raw_caption = self.raw_caption_short
@@ -350,7 +362,7 @@ class CaptionProcessingDTOMixin:
         if raw_caption is None:
             raw_caption = ''
         # handle dropout
-        if self.dataset_config.caption_dropout_rate > 0 and not short_caption:
+        if self.dataset_config.caption_dropout_rate > 0 and not short_caption and use_dropout:
             # get a random float form 0 to 1
             rand = random.random()
             if rand < self.dataset_config.caption_dropout_rate:
@@ -365,7 +377,7 @@ class CaptionProcessingDTOMixin:
         token_list = [x for x in token_list if x]
 
         # handle token dropout
-        if self.dataset_config.token_dropout_rate > 0 and not short_caption:
+        if self.dataset_config.token_dropout_rate > 0 and not short_caption and use_dropout:
             new_token_list = []
             keep_tokens: int = self.dataset_config.keep_tokens
             for idx, token in enumerate(token_list):
@@ -1289,23 +1301,36 @@ class LatentCachingFileItemDTOMixin:
             item["flip_y"] = True
         return item
 
+    def get_latent_hash(self: 'FileItemDTO'):
+        hash_dict = self.get_latent_info_dict()
+        # get base64 hash of md5 checksum of hash_dict
+        hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        return hash_str.replace('=', '')
+
+    def get_latent_dir(self: 'FileItemDTO'):
+        # we store latents in a folder in same path as image called _latent_cache
+        img_dir = os.path.dirname(self.path)
+        return os.path.join(img_dir, '_latent_cache')
+
     def get_latent_path(self: 'FileItemDTO', recalculate=False):
         if self._latent_path is not None and not recalculate:
             return self._latent_path
         else:
-            # we store latents in a folder in same path as image called _latent_cache
-            img_dir = os.path.dirname(self.path)
-            latent_dir = os.path.join(img_dir, '_latent_cache')
-            hash_dict = self.get_latent_info_dict()
+            latent_dir = self.get_latent_dir()
             filename_no_ext = os.path.splitext(os.path.basename(self.path))[0]
-            # get base64 hash of md5 checksum of hash_dict
-            hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
-            hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
-            hash_str = hash_str.replace('=', '')
+            hash_str = self.get_latent_hash()
             self._latent_path = os.path.join(latent_dir, f'{filename_no_ext}_{hash_str}.safetensors')
 
         return self._latent_path
 
+    @property
+    def is_latent_cache_consolidated(self: 'FileItemDTO'):
+        return self.is_caching_to_disk and self.dataset_config.latent_cache_format == 'consolidated'
+
+    def get_consolidated_latent_cache(self: 'FileItemDTO') -> ConsolidatedLatentCache:
+        return get_consolidated_latent_cache(self.get_latent_dir(), self.latent_version)
+
     def cleanup_latent(self):
         if self._encoded_latent is not None:
             if not self.is_caching_to_memory:
@@ -1318,7 +1343,10 @@ class LatentCachingFileItemDTOMixin:
     def get_latent(self, device=None):
         if not self.is_latent_cached:
             return None
-        if self._encoded_latent is None:
+        if self._encoded_latent is None and self.is_latent_cache_consolidated:
+            # zero copy slice of the memory mapped shard
+            self._encoded_latent = self.get_consolidated_latent_cache().get(self.get_latent_hash())
+        elif self._encoded_latent is None:
             # load it from disk
             state_dict = load_file(
                 self.get_latent_path(),
@@ -1336,11 +1364,91 @@ class LatentCachingMixin:
             super().__init__(**kwargs)
         self.latent_cache = {}
 
+    def get_latent_space_version(self: 'AiToolkitDataset'):
+        if self.sd.model_config.latent_space_version is not None:
+            return self.sd.model_config.latent_space_version
+        elif self.sd.is_xl:
+            return 'sdxl'
+        elif self.sd.is_v3:
+            return 'sd3'
+        elif self.sd.is_auraflow:
+            return 'sdxl'
+        elif self.sd.is_flux:
+            return 'flux1'
+        elif self.sd.model_config.is_pixart_sigma:
+            return 'sdxl'
+        else:
+            return 'sd1'
+
+    def _load_image_for_latent(self: 'AiToolkitDataset', file_item: 'FileItemDTO'):
+        # runs in the worker pool
+        file_item.load_and_process_image(self.transform, only_load_latents=True)
+        return file_item
+
+    def _iter_loaded_for_latents(
+            self: 'AiToolkitDataset',
+            file_items: List['FileItemDTO'],
+            pool: ThreadPoolExecutor,
+            max_in_flight: int
+    ):
+        # keep a bounded number of images decoding ahead of the vae so memory does not grow with the dataset
+        in_flight = deque()
+        items = iter(file_items)
+        for file_item in items:
+            in_flight.append(pool.submit(self._load_image_for_latent, file_item))
+            if len(in_flight) >= max_in_flight:
+                break
+        while len(in_flight) > 0:
+            file_item = in_flight.popleft().result()
+            next_item = next(items, None)
+            if next_item is not None:
+                in_flight.append(pool.submit(self._load_image_for_latent, next_item))
+            yield file_item
+
+    def _encode_latent_batch(self: 'AiToolkitDataset', batch: List['FileItemDTO'], save_pool: ThreadPoolExecutor):
+        to_disk = self.is_caching_latents_to_disk
+        to_memory = self.is_caching_latents_to_memory
+        dtype = self.sd.torch_dtype
+        device = self.sd.device_torch
+        try:
+            imgs = torch.stack([file_item.tensor for file_item in batch]).to(device, dtype=dtype)
+            latents = self.sd.encode_images(imgs)
+        except Exception as e:
+            print(f"Error processing images: {[file_item.path for file_item in batch]}")
+            print(f"Error: {str(e)}")
+            raise e
+        latents = latents.detach().cpu()
+        save_futures = []
+        for file_item, latent in zip(batch, latents):
+            # clone so each file gets its own storage instead of a view of the batch
+            latent = latent.clone()
+            if to_disk and file_item.is_latent_cache_consolidated:
+                cache = file_item.get_consolidated_latent_cache()
+                save_futures.append(save_pool.submit(cache.append, file_item.get_latent_hash(), latent))
+            elif to_disk:
+                latent_path = file_item.get_latent_path()
+                state_dict = OrderedDict([
+                    ('latent', latent),
+                ])
+                # metadata
+                meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+                os.makedirs(os.path.dirname(latent_path), exist_ok=True)
+                save_futures.append(save_pool.submit(save_file, state_dict, latent_path, metadata=meta))
+            if to_memory:
+                # keep it in memory
+                file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+            del file_item.tensor
+            file_item.is_latent_cached = True
+        del imgs
+        del latents
+        return save_futures
+
     def cache_latents_all_latents(self: 'AiToolkitDataset'):
         print(f"Caching latents for {self.dataset_path}")
         # cache all latents to disk
         to_disk = self.is_caching_latents_to_disk
         to_memory = self.is_caching_latents_to_memory
+        batch_size = max(1, self.dataset_config.latent_cache_batch_size)
 
         if to_disk:
             print(" - Saving latents to disk")
@@ -1349,76 +1457,96 @@ class LatentCachingMixin:
         # move sd items to cpu except for vae
         self.sd.set_device_state_preset('cache_latents')
 
-        # use tqdm to show progress
-        i = 0
-        for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
-            # set latent space version
-            if self.sd.model_config.latent_space_version is not None:
-                file_item.latent_space_version = self.sd.model_config.latent_space_version
-            elif self.sd.is_xl:
-                file_item.latent_space_version = 'sdxl'
-            elif self.sd.is_v3:
-                file_item.latent_space_version = 'sd3'
-            elif self.sd.is_auraflow:
-                file_item.latent_space_version = 'sdxl'
-            elif self.sd.is_flux:
-                file_item.latent_space_version = 'flux1'
-            elif self.sd.model_config.is_pixart_sigma:
-                file_item.latent_space_version = 'sdxl'
-            else:
-                file_item.latent_space_version = 'sd1'
+        latent_space_version = self.get_latent_space_version()
+        to_encode: List['FileItemDTO'] = []
+        consolidated_caches: Dict[str, ConsolidatedLatentCache] = {}
+        for file_item in self.file_list:
+            file_item.latent_space_version = latent_space_version
             file_item.is_caching_to_disk = to_disk
             file_item.is_caching_to_memory = to_memory
             file_item.latent_load_device = self.sd.device
 
             latent_path = file_item.get_latent_path(recalculate=True)
             # check if it is saved to disk already
-            if os.path.exists(latent_path):
+            if file_item.is_latent_cache_consolidated:
+                cache = file_item.get_consolidated_latent_cache()
+                consolidated_caches[cache.cache_dir] = cache
+                if file_item.get_latent_hash() in cache:
+                    if to_memory:
+                        file_item._encoded_latent = cache.get(file_item.get_latent_hash()).to(
+                            'cpu', dtype=self.sd.torch_dtype, copy=True
+                        )
+                    file_item.is_latent_cached = True
+                else:
+                    to_encode.append(file_item)
+            elif os.path.exists(latent_path):
                 if to_memory:
                     # load it into memory
                     state_dict = load_file(latent_path, device='cpu')
                     file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                file_item.is_latent_cached = True
             else:
-                # not saved to disk, calculate
-                # load the image first
-                file_item.load_and_process_image(self.transform, only_load_latents=True)
-                dtype = self.sd.torch_dtype
-                device = self.sd.device_torch
-                # add batch dimension
-                try:
-                    imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                    latent = self.sd.encode_images(imgs).squeeze(0)
-                except Exception as e:
-                    print(f"Error processing image: {file_item.path}")
-                    print(f"Error: {str(e)}")
-                    raise e
-                # save_latent
-                if to_disk:
-                    state_dict = OrderedDict([
-                        ('latent', latent.clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                    os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                    save_file(state_dict, latent_path, metadata=meta)
+                to_encode.append(file_item)
+
+        if len(to_encode) > 0:
+            # group by bucket resolution so every batch can be stacked
+            to_encode.sort(key=lambda x: (x.crop_width, x.crop_height))
+            num_workers = max(1, self.dataset_config.latent_cache_num_workers)
+            save_futures = []
+            with ThreadPoolExecutor(max_workers=num_workers) as load_pool, \
+                    ThreadPoolExecutor(max_workers=1) as save_pool:
+                progress_bar = tqdm(
+                    total=len(self.file_list),
+                    initial=len(self.file_list) - len(to_encode),
+                    desc=f'Caching latents{" to disk" if to_disk else ""}'
+                )
+                batch: List['FileItemDTO'] = []
+                max_in_flight = max(batch_size, num_workers) * 2
+                for file_item in self._iter_loaded_for_latents(to_encode, load_pool, max_in_flight):
+                    # non bucketed datasets can still end up with mismatched sizes, encode what we have
+                    if len(batch) > 0 and batch[0].tensor.shape != file_item.tensor.shape:
+                        save_futures += self._encode_latent_batch(batch, save_pool)
+                        progress_bar.update(len(batch))
+                        batch = []
+                    batch.append(file_item)
+                    if len(batch) >= batch_size:
+                        save_futures += self._encode_latent_batch(batch, save_pool)
+                        progress_bar.update(len(batch))
+                        batch = []
+                if len(batch) > 0:
+                    save_futures += self._encode_latent_batch(batch, save_pool)
+                    progress_bar.update(len(batch))
+                progress_bar.close()
+                # surface any write errors
+                for future in save_futures:
+                    future.result()
+            for cache in consolidated_caches.values():
+                cache.save_index()
 
-                if to_memory:
-                    # keep it in memory
-                    file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+        # restore device state
+        self.sd.restore_device_state()
 
-                del imgs
-                del latent
-                del file_item.tensor
 
-                # flush(garbage_collect=False)
-            file_item.is_latent_cached = True
-            i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
+class TextEmbeddingCachingMixin:
+    def __init__(self: 'AiToolkitDataset', **kwargs):
+        # if we have super, call it
+        if hasattr(super(), '__init__'):
+            super().__init__(**kwargs)
 
-        # restore device state
-        self.sd.restore_device_state()
+    def get_text_embedding_cache_dir(self: 'AiToolkitDataset'):
+        # stored in the dataset folder, next to _latent_cache
+        dataset_folder = self.dataset_path
+        if not os.path.isdir(dataset_folder):
+            dataset_folder = os.path.dirname(dataset_folder)
+        return os.path.join(dataset_folder, '_text_embedding_cache')
+
+    def get_unique_captions(self: 'AiToolkitDataset') -> List[str]:
+        # captions without dropout. Dropped captions are the empty prompt, which is always cached
+        captions = []
+        for file_item in self.file_list:
+            file_item.load_caption(self.caption_dict)
+            captions.append(file_item.get_caption(use_dropout=False))
+        return list(dict.fromkeys(captions))
 
 
 class CLIPCachingMixin:
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+from PIL import Image
+from PIL.ImageOps import exif_transpose
+
+from toolkit import image_utils
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+MANIFEST_FILENAME = '.aitk_manifest.json'
+# increment this if the manifest format changes to rebuild it
+MANIFEST_VERSION = 1
+
+printed_messages = []
+
+
+def print_once(msg):
+    global printed_messages
+    if msg not in printed_messages:
+        print(msg)
+        printed_messages.append(msg)
+
+
+def scan_image_files(folder: str) -> List[Tuple[str, os.stat_result]]:
+    # like os.walk, but keeps the stat from the directory listing so files are not stat'ed twice
+    files = []
+    folders = [folder]
+    while len(folders) > 0:
+        current = folders.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    files.append((entry.path, entry.stat()))
+    files.sort(key=lambda x: x[0])
+    return files
+
+
+def probe_image_size(path: str) -> Tuple[int, int]:
+    try:
+        return image_utils.get_image_size(path)
+    except image_utils.UnknownImageFormat:
+        print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
+                   f'This process is faster for png, jpeg')
+        img = exif_transpose(Image.open(path))
+        w, h = img.size
+        return w, h
+
+
+class DatasetManifest:
+    """
+    Per dataset record of every image's size on disk, mtime, dimensions and caption file contents.
+    It is loaded in one read and only files that changed since the last run are probed again, with
+    the image headers read in a thread pool. Entries are keyed by the path relative to the dataset
+    folder so images with the same name in different subfolders do not collide.
+    """
+
+    def __init__(self, folder: str, num_workers: int = 16):
+        self.folder = folder
+        self.num_workers = num_workers
+        self.manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+        self.entries: Dict[str, dict] = {}
+        self.is_dirty = False
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    manifest = json.load(f)
+                if manifest.get('version', None) == MANIFEST_VERSION:
+                    self.entries = manifest['files']
+            except Exception as e:
+                print(f"Could not read dataset manifest {self.manifest_path}, rebuilding it: {e}")
+
+    def get_key(self, path: str) -> str:
+        return os.path.relpath(path, self.folder)
+
+    def _read_caption(self, caption_path: str, entry: dict):
+        try:
+            caption_stat = os.stat(caption_path)
+        except FileNotFoundError:
+            caption_stat = None
+        if caption_stat is None:
+            if entry.get('caption_path', None) is not None or 'caption' not in entry:
+                entry['caption_path'] = None
+                entry['caption_mtime'] = None
+                entry['caption'] = None
+                entry['caption_hash'] = None
+                self.is_dirty = True
+            return
+        if entry.get('caption_path', None) == caption_path and entry.get('caption_mtime', None) == caption_stat.st_mtime:
+            return
+        with open(caption_path, 'r', encoding='utf-8') as f:
+            caption = f.read()
+        entry['caption_path'] = caption_path
+        entry['caption_mtime'] = caption_stat.st_mtime
+        entry['caption'] = caption
+        entry['caption_hash'] = hashlib.md5(caption.encode('utf-8')).hexdigest()
+        self.is_dirty = True
+
+    def _update_entry(self, path: str, stat: Union[os.stat_result, None], caption_ext: Union[str, None]) -> dict:
+        key = self.get_key(path)
+        if stat is None:
+            stat = os.stat(path)
+        entry = self.entries.get(key, None)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            width, height = probe_image_size(path)
+            entry = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'width': width,
+                'height': height,
+            }
+            self.entries[key] = entry
+            self.is_dirty = True
+        if caption_ext is not None:
+            caption_path = f"{os.path.splitext(path)[0]}.{caption_ext}"
+            self._read_caption(caption_path, entry)
+        return entry
+
+    def update(
+            self,
+            files: List[Tuple[str, Union[os.stat_result, None]]],
+            caption_ext: Union[str, None] = None,
+            prune: bool = True,
+    ) -> Dict[str, dict]:
+        # returns the entry for every file path. Files that failed to read are left out.
+        # prune drops entries for files not in files, only do it when files is the whole folder
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = [
+                (path, executor.submit(self._update_entry, path, stat, caption_ext)) for path, stat in files
+            ]
+            for path, future in futures:
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    print(f"Error reading image: {path}")
+                    print(e)
+
+        if prune:
+            # drop files that no longer exist
+            keys = set([self.get_key(path) for path, _ in files])
+            removed = [key for key in self.entries.keys() if key not in keys]
+            for key in removed:
+                del self.entries[key]
+            if len(removed) > 0:
+                self.is_dirty = True
+        return results
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.entries}, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.is_dirty = False
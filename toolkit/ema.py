@@ -1,6 +1,8 @@
 from __future__ import division
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Iterable, Optional
 import weakref
 import copy
@@ -37,6 +39,20 @@ class ExponentialMovingAverage:
 
         use_num_updates: Whether to use number of updates when computing
             averages.
+
+        update_every: Only fold the parameters into the average every this
+            many calls to `update`. The decay is raised to this power so the
+            average covers the same number of steps.
+
+        offload_to_cpu: Keep the shadow parameters in pinned cpu memory. The
+            parameters are copied off the device asynchronously and averaged
+            on a background thread, so the device only holds the trained
+            weights.
+
+    Shadow parameters are grouped into flat buffers per device and dtype and
+    updated with multi tensor (foreach) ops, a handful of kernels no matter
+    how many parameters there are. `eval` and `train` swap the averaged
+    weights in and out of the parameters instead of copying them.
     """
 
     def __init__(
@@ -45,18 +61,27 @@ class ExponentialMovingAverage:
             decay: float = 0.995,
             use_num_updates: bool = True,
             # feeds back the decat to the parameter
-            use_feedback: bool = False
+            use_feedback: bool = False,
+            update_every: int = 1,
+            offload_to_cpu: bool = False,
     ):
         if parameters is None:
             raise ValueError("parameters must be provided")
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
+        if update_every < 1:
+            raise ValueError('update_every must be at least 1')
+        if use_feedback and offload_to_cpu:
+            raise ValueError('use_feedback needs the shadow parameters on the device, it cannot be offloaded')
         self.decay = decay
         self.num_updates = 0 if use_num_updates else None
         self.use_feedback = use_feedback
+        self.update_every = update_every
+        self.offload_to_cpu = offload_to_cpu
+        self.step_count = 0
         parameters = list(parameters)
         self.shadow_params = [
-            p.clone().detach()
+            p.clone().detach().to('cpu') if offload_to_cpu else p.clone().detach()
             for p in parameters
         ]
         self.collected_params = None
@@ -68,6 +93,66 @@ class ExponentialMovingAverage:
         # maintained, and the model will be cleaned up.
         self._params_refs = [weakref.ref(p) for p in parameters]
 
+        # cpu offloading, params are staged in pinned memory and averaged on a worker thread
+        self._copy_stream = None
+        self._executor = None
+        self._pending: Optional[Future] = None
+        if offload_to_cpu:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            if torch.cuda.is_available():
+                self._copy_stream = torch.cuda.Stream()
+        self._build_buckets(parameters)
+
+    def _build_buckets(self, parameters: Iterable[torch.nn.Parameter]) -> None:
+        # group the shadow params by device and dtype so each group is one multi tensor update, and make
+        # each group views into one flat buffer so moving it around is a single copy
+        groups = OrderedDict()
+        for i, (s_param, param) in enumerate(zip(self.shadow_params, parameters)):
+            key = (s_param.device, s_param.dtype, param.device)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(i)
+
+        pin_memory = self.offload_to_cpu and torch.cuda.is_available()
+        self._buckets = []
+        for (device, dtype, param_device), indices in groups.items():
+            numel = sum([self.shadow_params[i].numel() for i in indices])
+            flat = torch.empty(numel, device=device, dtype=dtype, pin_memory=pin_memory and device.type == 'cpu')
+            staging = None
+            if self.offload_to_cpu:
+                # parameters are copied off the device in here before being averaged
+                staging = torch.empty(numel, dtype=dtype, pin_memory=pin_memory)
+            offset = 0
+            for i in indices:
+                s_param = self.shadow_params[i]
+                view = flat[offset:offset + s_param.numel()].view_as(s_param)
+                view.copy_(s_param)
+                self.shadow_params[i] = view
+                offset += s_param.numel()
+            self._buckets.append({
+                'indices': indices,
+                'flat': flat,
+                'staging': staging,
+                'param_device': param_device,
+            })
+
+    def _get_decay(self) -> float:
+        decay = self.decay
+        if self.num_updates is not None:
+            self.num_updates += 1
+            decay = min(
+                decay,
+                (1 + self.num_updates) / (10 + self.num_updates)
+            )
+        # keep the same time constant when only every nth step is averaged in
+        return decay ** self.update_every
+
+    def synchronize(self) -> None:
+        # wait for an offloaded update to land in the shadow params
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
     def _get_parameters(
             self,
             parameters: Optional[Iterable[torch.nn.Parameter]]
@@ -110,24 +195,57 @@ class ExponentialMovingAverage:
                 parameters with which this `ExponentialMovingAverage` was
                 initialized will be used.
         """
+        self.step_count += 1
+        if self.step_count % self.update_every != 0:
+            return
         parameters = self._get_parameters(parameters)
-        decay = self.decay
-        if self.num_updates is not None:
-            self.num_updates += 1
-            decay = min(
-                decay,
-                (1 + self.num_updates) / (10 + self.num_updates)
-            )
-        one_minus_decay = 1.0 - decay
+        one_minus_decay = 1.0 - self._get_decay()
         with torch.no_grad():
-            for s_param, param in zip(self.shadow_params, parameters):
-                tmp = (s_param - param)
-                # tmp will be a new tensor so we can do in-place
-                tmp.mul_(one_minus_decay)
-                s_param.sub_(tmp)
-
+            if self.offload_to_cpu:
+                self._update_offloaded(parameters, one_minus_decay)
+                return
+            for bucket in self._buckets:
+                s_params = [self.shadow_params[i] for i in bucket['indices']]
+                params = [parameters[i].data for i in bucket['indices']]
                 if self.use_feedback:
-                    param.add_(tmp)
+                    tmp = torch._foreach_sub(s_params, params)
+                    torch._foreach_mul_(tmp, one_minus_decay)
+                    torch._foreach_sub_(s_params, tmp)
+                    torch._foreach_add_(params, tmp)
+                else:
+                    # s_param = s_param + (1 - decay) * (param - s_param), no temporaries
+                    torch._foreach_lerp_(s_params, params, one_minus_decay)
+
+    def _update_offloaded(self, parameters: list, one_minus_decay: float) -> None:
+        # the last update still reads the staging buffers
+        self.synchronize()
+        events = []
+        for bucket in self._buckets:
+            params = [parameters[i].data for i in bucket['indices']]
+            if self._copy_stream is not None and bucket['param_device'].type == 'cuda':
+                # flatten on the current stream so the next optimizer step cannot change the params
+                # while they are read, then copy the snapshot off on a side stream
+                flat_params = torch.cat([p.reshape(-1) for p in params])
+                self._copy_stream.wait_stream(torch.cuda.current_stream(bucket['param_device']))
+                with torch.cuda.stream(self._copy_stream):
+                    bucket['staging'].copy_(flat_params, non_blocking=True)
+                    # keep the snapshot alive until the copy is done with it
+                    flat_params.record_stream(self._copy_stream)
+                    event = torch.cuda.Event()
+                    event.record(self._copy_stream)
+                events.append(event)
+            else:
+                torch.cat([p.reshape(-1) for p in params], out=bucket['staging'])
+                events.append(None)
+
+        def average():
+            with torch.no_grad():
+                for bucket, event in zip(self._buckets, events):
+                    if event is not None:
+                        event.synchronize()
+                    bucket['flat'].lerp_(bucket['staging'], one_minus_decay)
+
+        self._pending = self._executor.submit(average)
 
     def copy_to(
             self,
@@ -142,6 +260,7 @@ class ExponentialMovingAverage:
                 parameters with which this `ExponentialMovingAverage` was
                 initialized will be used.
         """
+        self.synchronize()
         parameters = self._get_parameters(parameters)
         for s_param, param in zip(self.shadow_params, parameters):
             param.data.copy_(s_param.data)
@@ -228,6 +347,7 @@ class ExponentialMovingAverage:
             device: like `device` argument to `torch.Tensor.to`
         """
         # .to() on the tensors handles None correctly
+        self.synchronize()
         self.shadow_params = [
             p.to(device=device, dtype=dtype)
             if p.is_floating_point()
@@ -241,6 +361,7 @@ class ExponentialMovingAverage:
                 else p.to(device=device)
                 for p in self.collected_params
             ]
+        self._build_buckets(self._get_parameters(None))
         return
 
     def state_dict(self) -> dict:
@@ -248,6 +369,7 @@ class ExponentialMovingAverage:
         # Following PyTorch conventions, references to tensors are returned:
         # "returns a reference to the state and not its copy!" -
         # https://pytorch.org/tutorials/beginner/saving_loading_models.html#what-is-a-state-dict
+        self.synchronize()
         return {
             "decay": self.decay,
             "num_updates": self.num_updates,
@@ -263,6 +385,7 @@ class ExponentialMovingAverage:
                 from a call to :meth:`state_dict`.
         """
         # deepcopy, to be consistent with module API
+        self.synchronize()
         state_dict = copy.deepcopy(state_dict)
         self.decay = state_dict["decay"]
         if self.decay < 0.0 or self.decay > 1.0:
@@ -298,12 +421,13 @@ class ExponentialMovingAverage:
                 # ^ parameter references are still good
                 for i, p in enumerate(params):
                     self.shadow_params[i] = self.shadow_params[i].to(
-                        device=p.device, dtype=p.dtype
+                        device='cpu' if self.offload_to_cpu else p.device, dtype=p.dtype
                     )
                     if self.collected_params is not None:
                         self.collected_params[i] = self.collected_params[i].to(
                             device=p.device, dtype=p.dtype
                         )
+                self._build_buckets(params)
         else:
             raise ValueError(
                 "Tried to `load_state_dict()` with the wrong number of "
@@ -311,14 +435,27 @@ class ExponentialMovingAverage:
             )
 
     def eval(self):
+        # swaps the averaged weights into the parameters. The training weights are set aside, not copied
         if self._is_train_mode:
             with torch.no_grad():
-                self.store()
-                self.copy_to()
+                self.synchronize()
+                parameters = self._get_parameters(None)
+                self.collected_params = [param.data for param in parameters]
+                for bucket in self._buckets:
+                    # one copy per bucket if offloaded, the shadow buffer itself if not
+                    flat = bucket['flat'].to(bucket['param_device'], non_blocking=True)
+                    offset = 0
+                    for i in bucket['indices']:
+                        s_param = self.shadow_params[i]
+                        parameters[i].data = flat[offset:offset + s_param.numel()].view_as(s_param)
+                        offset += s_param.numel()
                 self._is_train_mode = False
 
     def train(self):
         if not self._is_train_mode:
             with torch.no_grad():
-                self.restore()
+                parameters = self._get_parameters(None)
+                for c_param, param in zip(self.collected_params, parameters):
+                    param.data = c_param
+                self.collected_params = None
                 self._is_train_mode = True
@@ -0,0 +1,28 @@
+import threading
+from typing import Set, Union
+
+# a run.py --worker process reads this from stdin, followed by the config file of the job to cancel
+WORKER_CANCEL_COMMAND = '__cancel__'
+
+_lock = threading.Lock()
+_current_job: Union[str, None] = None
+_cancelled_jobs: Set[str] = set()
+
+
+def set_current_job(config_file: Union[str, None]):
+    global _current_job
+    with _lock:
+        if _current_job is not None:
+            _cancelled_jobs.discard(_current_job)
+        _current_job = config_file
+
+
+def request_job_cancel(config_file: str):
+    # a cancel can come in before the worker gets to the job, so it is kept by config file
+    with _lock:
+        _cancelled_jobs.add(config_file)
+
+
+def is_job_cancel_requested() -> bool:
+    with _lock:
+        return _current_job is not None and _current_job in _cancelled_jobs
@@ -0,0 +1,144 @@
+import json
+import mmap
+import os
+import threading
+from typing import Dict, Union
+
+import torch
+
+# byte alignment for every latent in the shard
+SHARD_ALIGNMENT = 64
+
+
+def _dtype_to_str(dtype: torch.dtype) -> str:
+    return str(dtype).replace('torch.', '')
+
+
+def _str_to_dtype(dtype_str: str) -> torch.dtype:
+    return getattr(torch, dtype_str)
+
+
+class ConsolidatedLatentCache:
+    """
+    All latents for a _latent_cache folder stored in a single shard file (latents.bin) with a json index
+    keyed by the latent info dict hash. The shard is memory mapped once per process so reads are
+    zero copy slices. New latents are appended to the end of the shard.
+    """
+
+    shard_name = 'latents.bin'
+    index_name = 'latents_index.json'
+
+    def __init__(self, cache_dir: str, latent_version: int):
+        self.cache_dir = cache_dir
+        self.latent_version = latent_version
+        self.shard_path = os.path.join(cache_dir, self.shard_name)
+        self.index_path = os.path.join(cache_dir, self.index_name)
+        self.entries: Dict[str, dict] = {}
+        self._mmap: Union[mmap.mmap, None] = None
+        self._mmap_size = 0
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('latent_version', None) != self.latent_version:
+            print(f"Latent version changed, invalidating consolidated latent cache in {self.cache_dir}")
+            self.invalidate()
+            return
+        shard_size = os.path.getsize(self.shard_path) if os.path.exists(self.shard_path) else 0
+        # drop anything that did not make it to disk
+        self.entries = {
+            key: entry for key, entry in index.get('entries', {}).items()
+            if entry['offset'] + entry['num_bytes'] <= shard_size
+        }
+
+    def invalidate(self):
+        self.close()
+        self.entries = {}
+        for path in [self.shard_path, self.index_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # tensors handed out by get still view it. The map holds no file handle, dropping our
+                # reference is enough, it is unmapped when the last of those tensors is freed
+                pass
+            self._mmap = None
+            self._mmap_size = 0
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get_mmap(self, min_size: int) -> mmap.mmap:
+        if self._mmap is None or self._mmap_size < min_size:
+            # shard grew since we mapped it, remap
+            self.close()
+            with open(self.shard_path, 'rb') as f:
+                # copy on write so tensors are writable without touching the file
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._mmap_size = len(self._mmap)
+        return self._mmap
+
+    def get(self, key: str) -> torch.Tensor:
+        entry = self.entries[key]
+        dtype = _str_to_dtype(entry['dtype'])
+        shape = entry['shape']
+        buffer = self._get_mmap(entry['offset'] + entry['num_bytes'])
+        num_elements = 1
+        for dim in shape:
+            num_elements *= dim
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=num_elements, offset=entry['offset'])
+        return tensor.view(shape)
+
+    def append(self, key: str, latent: torch.Tensor):
+        latent = latent.detach().cpu().contiguous()
+        data = latent.reshape(-1).view(torch.uint8).numpy().tobytes()
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.shard_path, 'ab') as f:
+                offset = f.tell()
+                padding = (SHARD_ALIGNMENT - offset % SHARD_ALIGNMENT) % SHARD_ALIGNMENT
+                if padding > 0:
+                    f.write(b'\0' * padding)
+                    offset += padding
+                f.write(data)
+            self.entries[key] = {
+                'offset': offset,
+                'num_bytes': len(data),
+                'shape': list(latent.shape),
+                'dtype': _dtype_to_str(latent.dtype),
+            }
+
+    def save_index(self):
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            index = {
+                'latent_version': self.latent_version,
+                'entries': self.entries,
+            }
+            # write to a temp file and swap so a crash never leaves a half written index
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+
+
+# one cache per folder per process so dataloader workers each get their own memory map
+_consolidated_latent_caches: Dict[tuple, ConsolidatedLatentCache] = {}
+
+
+def get_consolidated_latent_cache(cache_dir: str, latent_version: int) -> ConsolidatedLatentCache:
+    key = (os.getpid(), os.path.abspath(cache_dir), latent_version)
+    if key not in _consolidated_latent_caches:
+        _consolidated_latent_caches[key] = ConsolidatedLatentCache(cache_dir, latent_version)
+    return _consolidated_latent_caches[key]
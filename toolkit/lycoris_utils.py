@@ -12,6 +12,7 @@ import torch.linalg as linalg
 
 from tqdm import tqdm
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def make_sparse(t: torch.Tensor, sparsity=0.95):
@@ -22,18 +23,7 @@ def make_sparse(t: torch.Tensor, sparsity=0.95):
     return sparse_t
 
 
-def extract_conv(
-        weight: Union[torch.Tensor, nn.Parameter],
-        mode='fixed',
-        mode_param=0,
-        device='cpu',
-        is_cp=False,
-) -> Tuple[nn.Parameter, nn.Parameter]:
-    weight = weight.to(device)
-    out_ch, in_ch, kernel_size, _ = weight.shape
-
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
-
+def get_lora_rank(S: torch.Tensor, mode, mode_param, out_ch: int, in_ch: int) -> int:
     if mode == 'fixed':
         lora_rank = mode_param
     elif mode == 'threshold':
@@ -50,8 +40,23 @@ def extract_conv(
         lora_rank = torch.sum(s_cum < min_cum_sum)
     else:
         raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
+    lora_rank = max(1, int(lora_rank))
     lora_rank = min(out_ch, in_ch, lora_rank)
+    return lora_rank
+
+
+def decompose_weight(
+        weight: torch.Tensor,
+        U: torch.Tensor,
+        S: torch.Tensor,
+        Vh: torch.Tensor,
+        mode='fixed',
+        mode_param=0,
+        is_cp=False,
+):
+    # splits a linear or conv weight into lora weights from the svd of weight.reshape(out_ch, -1)
+    out_ch, in_ch = weight.shape[:2]
+    lora_rank = get_lora_rank(S, mode, mode_param, out_ch, in_ch)
     if lora_rank >= out_ch / 2 and not is_cp:
         return weight, 'full'
 
@@ -60,13 +65,45 @@ def extract_conv(
     U = U @ torch.diag(S)
     Vh = Vh[:lora_rank, :]
 
-    diff = (weight - (U @ Vh).reshape(out_ch, in_ch, kernel_size, kernel_size)).detach()
-    extract_weight_A = Vh.reshape(lora_rank, in_ch, kernel_size, kernel_size).detach()
-    extract_weight_B = U.reshape(out_ch, lora_rank, 1, 1).detach()
+    diff = (weight - (U @ Vh).reshape(weight.shape)).detach()
+    extract_weight_A = Vh.reshape(lora_rank, *weight.shape[1:]).detach()
+    extract_weight_B = U.reshape(out_ch, lora_rank, *([1] * (weight.dim() - 2))).detach()
     del U, S, Vh, weight
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
+def batched_svd(
+        weights: torch.Tensor,
+        mode='fixed',
+        mode_param=0,
+        lowrank=False,
+        oversample=10,
+        niter=2,
+):
+    # svd of a (batch, out_ch, in_ch) stack of weights. Only the top singular values are needed
+    # for fixed mode, so those can use the much faster randomized low rank svd
+    if lowrank and mode == 'fixed':
+        q = int(mode_param) + oversample
+        if q < min(weights.shape[-2:]):
+            U, S, V = torch.svd_lowrank(weights, q=q, niter=niter)
+            return U, S, V.transpose(-2, -1)
+    return linalg.svd(weights, full_matrices=False)
+
+
+def extract_conv(
+        weight: Union[torch.Tensor, nn.Parameter],
+        mode='fixed',
+        mode_param=0,
+        device='cpu',
+        is_cp=False,
+) -> Tuple[nn.Parameter, nn.Parameter]:
+    weight = weight.to(device)
+    out_ch = weight.shape[0]
+
+    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1), full_matrices=False)
+    return decompose_weight(weight, U, S, Vh, mode, mode_param, is_cp)
+
+
 def extract_linear(
         weight: Union[torch.Tensor, nn.Parameter],
         mode='fixed',
@@ -74,41 +111,162 @@ def extract_linear(
         device='cpu',
 ) -> Tuple[nn.Parameter, nn.Parameter]:
     weight = weight.to(device)
-    out_ch, in_ch = weight.shape
 
-    U, S, Vh = linalg.svd(weight)
+    U, S, Vh = linalg.svd(weight, full_matrices=False)
+    return decompose_weight(weight, U, S, Vh, mode, mode_param)
 
-    if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
-        assert mode_param >= 0
-        lora_rank = torch.sum(S > mode_param)
-    elif mode == 'ratio':
-        assert 1 >= mode_param >= 0
-        min_s = torch.max(S) * mode_param
-        lora_rank = torch.sum(S > min_s)
-    elif mode == 'quantile' or mode == 'percentile':
-        assert 1 >= mode_param >= 0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum < min_cum_sum)
+
+LINEAR_LAYERS = {'Linear', 'LoRACompatibleLinear'}
+CONV_LAYERS = {'Conv2d', 'LoRACompatibleConv'}
+
+
+class ExtractTarget:
+    # a layer to extract, the difference is only computed when its batch is decomposed
+    def __init__(
+            self,
+            lora_name: str,
+            weight: torch.Tensor,
+            base_weight: torch.Tensor,
+            mode_param,
+            is_conv: bool,
+            is_linear: bool,
+    ):
+        self.lora_name = lora_name
+        self.weight = weight
+        self.base_weight = base_weight
+        self.mode_param = mode_param
+        self.is_conv = is_conv
+        # 1x1 convs are extracted like linear layers
+        self.is_linear = is_linear
+
+
+def decompose_target(
+        target: ExtractTarget,
+        weight: torch.Tensor,
+        U: torch.Tensor,
+        S: torch.Tensor,
+        Vh: torch.Tensor,
+        mode='fixed',
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+) -> 'OrderedDict[str, torch.Tensor]':
+    loras = OrderedDict()
+    lora_name = target.lora_name
+    weight, decompose_mode = decompose_weight(weight, U, S, Vh, mode, target.mode_param)
+    if decompose_mode == 'low rank':
+        extract_a, extract_b, diff = weight
+        if target.is_conv and small_conv and not target.is_linear:
+            dim = extract_a.size(0)
+            (extract_c, extract_a, _), _ = extract_conv(
+                extract_a.transpose(0, 1),
+                'fixed', dim,
+                extract_device, True
+            )
+            extract_a = extract_a.transpose(0, 1)
+            extract_c = extract_c.transpose(0, 1)
+            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
+            diff = target.weight - torch.einsum(
+                'i j k l, j r, p i -> p r k l',
+                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
+            ).detach().cpu().contiguous()
+            del extract_c
+        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+        if use_bias:
+            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+
+            indices = sparse_diff.indices().to(torch.int16)
+            values = sparse_diff.values().half()
+            loras[f'{lora_name}.bias_indices'] = indices
+            loras[f'{lora_name}.bias_values'] = values
+            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+        del extract_a, extract_b, diff
+    elif decompose_mode == 'full':
+        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
     else:
-        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2:
-        return weight, 'full'
+        raise NotImplementedError
+    return loras
 
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
 
-    diff = (weight - U @ Vh).detach()
-    extract_weight_A = Vh.reshape(lora_rank, in_ch).detach()
-    extract_weight_B = U.reshape(out_ch, lora_rank).detach()
-    del U, S, Vh, weight
-    return (extract_weight_A, extract_weight_B, diff), 'low rank'
+@torch.no_grad()
+def extract_targets(
+        targets: List[ExtractTarget],
+        mode='fixed',
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        batch_size=8,
+        lowrank=False,
+        oversample=10,
+        num_workers=1,
+) -> 'OrderedDict[str, torch.Tensor]':
+    # layers with the same shape are stacked and decomposed with a single batched svd.
+    # On cpu, batches can also be spread over worker threads, torch releases the gil in the svd
+    groups = OrderedDict()
+    for idx, target in enumerate(targets):
+        key = (tuple(target.weight.shape), target.mode_param)
+        groups.setdefault(key, []).append(idx)
+
+    chunks = []
+    for idxs in groups.values():
+        for i in range(0, len(idxs), max(1, batch_size)):
+            chunks.append(idxs[i:i + max(1, batch_size)])
+
+    def run_chunk(chunk: List[int]):
+        weights = torch.stack([
+            targets[idx].weight.detach() - targets[idx].base_weight.detach() for idx in chunk
+        ]).to(extract_device, dtype=torch.float32)
+        U, S, Vh = batched_svd(
+            weights.reshape(weights.shape[0], weights.shape[1], -1),
+            mode,
+            targets[chunk[0]].mode_param,
+            lowrank=lowrank,
+            oversample=oversample,
+        )
+        chunk_loras = []
+        for i, idx in enumerate(chunk):
+            chunk_loras.append(decompose_target(
+                targets[idx], weights[i], U[i], S[i], Vh[i],
+                mode, extract_device, use_bias, sparsity, small_conv
+            ))
+        del weights, U, S, Vh
+        return chunk_loras
+
+    results = {}
+    is_cpu = torch.device(extract_device).type == 'cpu'
+    num_workers = num_workers if is_cpu else 1
+    progress_bar = tqdm(total=len(targets))
+    if num_workers > 1:
+        # split the cpu threads between the workers so they do not oversubscribe
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, num_threads // num_workers))
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(run_chunk, chunk): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    for idx, loras in zip(chunk, future.result()):
+                        results[idx] = loras
+                    progress_bar.update(len(chunk))
+        finally:
+            torch.set_num_threads(num_threads)
+    else:
+        for chunk in chunks:
+            for idx, loras in zip(chunk, run_chunk(chunk)):
+                results[idx] = loras
+            progress_bar.update(len(chunk))
+    progress_bar.close()
+
+    # keep the layer order
+    loras = OrderedDict()
+    for idx in range(len(targets)):
+        loras.update(results[idx])
+    return loras
 
 
 def extract_diff(
@@ -124,6 +282,10 @@ def extract_diff(
         linear_only=False,
         extract_unet=True,
         extract_text_encoder=True,
+        batch_size=8,
+        lowrank=False,
+        oversample=10,
+        num_workers=1,
 ):
     meta = OrderedDict()
 
@@ -159,14 +321,14 @@ def extract_diff(
     LORA_PREFIX_UNET = 'lora_unet'
     LORA_PREFIX_TEXT_ENCODER = 'lora_te'
 
-    def make_state_dict(
+    def get_targets(
             prefix,
             root_module: torch.nn.Module,
             target_module: torch.nn.Module,
             target_replace_modules,
             target_replace_names=[]
-    ):
-        loras = {}
+    ) -> List[ExtractTarget]:
+        targets = []
         temp = {}
         temp_name = {}
 
@@ -174,168 +336,71 @@ def extract_diff(
             if module.__class__.__name__ in target_replace_modules:
                 temp[name] = {}
                 for child_name, child_module in module.named_modules():
-                    if child_module.__class__.__name__ not in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
+                    if child_module.__class__.__name__ not in LINEAR_LAYERS | CONV_LAYERS:
                         continue
                     temp[name][child_name] = child_module.weight
             elif name in target_replace_names:
                 temp_name[name] = module.weight
 
-        for name, module in tqdm(list(target_module.named_modules())):
+        def add_target(lora_name, module, base_weight):
+            layer = module.__class__.__name__
+            if layer in LINEAR_LAYERS:
+                is_conv = False
+                is_linear = True
+            elif layer in CONV_LAYERS:
+                is_conv = True
+                is_linear = module.weight.shape[2] == 1 and module.weight.shape[3] == 1
+                if not is_linear and linear_only:
+                    return
+            else:
+                return
+            if torch.allclose(module.weight, base_weight):
+                return
+            targets.append(ExtractTarget(
+                lora_name.replace('.', '_'),
+                module.weight,
+                base_weight,
+                linear_mode_param if is_linear else conv_mode_param,
+                is_conv,
+                is_linear,
+            ))
+
+        for name, module in target_module.named_modules():
             if name in temp:
                 weights = temp[name]
                 for child_name, child_module in module.named_modules():
-                    lora_name = prefix + '.' + name + '.' + child_name
-                    lora_name = lora_name.replace('.', '_')
-                    layer = child_module.__class__.__name__
-                    if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        root_weight = child_module.weight
-                        if torch.allclose(root_weight, weights[child_name]):
-                            continue
-
-                    if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                        weight, decompose_mode = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                    elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                        is_linear = (child_module.weight.shape[2] == 1
-                                     and child_module.weight.shape[3] == 1)
-                        if not is_linear and linear_only:
-                            continue
-                        weight, decompose_mode = extract_conv(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                        if small_conv and not is_linear and decompose_mode == 'low rank':
-                            dim = extract_a.size(0)
-                            (extract_c, extract_a, _), _ = extract_conv(
-                                extract_a.transpose(0, 1),
-                                'fixed', dim,
-                                extract_device, True
-                            )
-                            extract_a = extract_a.transpose(0, 1)
-                            extract_c = extract_c.transpose(0, 1)
-                            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                            diff = child_module.weight - torch.einsum(
-                                'i j k l, j r, p i -> p r k l',
-                                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                            ).detach().cpu().contiguous()
-                            del extract_c
-                    else:
-                        continue
-                    if decompose_mode == 'low rank':
-                        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                        if use_bias:
-                            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                            indices = sparse_diff.indices().to(torch.int16)
-                            values = sparse_diff.values().half()
-                            loras[f'{lora_name}.bias_indices'] = indices
-                            loras[f'{lora_name}.bias_values'] = values
-                            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                        del extract_a, extract_b, diff
-                    elif decompose_mode == 'full':
-                        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                    else:
-                        raise NotImplementedError
+                    if child_name in weights:
+                        add_target(prefix + '.' + name + '.' + child_name, child_module, weights[child_name])
             elif name in temp_name:
-                weights = temp_name[name]
-                lora_name = prefix + '.' + name
-                lora_name = lora_name.replace('.', '_')
-                layer = module.__class__.__name__
-
-                if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                    root_weight = module.weight
-                    if torch.allclose(root_weight, weights):
-                        continue
+                add_target(prefix + '.' + name, module, temp_name[name])
+        return targets
 
-                if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                    weight, decompose_mode = extract_linear(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                    is_linear = (
-                            root_weight.shape[2] == 1
-                            and root_weight.shape[3] == 1
-                    )
-                    if not is_linear and linear_only:
-                        continue
-                    weight, decompose_mode = extract_conv(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param if is_linear else conv_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                    if small_conv and not is_linear and decompose_mode == 'low rank':
-                        dim = extract_a.size(0)
-                        (extract_c, extract_a, _), _ = extract_conv(
-                            extract_a.transpose(0, 1),
-                            'fixed', dim,
-                            extract_device, True
-                        )
-                        extract_a = extract_a.transpose(0, 1)
-                        extract_c = extract_c.transpose(0, 1)
-                        loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                        diff = root_weight - torch.einsum(
-                            'i j k l, j r, p i -> p r k l',
-                            extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                        ).detach().cpu().contiguous()
-                        del extract_c
-                else:
-                    continue
-                if decompose_mode == 'low rank':
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    if use_bias:
-                        diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                        sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                        indices = sparse_diff.indices().to(torch.int16)
-                        values = sparse_diff.values().half()
-                        loras[f'{lora_name}.bias_indices'] = indices
-                        loras[f'{lora_name}.bias_values'] = values
-                        loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                    del extract_a, extract_b, diff
-                elif decompose_mode == 'full':
-                    loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                else:
-                    raise NotImplementedError
-        return loras
-
-    text_encoder_loras = make_state_dict(
+    text_encoder_targets = get_targets(
         LORA_PREFIX_TEXT_ENCODER,
         base_model[0], db_model[0],
         TEXT_ENCODER_TARGET_REPLACE_MODULE
     )
 
-    unet_loras = make_state_dict(
+    unet_targets = get_targets(
         LORA_PREFIX_UNET,
         base_model[2], db_model[2],
         UNET_TARGET_REPLACE_MODULE,
         UNET_TARGET_REPLACE_NAME
     )
-    print(len(text_encoder_loras), len(unet_loras))
-    # the | will
-    return (text_encoder_loras | unet_loras), meta
+    print(f"Extracting {len(text_encoder_targets)} text encoder and {len(unet_targets)} unet layers")
+    loras = extract_targets(
+        text_encoder_targets + unet_targets,
+        mode,
+        extract_device,
+        use_bias,
+        sparsity,
+        small_conv,
+        batch_size=batch_size,
+        lowrank=lowrank,
+        oversample=oversample,
+        num_workers=num_workers,
+    )
+    return loras, meta
 
 
 def get_module(
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from typing import Dict, Union
+
+import torch
+
+
+class MetricsAccumulator:
+    """
+    Keeps per step metrics (loss, grad norm, nan flags, lr) in ring buffers on the device so the
+    training loop never has to wait on the gpu to read them. They are only copied back to the host
+    when flush is called, at a logging boundary. When a buffer fills up before a flush, it is folded
+    into a running sum on the device, so no step is dropped however long the flush interval is.
+    """
+
+    def __init__(self, device: Union[str, torch.device], size: int = 100):
+        self.device = device
+        self.size = max(1, size)
+        self.buffers: Dict[str, torch.Tensor] = OrderedDict()
+        # [sum, number of valid steps] of the buffers folded since the last flush
+        self.folded: Dict[str, torch.Tensor] = OrderedDict()
+        # steps written since the last flush, can be more than size if the buffers were folded
+        self.count = 0
+        self.index = 0
+
+    def _get_buffer(self, key: str) -> torch.Tensor:
+        if key not in self.buffers:
+            # nan so steps before this metric existed are ignored when averaging
+            self.buffers[key] = torch.full((self.size,), float('nan'), device=self.device, dtype=torch.float32)
+            self.folded[key] = torch.zeros((2,), device=self.device, dtype=torch.float32)
+        return self.buffers[key]
+
+    @staticmethod
+    def _sum_valid(values: torch.Tensor):
+        is_nan = torch.isnan(values)
+        sums = torch.where(is_nan, torch.zeros_like(values), values).sum(dim=-1)
+        valid = (~is_nan).sum(dim=-1).float()
+        return sums, valid
+
+    def _fold(self):
+        # the buffers are full, add them to the running sums and clear them for the next steps
+        for key, buffer in self.buffers.items():
+            sums, valid = self._sum_valid(buffer)
+            self.folded[key] += torch.stack([sums, valid])
+            buffer.fill_(float('nan'))
+        self.index = 0
+
+    @torch.no_grad()
+    def add(self, metrics: Dict[str, Union[torch.Tensor, float]]):
+        if self.index == self.size:
+            # folded right before writing, so the last step written is always still in the buffers
+            self._fold()
+        for key, value in metrics.items():
+            buffer = self._get_buffer(key)
+            if isinstance(value, torch.Tensor):
+                # copies on the device, nothing is read back
+                buffer[self.index].copy_(value.detach().float().mean())
+            else:
+                buffer[self.index] = float(value)
+        self.index += 1
+        self.count += 1
+
+    @torch.no_grad()
+    def flush(self) -> Dict[str, Dict[str, float]]:
+        # returns the latest value, sum and mean since the last flush for every metric, then resets.
+        # This is the only place the host waits for the device
+        if self.count == 0:
+            return OrderedDict()
+        last_index = self.index - 1
+        keys = list(self.buffers.keys())
+        stacked = torch.stack([self.buffers[key] for key in keys])
+        folded = torch.stack([self.folded[key] for key in keys])
+        # only the steps written since the last fold, the rest are in folded
+        sums, valid = self._sum_valid(stacked[:, :self.index])
+        sums = sums + folded[:, 0]
+        valid = valid + folded[:, 1]
+        means = sums / valid.clamp(min=1)
+        # one transfer for everything
+        latest, sums, means, valid = torch.stack(
+            [stacked[:, last_index], sums, means, valid]
+        ).cpu().tolist()
+
+        results = OrderedDict()
+        for i, key in enumerate(keys):
+            results[key] = {
+                'latest': latest[i],
+                'sum': sums[i],
+                'mean': means[i] if valid[i] > 0 else float('nan'),
+            }
+        for buffer in self.buffers.values():
+            buffer.fill_(float('nan'))
+        for folded in self.folded.values():
+            folded.zero_()
+        self.count = 0
+        self.index = 0
+        return results
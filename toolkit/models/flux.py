@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Union
+
+import torch
+from einops import repeat
+
+
+class FluxInputs:
+    # device resident inputs for one (batch, latent size, text length) shape
+    def __init__(
+            self,
+            img_ids: torch.Tensor,
+            txt_ids: torch.Tensor,
+            guidance: Union[torch.Tensor, None]
+    ):
+        self.img_ids = img_ids
+        self.txt_ids = txt_ids
+        self.guidance = guidance
+        # filled in by the transformer the first time these ids are used
+        self.rotary_emb = None
+
+
+def get_joint_attention_mask(text_attention_mask: torch.Tensor, image_seq_len: int) -> torch.Tensor:
+    # joint attention runs over the text tokens followed by the image tokens. Image tokens are never masked.
+    # Shaped to broadcast over heads and queries in scaled_dot_product_attention
+    image_attention_mask = torch.ones(
+        (text_attention_mask.shape[0], image_seq_len),
+        device=text_attention_mask.device,
+        dtype=torch.bool
+    )
+    attention_mask = torch.cat([text_attention_mask.bool(), image_attention_mask], dim=1)
+    return attention_mask[:, None, None, :]
+
+
+class CachedPosEmbed(torch.nn.Module):
+    # wraps the transformer pos_embed so the rotary embedding for cached ids is only computed once
+    def __init__(self, pos_embed: torch.nn.Module):
+        super().__init__()
+        self.pos_embed = pos_embed
+        self.inputs: Union[FluxInputs, None] = None
+
+    def forward(self, ids: torch.Tensor):
+        if self.inputs is None:
+            return self.pos_embed(ids)
+        if self.inputs.rotary_emb is None:
+            self.inputs.rotary_emb = self.pos_embed(ids)
+        return self.inputs.rotary_emb
+
+
+class FluxInputCache:
+    """
+    LRU cache of the flux position ids, guidance and rotary embeddings. They only depend on the
+    shape of the inputs, which only takes a few values with bucketing, so there is no reason to
+    build them on the cpu and copy them over every step.
+    """
+
+    def __init__(self, max_size: int = 16):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    @torch.no_grad()
+    def get(
+            self,
+            batch_size: int,
+            height: int,
+            width: int,
+            text_length: int,
+            device: torch.device,
+            guidance_batch_size: Union[int, None] = None,
+            guidance_scale: float = 1.0,
+    ) -> FluxInputs:
+        # height and width are the latent size, before packing
+        key = (batch_size, height, width, text_length, str(device), guidance_batch_size, guidance_scale)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        img_ids = torch.zeros(height // 2, width // 2, 3)
+        img_ids[..., 1] = img_ids[..., 1] + torch.arange(height // 2)[:, None]
+        img_ids[..., 2] = img_ids[..., 2] + torch.arange(width // 2)[None, :]
+        img_ids = repeat(img_ids, "h w c -> b (h w) c", b=batch_size).to(device)
+
+        txt_ids = torch.zeros(batch_size, text_length, 3, device=device)
+
+        guidance = None
+        if guidance_batch_size is not None:
+            guidance = torch.tensor([guidance_scale], device=device)
+            guidance = guidance.expand(guidance_batch_size)
+
+        inputs = FluxInputs(img_ids=img_ids, txt_ids=txt_ids, guidance=guidance)
+        self.cache[key] = inputs
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return inputs
+
+    @contextmanager
+    def rotary_cache(self, transformer: torch.nn.Module, inputs: FluxInputs):
+        # use the rotary embedding cached on inputs for transformer calls inside this context
+        if not isinstance(transformer.pos_embed, CachedPosEmbed):
+            transformer.pos_embed = CachedPosEmbed(transformer.pos_embed)
+        transformer.pos_embed.inputs = inputs
+        try:
+            yield
+        finally:
+            transformer.pos_embed.inputs = None
+
+    def clear(self):
+        self.cache.clear()
@@ -1,4 +1,3 @@
-import json
 import os
 from collections import OrderedDict
 from typing import Optional, Union, List, Type, TYPE_CHECKING, Dict, Any, Literal
@@ -10,11 +9,12 @@ import weakref
 
 from tqdm import tqdm
 
+from toolkit.async_saver import snapshot_to_cpu
 from toolkit.config_modules import NetworkConfig
 from toolkit.lorm import extract_conv, extract_linear, count_parameters
 from toolkit.metadata import add_model_hash_to_meta
 from toolkit.paths import KEYMAPS_ROOT
-from toolkit.saving import get_lora_keymap_from_model_keymap
+from toolkit.saving import get_network_keymap
 
 if TYPE_CHECKING:
     from toolkit.lycoris_special import LycorisSpecialNetwork, LoConSpecialModule
@@ -45,6 +45,22 @@ ExtractMode = Union[
 ]
 
 
+def get_uniform_multiplier(multiplier) -> Optional[float]:
+    # the multiplier as a float if it is the same for the whole batch
+    if isinstance(multiplier, (int, float)):
+        return float(multiplier)
+    if isinstance(multiplier, list) and len(multiplier) > 0 and all([isinstance(m, (int, float)) for m in multiplier]):
+        if all([m == multiplier[0] for m in multiplier]):
+            return float(multiplier[0])
+    return None
+
+
+def get_quantized_weight_bytes(weight: QTensor) -> int:
+    # size of the data and scales the quantized tensor is made of
+    inner_names, _ = weight.__tensor_flatten__()
+    return sum([getattr(weight, name).numel() * getattr(weight, name).element_size() for name in inner_names])
+
+
 def broadcast_and_multiply(tensor, multiplier):
     # Determine the number of dimensions required
     num_extra_dims = tensor.dim() - multiplier.dim()
@@ -161,6 +177,10 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        # quantized weight from before a merge, put back as is on merge out
+        self.pre_merge_weight: Optional[QTensor] = None
+        # scale * multiplier for the fused forward, set by the network
+        self.fused_scale: float = 1.0
 
     def _call_forward(self: Module, x):
         # module dropout
@@ -233,6 +253,47 @@ class ToolkitModuleMixin:
             return self.lora_up(self.lora_down(x))
 
     def forward(self: Module, x, *args, **kwargs):
+        # the network picks the implementation when its state changes, see _update_module_forwards
+        return self.forward_impl(self, x, *args, **kwargs)
+
+    def bypass_forward(self: Module, x, *args, **kwargs):
+        # network inactive, merged in or at a multiplier of 0
+        return self.org_forward(x, *args, **kwargs)
+
+    def fused_forward(self: Module, x, *args, **kwargs):
+        # base(x) + up(down(x)) * scale * multiplier. One cast of the input, and the scale is a python
+        # float applied in the same kernel as the add, so nothing is allocated for the multiplier
+        org_forwarded = self.org_forward(x, *args, **kwargs)
+        if isinstance(x, QTensor):
+            x = x.dequantize()
+        lora_output = self.lora_up(self.lora_down(x.to(self.lora_down.weight.dtype)))
+        return torch.add(org_forwarded, lora_output.to(org_forwarded.dtype), alpha=self.fused_scale)
+
+    def can_fuse_forward(self: Module) -> bool:
+        # plain linear lora with nothing that changes the forward between calls
+        if self.__class__.__name__ != "LoRAModule" or not isinstance(self.lora_down, nn.Linear):
+            return False
+        if getattr(self, 'lora_mid', None) is not None or isinstance(getattr(self, 'scalar', None), nn.Parameter):
+            return False
+        if isinstance(self.dropout, nn.Module) or self.dropout:
+            return False
+        return not self.rank_dropout and not self.module_dropout
+
+    def set_forward_impl(self: Module, bypass: bool, uniform_multiplier: Optional[float]):
+        if self.network_ref().is_lorm:
+            self.forward_impl = ToolkitModuleMixin.unfused_forward
+        elif bypass:
+            self.forward_impl = ToolkitModuleMixin.bypass_forward
+        elif uniform_multiplier is not None and self.can_fuse_forward():
+            scale = self.scale
+            if hasattr(self, 'scalar'):
+                scale = scale * float(self.scalar)
+            self.fused_scale = float(scale * uniform_multiplier)
+            self.forward_impl = ToolkitModuleMixin.fused_forward
+        else:
+            self.forward_impl = ToolkitModuleMixin.unfused_forward
+
+    def unfused_forward(self: Module, x, *args, **kwargs):
         skip = False
         network: Network = self.network_ref()
         if network.is_lorm:
@@ -305,6 +366,8 @@ class ToolkitModuleMixin:
             raise e
         return x
 
+    forward_impl = staticmethod(unfused_forward)
+
     def enable_gradient_checkpointing(self: Module):
         self.is_checkpointing = True
 
@@ -313,49 +376,35 @@ class ToolkitModuleMixin:
 
     @torch.no_grad()
     def merge_out(self: Module, merge_out_weight=1.0):
+        if self.pre_merge_weight is not None:
+            # quantized, restore the exact weight from before the merge instead of subtracting
+            org_module = self.org_module[0]
+            device = org_module.weight.device
+            org_module.weight = torch.nn.Parameter(self.pre_merge_weight.to(device), requires_grad=False)
+            self.pre_merge_weight = None
+            return
         # make sure it is positive
         merge_out_weight = abs(merge_out_weight)
         # merging out is just merging in the negative of the weight
         self.merge_in(merge_weight=-merge_out_weight)
 
-    @torch.no_grad()
-    def merge_in(self: Module, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
-        # get up/down weight
+    def get_merge_delta(self: Module, weight: torch.Tensor, multiplier=1.0) -> torch.Tensor:
+        # the change merging in the lora makes to weight, in float32
         up_weight = self.lora_up.weight.clone().float()
         down_weight = self.lora_down.weight.clone().float()
 
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        multiplier = merge_weight
         scale = self.scale
         # handle trainable scaler method locon does
         if hasattr(self, 'scalar'):
             scale = scale * self.scalar
 
-        # merge weight
         if len(weight.size()) == 2:
             # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
+            return multiplier * (up_weight @ down_weight) * scale
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
+            return (
+                    multiplier
                     * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
                     * scale
             )
@@ -363,11 +412,52 @@ class ToolkitModuleMixin:
             # conv2d 3x3
             conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
             # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+            return multiplier * conved * scale
+
+    @torch.no_grad()
+    def merge_in(self: Module, merge_weight=1.0):
+        if not self.can_merge_in:
+            return
+
+        org_module = self.org_module[0]
+        if isinstance(org_module.weight, QTensor):
+            self.merge_in_quantized(merge_weight)
+            return
+
+        # extract weight from org_module
+        org_sd = org_module.state_dict()
+        weight_key = "weight"
+
+        orig_dtype = org_sd[weight_key].dtype
+        weight = org_sd[weight_key].float()
+
+        # merge weight
+        weight = weight + self.get_merge_delta(weight, merge_weight)
 
         # set weight to org_module
         org_sd[weight_key] = weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+        org_module.load_state_dict(org_sd)
+
+    @torch.no_grad()
+    def merge_in_quantized(self: Module, merge_weight=1.0):
+        # dequantize, add the lora and quantize again with the module's own qtype. The quantized weight
+        # from before is parked on the cpu so merging out is exact and does not hold a second copy in vram
+        org_module = self.org_module[0]
+        quantized_weight = org_module.weight
+        weight = quantized_weight.dequantize().float()
+        weight = weight + self.get_merge_delta(weight, merge_weight)
+        org_module.weight = torch.nn.Parameter(weight.to(quantized_weight.dtype), requires_grad=False)
+        del weight
+        # quantizes the float weight we just set
+        org_module.freeze()
+        # keep the quantized weight from before on the device so merging out is exact and free. Only park it
+        # on the cpu when there is no longer room for it plus the float temporaries of merging the next layer
+        pre_merge_weight = quantized_weight.detach()
+        if pre_merge_weight.device.type == 'cuda':
+            free_bytes, _ = torch.cuda.mem_get_info(pre_merge_weight.device)
+            if free_bytes < get_quantized_weight_bytes(pre_merge_weight) + pre_merge_weight.numel() * 8:
+                pre_merge_weight = pre_merge_weight.to('cpu')
+        self.pre_merge_weight = pre_merge_weight
 
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
@@ -405,6 +495,8 @@ class ToolkitNetworkMixin:
         self.train_unet = train_unet
         self.is_checkpointing = False
         self._multiplier: float = 1.0
+        self._is_active: bool = False
+        self._is_merged_in: bool = False
         self.is_active: bool = False
         self.is_sdxl = is_sdxl
         self.is_ssd = is_ssd
@@ -417,8 +509,11 @@ class ToolkitNetworkMixin:
         self.module_losses: List[torch.Tensor] = []
         self.lorm_train_mode: Literal['local', None] = None
         self.can_merge_in = not is_lorm
+        # state dict key -> saved key, see get_save_key
+        self._save_key_cache: Dict[tuple, Optional[str]] = {}
 
-    def get_keymap(self: Network, force_weight_mapping=False):
+    def get_keymap(self: Network, force_weight_mapping=False, inverted=False):
+        # the keymap is shared between callers, do not modify it
         use_weight_mapping = False
 
         if self.is_ssd:
@@ -446,96 +541,104 @@ class ToolkitNetworkMixin:
 
         keymap_path = os.path.join(KEYMAPS_ROOT, keymap_name)
 
-        keymap = None
-        # check if file exists
-        if os.path.exists(keymap_path):
-            with open(keymap_path, 'r') as f:
-                keymap = json.load(f)['ldm_diffusers_keymap']
-
-        if use_weight_mapping and keymap is not None:
-            # get keymap from weights
-            keymap = get_lora_keymap_from_model_keymap(keymap)
-
-        # upgrade keymaps for DoRA
-        if self.network_type.lower() == 'dora':
-            if keymap is not None:
-                new_keymap = {}
-                for ldm_key, diffusers_key in keymap.items():
-                    ldm_key = ldm_key.replace('.alpha', '.magnitude')
-                    # ldm_key = ldm_key.replace('.lora_down.weight', '.lora_down')
-                    # ldm_key = ldm_key.replace('.lora_up.weight', '.lora_up')
-
-                    diffusers_key = diffusers_key.replace('.alpha', '.magnitude')
-                    # diffusers_key = diffusers_key.replace('.lora_down.weight', '.lora_down')
-                    # diffusers_key = diffusers_key.replace('.lora_up.weight', '.lora_up')
-
-                    new_keymap[ldm_key] = diffusers_key
-
-                keymap = new_keymap
-
+        keymap, inverted_keymap = get_network_keymap(
+            keymap_path,
+            use_weight_mapping=use_weight_mapping,
+            is_dora=self.network_type.lower() == 'dora'
+        )
+        if inverted:
+            return inverted_keymap
         return keymap
 
-    def save_weights(
-            self: Network,
-            file, dtype=torch.float16,
-            metadata=None,
-            extra_state_dict: Optional[OrderedDict] = None
-    ):
-        keymap = self.get_keymap()
+    def get_save_key(self: Network, key: str, use_keymap: bool = True) -> Optional[str]:
+        # converts a state dict key to the key it is saved as, None if it is not saved.
+        # The network keys do not change, so they are only converted once
+        cache_key = (key, use_keymap)
+        if cache_key in self._save_key_cache:
+            return self._save_key_cache[cache_key]
+        save_key = key
+        if use_keymap:
+            save_keymap = self.get_keymap(inverted=True)
+            if save_keymap is not None and key in save_keymap:
+                save_key = save_keymap[key]
 
-        save_keymap = {}
-        if keymap is not None:
-            for ldm_key, diffusers_key in keymap.items():
-                #  invert them
-                save_keymap[diffusers_key] = ldm_key
+        if self.peft_format:
+            # lora_down = lora_A
+            # lora_up = lora_B
+            # no alpha
+            if save_key.endswith('.alpha'):
+                save_key = None
+            else:
+                save_key = save_key.replace('lora_down', 'lora_A')
+                save_key = save_key.replace('lora_up', 'lora_B')
+                # replace all $$ with .
+                save_key = save_key.replace('$$', '.')
 
-        if metadata is not None and len(metadata) == 0:
-            metadata = None
+        self._save_key_cache[cache_key] = save_key
+        return save_key
 
+    def get_save_dict(
+            self: Network,
+            dtype=torch.float16,
+            extra_state_dict: Optional[OrderedDict] = None,
+            to_pinned_memory: bool = False
+    ) -> OrderedDict:
         state_dict = self.state_dict()
         save_dict = OrderedDict()
 
         for key in list(state_dict.keys()):
+            save_key = self.get_save_key(key)
+            if save_key is None:
+                del state_dict[key]
+                continue
             v = state_dict[key]
-            v = v.detach().clone().to("cpu").to(dtype)
-            save_key = save_keymap[key] if key in save_keymap else key
+            if to_pinned_memory:
+                # copied to host all at once below
+                v = v.detach().to(dtype)
+            else:
+                v = v.detach().clone().to("cpu").to(dtype)
             save_dict[save_key] = v
             del state_dict[key]
 
         if extra_state_dict is not None:
-            # add extra items to state dict
+            # add extra items to state dict, they are not in the keymap
             for key in list(extra_state_dict.keys()):
+                save_key = self.get_save_key(key, use_keymap=False)
+                if save_key is None:
+                    continue
                 v = extra_state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
-                save_dict[key] = v
-
-        if self.peft_format:
-            # lora_down = lora_A
-            # lora_up = lora_B
-            # no alpha
+                if to_pinned_memory:
+                    v = v.detach().to(dtype)
+                else:
+                    v = v.detach().clone().to("cpu").to(dtype)
+                save_dict[save_key] = v
 
-            new_save_dict = {}
-            for key, value in save_dict.items():
-                if key.endswith('.alpha'):
-                    continue
-                new_key = key
-                new_key = new_key.replace('lora_down', 'lora_A')
-                new_key = new_key.replace('lora_up', 'lora_B')
-                # replace all $$ with .
-                new_key = new_key.replace('$$', '.')
-                new_save_dict[new_key] = value
+        if to_pinned_memory:
+            save_dict = snapshot_to_cpu(save_dict)
 
-            save_dict = new_save_dict
+        return save_dict
 
-        if metadata is None:
+    @staticmethod
+    def write_weights(save_dict: OrderedDict, file, metadata=None):
+        # does not touch the network, so it is safe to call from a background thread
+        if metadata is None or len(metadata) == 0:
             metadata = OrderedDict()
-        metadata = add_model_hash_to_meta(state_dict, metadata)
+        metadata = add_model_hash_to_meta(save_dict, metadata)
         if os.path.splitext(file)[1] == ".safetensors":
             from safetensors.torch import save_file
             save_file(save_dict, file, metadata)
         else:
             torch.save(save_dict, file)
 
+    def save_weights(
+            self: Network,
+            file, dtype=torch.float16,
+            metadata=None,
+            extra_state_dict: Optional[OrderedDict] = None
+    ):
+        save_dict = self.get_save_dict(dtype=dtype, extra_state_dict=extra_state_dict)
+        self.write_weights(save_dict, file, metadata)
+
     def load_weights(self: Network, file, force_weight_mapping=False):
         # allows us to save and load to and from ldm weights
         keymap = self.get_keymap(force_weight_mapping)
@@ -615,6 +718,36 @@ class ToolkitNetworkMixin:
                 tensor_multiplier = multiplier.clone().detach().to(device, dtype=dtype)
 
             self.torch_multiplier = tensor_multiplier.clone().detach()
+        self._update_module_forwards()
+
+    @property
+    def is_active(self) -> bool:
+        return self._is_active
+
+    @is_active.setter
+    def is_active(self, value: bool):
+        if value == self._is_active:
+            return
+        self._is_active = value
+        self._update_module_forwards()
+
+    @property
+    def is_merged_in(self) -> bool:
+        return self._is_merged_in
+
+    @is_merged_in.setter
+    def is_merged_in(self, value: bool):
+        if value == self._is_merged_in:
+            return
+        self._is_merged_in = value
+        self._update_module_forwards()
+
+    def _update_module_forwards(self: Network):
+        # pick each module's forward once here instead of checking the network state on every call
+        uniform_multiplier = get_uniform_multiplier(self._multiplier)
+        bypass = not self._is_active or self._is_merged_in or uniform_multiplier == 0
+        for module in self.get_all_modules():
+            module.set_forward_impl(bypass, uniform_multiplier)
 
     @property
     def multiplier(self) -> Union[float, List[float], List[List[float]]]:
@@ -647,6 +780,13 @@ class ToolkitNetworkMixin:
         for lora in loras:
             lora.to(device, dtype)
 
+    def remove_from_model(self: Network):
+        # undoes apply_to. Restores whatever forward was there before, which may be another network
+        for module in self.get_all_modules():
+            if hasattr(module, 'org_forward'):
+                module.org_module[0].forward = module.org_forward
+                del module.org_forward
+
     def get_all_modules(self: Network) -> List[Module]:
         loras = []
         if hasattr(self, 'unet_loras'):
@@ -672,6 +812,10 @@ class ToolkitNetworkMixin:
         self.is_checkpointing = False
         self._update_checkpointing()
 
+    @property
+    def has_quantized_modules(self: Network) -> bool:
+        return any([isinstance(module.org_module[0].weight, QTensor) for module in self.get_all_modules()])
+
     def merge_in(self, merge_weight=1.0):
         if self.network_type.lower() == 'dora':
             return
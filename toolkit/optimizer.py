@@ -78,3 +78,17 @@ def get_optimizer(
     else:
         raise ValueError(f'Unknown optimizer type {optimizer_type}')
     return optimizer
+
+
+def zero_non_finite_grads(params):
+    # a nan loss leaves nan in the grads of every param it reached. Zeroing them on the device
+    # turns the step into a no op for those params without waiting on the gpu to check the loss.
+    # params can be a list of tensors or a list of param groups
+    grads = []
+    for param in params:
+        group_params = param['params'] if isinstance(param, dict) else [param]
+        for group_param in group_params:
+            if group_param.grad is not None:
+                grads.append(group_param.grad)
+    for grad in grads:
+        torch.nan_to_num_(grad, nan=0.0, posinf=0.0, neginf=0.0)
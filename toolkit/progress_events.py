@@ -0,0 +1,47 @@
+import json
+import os
+import threading
+import time
+from typing import Union
+
+# when set, the trainer writes json lines progress events to this file descriptor
+PROGRESS_FD_ENV = 'AITK_PROGRESS_FD'
+
+
+class ProgressEventWriter:
+    def __init__(self, fd: Union[int, None] = None):
+        self.file = None
+        self.lock = threading.Lock()
+        if fd is not None:
+            # line buffered so every event reaches the reader as soon as it is written
+            self.file = os.fdopen(fd, 'w', buffering=1)
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def emit(self, event: str, **data):
+        if self.file is None:
+            return
+        line = json.dumps({'event': event, 'time': time.time(), **data}, default=str)
+        with self.lock:
+            try:
+                self.file.write(line + '\n')
+            except (BrokenPipeError, OSError):
+                # reader went away, training should not die because of it
+                self.file = None
+
+
+_progress_event_writer: Union[ProgressEventWriter, None] = None
+
+
+def get_progress_event_writer() -> ProgressEventWriter:
+    global _progress_event_writer
+    if _progress_event_writer is None:
+        fd = os.environ.get(PROGRESS_FD_ENV, None)
+        _progress_event_writer = ProgressEventWriter(int(fd) if fd is not None else None)
+    return _progress_event_writer
+
+
+def emit_progress_event(event: str, **data):
+    get_progress_event_writer().emit(event, **data)
@@ -1,4 +1,8 @@
+import base64
+import hashlib
+import json
 import os
+from collections import OrderedDict
 from typing import Optional, TYPE_CHECKING, List, Union, Tuple
 
 import torch
@@ -130,12 +134,45 @@ class EncodedPromptPair:
         return self
 
 
+def pad_prompt_embeds(prompt_embeds: PromptEmbeds, length: int) -> PromptEmbeds:
+    # zero pad the text embeds and attention mask on the sequence dim up to length. Embeds without a mask
+    # get one so they can be concatenated with masked ones
+    pad_len = max(0, length - prompt_embeds.text_embeds.shape[1])
+    if pad_len == 0 and prompt_embeds.attention_mask is not None:
+        return prompt_embeds
+    attention_mask = prompt_embeds.attention_mask
+    if attention_mask is None:
+        attention_mask = torch.ones(prompt_embeds.text_embeds.shape[:2], device=prompt_embeds.text_embeds.device)
+    padded = prompt_embeds.clone()
+    padded.text_embeds = torch.nn.functional.pad(prompt_embeds.text_embeds, (0, 0, 0, pad_len))
+    padded.attention_mask = torch.nn.functional.pad(attention_mask, (0, pad_len), value=0)
+    return padded
+
+
+def trim_prompt_embeds_padding(prompt_embeds: PromptEmbeds) -> PromptEmbeds:
+    # drop padding every prompt in the batch has, leaving the longest prompt unpadded
+    if prompt_embeds.attention_mask is None:
+        return prompt_embeds
+    length = max(int(prompt_embeds.attention_mask.sum(dim=1).max()), 1)
+    trimmed = prompt_embeds.clone()
+    trimmed.text_embeds = trimmed.text_embeds[:, :length]
+    trimmed.attention_mask = trimmed.attention_mask[:, :length]
+    return trimmed
+
+
 def concat_prompt_embeds(prompt_embeds: list[PromptEmbeds]):
+    if any([p.attention_mask is not None for p in prompt_embeds]):
+        # embeds encoded with a dynamic text length can have different lengths, pad them to the longest
+        max_length = max([p.text_embeds.shape[1] for p in prompt_embeds])
+        prompt_embeds = [pad_prompt_embeds(p, max_length) for p in prompt_embeds]
     text_embeds = torch.cat([p.text_embeds for p in prompt_embeds], dim=0)
     pooled_embeds = None
     if prompt_embeds[0].pooled_embeds is not None:
         pooled_embeds = torch.cat([p.pooled_embeds for p in prompt_embeds], dim=0)
-    return PromptEmbeds([text_embeds, pooled_embeds])
+    attention_mask = None
+    if prompt_embeds[0].attention_mask is not None:
+        attention_mask = torch.cat([p.attention_mask for p in prompt_embeds], dim=0)
+    return PromptEmbeds([text_embeds, pooled_embeds], attention_mask=attention_mask)
 
 
 def concat_prompt_pairs(prompt_pairs: list[EncodedPromptPair]):
@@ -241,6 +278,107 @@ class PromptEmbedsCache:
             return None
 
 
+class TextEmbeddingCache:
+    """
+    Disk backed cache of encoded prompts. Each prompt is encoded once and saved as a safetensors file
+    keyed by a hash of the prompt and the tokenizer / text encoder identity. Once everything is cached,
+    the text encoders are not needed for training and can be moved off of the gpu.
+    """
+
+    # increment this if we change the embedding format to invalidate the cache
+    text_embedding_version = 1
+
+    def __init__(self, sd: 'StableDiffusion'):
+        self.sd = sd
+        self.prompts: dict[str, PromptEmbeds] = {}
+
+    def __contains__(self, prompt: str) -> bool:
+        return prompt in self.prompts
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def get_text_embedding_info_dict(self, prompt: str):
+        tokenizers = self.sd.tokenizer if isinstance(self.sd.tokenizer, list) else [self.sd.tokenizer]
+        text_encoders = self.sd.text_encoder if isinstance(self.sd.text_encoder, list) else [self.sd.text_encoder]
+        item = OrderedDict([
+            ("prompt", prompt),
+            ("name_or_path", self.sd.model_config.name_or_path),
+            ("tokenizers", [
+                f"{tokenizer.__class__.__name__}:{getattr(tokenizer, 'name_or_path', '')}" for tokenizer in tokenizers
+            ]),
+            ("text_encoders", [
+                f"{te.__class__.__name__}:{getattr(te.config, '_name_or_path', '')}" for te in text_encoders
+            ]),
+            ("te_dtype", str(self.sd.te_torch_dtype)),
+            ("attn_masking", self.sd.model_config.attn_masking),
+            ("text_embedding_version", self.text_embedding_version),
+        ])
+        if self.sd.model_config.dynamic_text_length:
+            item["text_length_buckets"] = self.sd.model_config.text_length_buckets
+        return item
+
+    def get_text_embedding_path(self, prompt: str, cache_dir: str):
+        hash_dict = self.get_text_embedding_info_dict(prompt)
+        # get base64 hash of md5 checksum of hash_dict
+        hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        hash_str = hash_str.replace('=', '')
+        return os.path.join(cache_dir, f'{hash_str}.safetensors')
+
+    @torch.no_grad()
+    def cache_prompts(self, prompt_list: List[str], cache_dir: str):
+        # the empty prompt is always needed for caption dropout
+        prompt_list = list(dict.fromkeys([""] + prompt_list))
+        os.makedirs(cache_dir, exist_ok=True)
+        num_encoded = 0
+        for prompt in tqdm(prompt_list, desc="Caching text embeddings", leave=False):
+            if prompt in self.prompts:
+                continue
+            embedding_path = self.get_text_embedding_path(prompt, cache_dir)
+            if os.path.exists(embedding_path):
+                state_dict = load_file(embedding_path, device='cpu')
+                prompt_embeds = PromptEmbeds(
+                    [state_dict['text_embeds'], state_dict.get('pooled_embeds', None)],
+                    attention_mask=state_dict.get('attention_mask', None)
+                )
+            else:
+                prompt_embeds = self.sd.encode_prompt(prompt).detach().to('cpu')
+                state_dict = OrderedDict([
+                    ('text_embeds', prompt_embeds.text_embeds.contiguous()),
+                ])
+                if prompt_embeds.pooled_embeds is not None:
+                    state_dict['pooled_embeds'] = prompt_embeds.pooled_embeds.contiguous()
+                if prompt_embeds.attention_mask is not None:
+                    state_dict['attention_mask'] = prompt_embeds.attention_mask.contiguous()
+                meta = OrderedDict([
+                    ('format', 'pt'),
+                    ('prompt', prompt),
+                ])
+                save_file(state_dict, embedding_path, metadata=meta)
+                num_encoded += 1
+            self.prompts[prompt] = prompt_embeds
+        return num_encoded
+
+    def encode_prompt(self, prompt, dropout_prob=0.0) -> PromptEmbeds:
+        # mirrors StableDiffusion.encode_prompt, but pulls from the cache
+        if not isinstance(prompt, list):
+            prompt = [prompt]
+        if dropout_prob > 0.0:
+            # randomly drop out prompts
+            prompt = [
+                p if torch.rand(1).item() > dropout_prob else "" for p in prompt
+            ]
+        embeds_list = []
+        for p in prompt:
+            if p not in self.prompts:
+                # should not happen unless the captions changed. Encode it with whatever device the te is on
+                print(f"Warning: prompt not found in text embedding cache, encoding it now: {p}")
+                self.prompts[p] = self.sd.encode_prompt(p).detach().to('cpu')
+            embeds_list.append(self.prompts[p])
+        return concat_prompt_embeds(embeds_list)
+
+
 class EncodedAnchor:
     def __init__(
             self,
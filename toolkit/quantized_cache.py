@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable
+
+import torch
+from optimum.quanto import quantization_map, requantize
+from safetensors.torch import load_file, save_model
+
+# cache of quantized model weights so quantization (and any fused lora) only happens once per base model
+
+WEIGHTS_NAME = 'model.safetensors'
+QUANTIZATION_MAP_NAME = 'quantization_map.json'
+# bump to invalidate every cache entry if the format changes
+QUANTIZED_CACHE_VERSION = 1
+
+
+def get_model_revision(name_or_path: str) -> str:
+    if os.path.exists(name_or_path):
+        # local models are identified by path and the size and mtime of every file in them. The folder
+        # mtime does not change when a file inside it is replaced
+        return f"local:{os.path.abspath(name_or_path)}:{get_local_model_hash(name_or_path)}"
+    # hub models, use the commit we have in the local hub cache
+    from huggingface_hub.constants import HF_HUB_CACHE
+    ref_path = os.path.join(HF_HUB_CACHE, f"models--{name_or_path.replace('/', '--')}", 'refs', 'main')
+    if os.path.exists(ref_path):
+        with open(ref_path, 'r') as f:
+            return f"hub:{name_or_path}:{f.read().strip()}"
+    return f"hub:{name_or_path}"
+
+
+def get_local_model_hash(path: str) -> str:
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = []
+        for root, _, filenames in os.walk(path):
+            files.extend(os.path.join(root, filename) for filename in filenames)
+        files.sort()
+    md5 = hashlib.md5()
+    for file in files:
+        stat = os.stat(file)
+        md5.update(f"{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime}\n".encode('utf-8'))
+    return md5.hexdigest()
+
+
+def get_file_hash(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_quantized_cache_path(cache_dir: str, name: str, **key_items) -> str:
+    key = OrderedDict([
+        ("name", name),
+        ("version", QUANTIZED_CACHE_VERSION),
+        ("torch", torch.__version__),
+        *sorted(key_items.items()),
+    ])
+    # get base64 hash of md5 checksum of the key
+    hash_input = json.dumps(key, sort_keys=True, default=str).encode('utf-8')
+    hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii').replace('=', '')
+    return os.path.join(cache_dir, f"{name}_{hash_str}")
+
+
+def quantized_cache_exists(cache_path: str) -> bool:
+    return os.path.exists(os.path.join(cache_path, WEIGHTS_NAME)) and \
+        os.path.exists(os.path.join(cache_path, QUANTIZATION_MAP_NAME))
+
+
+def save_quantized_model(model: torch.nn.Module, cache_path: str):
+    # write to a temp folder and rename so an interrupted save is never picked up
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path, exist_ok=True)
+    # save_model drops tied weights that save_file would refuse
+    save_model(model, os.path.join(tmp_path, WEIGHTS_NAME), force_contiguous=True)
+    with open(os.path.join(tmp_path, QUANTIZATION_MAP_NAME), 'w') as f:
+        json.dump(quantization_map(model), f)
+    # keep the config so the model can be rebuilt without the original files
+    if hasattr(model, 'save_config'):
+        # diffusers
+        model.save_config(tmp_path)
+    else:
+        # transformers
+        model.config.save_pretrained(tmp_path)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+
+
+@contextmanager
+def _default_dtype(dtype: torch.dtype):
+    prev_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(dtype)
+    try:
+        yield
+    finally:
+        torch.set_default_dtype(prev_dtype)
+
+
+def load_quantized_model(
+        build_model: Callable[[str], torch.nn.Module],
+        cache_path: str,
+        device: torch.device,
+        dtype: torch.dtype
+) -> torch.nn.Module:
+    # build_model gets the cache path to read the saved config from. The model is built on the meta
+    # device so nothing is allocated until the quantized weights are loaded in
+    with torch.device('meta'), _default_dtype(dtype):
+        model = build_model(cache_path)
+    # memory mapped, tensors are only read when they are copied to the device
+    state_dict = load_file(os.path.join(cache_path, WEIGHTS_NAME), device='cpu')
+    with open(os.path.join(cache_path, QUANTIZATION_MAP_NAME), 'r') as f:
+        qmap = json.load(f)
+    # requantize makes full precision placeholders for every param on the device it is given before
+    # loading the quantized weights in. On the cpu those pages are never touched, on the gpu it would
+    # allocate the whole unquantized model. So load on the cpu and only move the quantized model over
+    requantize(model, state_dict, qmap, device=torch.device('cpu'))
+    del state_dict
+    model.to(device)
+    model.eval()
+    model.requires_grad_(False)
+    return model
@@ -4,6 +4,8 @@ from typing import Union
 from diffusers import FlowMatchEulerDiscreteScheduler
 import torch
 
+from toolkit.train_tools import get_timestep_indices
+
 
 class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
     def __init__(self, *args, **kwargs):
@@ -37,16 +39,23 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
             self.linear_timesteps = timesteps
             self.linear_timesteps_weights = bsmntw_weighing
             self.linear_timesteps_weights2 = hbsmntw_weighing
+            # train schedules only depend on the step count, device and type, so they are built once
+            self._train_timesteps_cache = {}
             pass
 
     def get_weights_for_timesteps(self, timesteps: torch.Tensor, v2=False) -> torch.Tensor:
         # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(self.timesteps, timesteps)
 
-        # Get the weights for the timesteps
+        # Get the weights for the timesteps. Keep the table on the device of the timesteps so it
+        # is not copied over every step
         if v2:
+            if self.linear_timesteps_weights2.device != step_indices.device:
+                self.linear_timesteps_weights2 = self.linear_timesteps_weights2.to(step_indices.device)
             weights = self.linear_timesteps_weights2[step_indices].flatten()
         else:
+            if self.linear_timesteps_weights.device != step_indices.device:
+                self.linear_timesteps_weights = self.linear_timesteps_weights.to(step_indices.device)
             weights = self.linear_timesteps_weights[step_indices].flatten()
 
         return weights
@@ -55,7 +64,7 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
         sigmas = self.sigmas.to(device=device, dtype=dtype)
         schedule_timesteps = self.timesteps.to(device)
         timesteps = timesteps.to(device)
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(schedule_timesteps, timesteps)
 
         sigma = sigmas[step_indices].flatten()
         while len(sigma.shape) < n_dim:
@@ -90,21 +99,21 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
         return sample
 
     def set_train_timesteps(self, num_timesteps, device, linear=False):
-        if linear:
-            timesteps = torch.linspace(1000, 0, num_timesteps, device=device)
-            self.timesteps = timesteps
-            return timesteps
-        else:
-            # distribute them closer to center. Inference distributes them as a bias toward first
-            # Generate values from 0 to 1
-            t = torch.sigmoid(torch.randn((num_timesteps,), device=device))
-
-            # Scale and reverse the values to go from 1000 to 0
-            timesteps = ((1 - t) * 1000)
-
-            # Sort the timesteps in descending order
-            timesteps, _ = torch.sort(timesteps, descending=True)
-
-            self.timesteps = timesteps.to(device=device)
-
-            return timesteps
+        cache_key = (num_timesteps, str(device), linear)
+        if cache_key not in self._train_timesteps_cache:
+            if linear:
+                timesteps = torch.linspace(1000, 0, num_timesteps, device=device)
+            else:
+                # distribute them closer to center. Inference distributes them as a bias toward first.
+                # Use evenly spaced quantiles of sigmoid(randn) instead of drawing and sorting a new random
+                # schedule every step. Indices are sampled uniformly, so the timesteps follow the same distribution
+                quantiles = (torch.arange(num_timesteps, dtype=torch.float64) + 0.5) / num_timesteps
+                t = torch.sigmoid(torch.special.ndtri(quantiles))
+
+                # Scale and reverse the values to go from 1000 to 0, already sorted in descending order
+                timesteps = ((1 - t) * 1000).to(device=device, dtype=torch.float32)
+            self._train_timesteps_cache[cache_key] = timesteps
+
+        timesteps = self._train_timesteps_cache[cache_key]
+        self.timesteps = timesteps
+        return timesteps
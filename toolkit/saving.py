@@ -1,7 +1,9 @@
 import json
 import os
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Literal, Optional, Union
+from functools import lru_cache
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Literal, Mapping, Optional, Tuple, Union
 
 import torch
 from safetensors.torch import load_file, save_file
@@ -13,12 +15,42 @@ if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
 
 
+@lru_cache(maxsize=None)
 def get_slices_from_string(s: str) -> tuple:
     slice_strings = s.split(',')
     slices = [eval(f"slice({component.strip()})") for component in slice_strings]
     return tuple(slices)
 
 
+def freeze_mapping(value: Any) -> Any:
+    # read only view of parsed json, for results that are cached and shared between callers
+    if isinstance(value, dict):
+        return MappingProxyType(type(value)((k, freeze_mapping(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze_mapping(v) for v in value)
+    return value
+
+
+class KeymapMapping:
+    # a parsed keymap json, read only
+    def __init__(self, mapping: 'OrderedDict'):
+        self.ldm_diffusers_keymap: Mapping[str, str] = freeze_mapping(mapping['ldm_diffusers_keymap'])
+        self.ldm_diffusers_shape_map: Mapping[str, Any] = freeze_mapping(
+            mapping.get('ldm_diffusers_shape_map', {})
+        )
+        self.ldm_diffusers_operator_map: Mapping[str, Any] = freeze_mapping(
+            mapping.get('ldm_diffusers_operator_map', OrderedDict())
+        )
+
+
+@lru_cache(maxsize=None)
+def load_keymap_mapping(mapping_path: str) -> KeymapMapping:
+    # keymaps are large and never change while we run, only parse each one once
+    with open(mapping_path, 'r') as f:
+        mapping = json.load(f, object_pairs_hook=OrderedDict)
+    return KeymapMapping(mapping)
+
+
 def convert_state_dict_to_ldm_with_mapping(
         diffusers_state_dict: 'OrderedDict',
         mapping_path: str,
@@ -29,16 +61,15 @@ def convert_state_dict_to_ldm_with_mapping(
     converted_state_dict = OrderedDict()
 
     # load mapping
-    with open(mapping_path, 'r') as f:
-        mapping = json.load(f, object_pairs_hook=OrderedDict)
+    mapping = load_keymap_mapping(mapping_path)
 
     # keep track of keys not matched
-    ldm_matched_keys = []
-    diffusers_matched_keys = []
+    ldm_matched_keys = set()
+    diffusers_matched_keys = set()
 
-    ldm_diffusers_keymap = mapping['ldm_diffusers_keymap']
-    ldm_diffusers_shape_map = mapping['ldm_diffusers_shape_map']
-    ldm_diffusers_operator_map = mapping['ldm_diffusers_operator_map']
+    ldm_diffusers_keymap = mapping.ldm_diffusers_keymap
+    ldm_diffusers_shape_map = mapping.ldm_diffusers_shape_map
+    ldm_diffusers_operator_map = mapping.ldm_diffusers_operator_map
 
     # load base if it exists
     # the base just has come keys like timing ids and stuff diffusers doesn't have or they don't match
@@ -49,41 +80,38 @@ def convert_state_dict_to_ldm_with_mapping(
             converted_state_dict[key] = converted_state_dict[key].to(device, dtype=dtype)
 
     # process operators first
-    for ldm_key in ldm_diffusers_operator_map:
+    for ldm_key, operator in ldm_diffusers_operator_map.items():
         # if the key cat is in the ldm key, we need to process it
-        if 'cat' in ldm_diffusers_operator_map[ldm_key]:
+        if 'cat' in operator:
             cat_list = []
-            for diffusers_key in ldm_diffusers_operator_map[ldm_key]['cat']:
+            for diffusers_key in operator['cat']:
                 cat_list.append(diffusers_state_dict[diffusers_key].detach())
             converted_state_dict[ldm_key] = torch.cat(cat_list, dim=0).to(device, dtype=dtype)
-            diffusers_matched_keys.extend(ldm_diffusers_operator_map[ldm_key]['cat'])
-            ldm_matched_keys.append(ldm_key)
-        if 'slice' in ldm_diffusers_operator_map[ldm_key]:
-            tensor_to_slice = diffusers_state_dict[ldm_diffusers_operator_map[ldm_key]['slice'][0]]
-            slice_text = diffusers_state_dict[ldm_diffusers_operator_map[ldm_key]['slice'][1]]
+            diffusers_matched_keys.update(operator['cat'])
+            ldm_matched_keys.add(ldm_key)
+        if 'slice' in operator:
+            tensor_to_slice = diffusers_state_dict[operator['slice'][0]]
+            slice_text = diffusers_state_dict[operator['slice'][1]]
             converted_state_dict[ldm_key] = tensor_to_slice[get_slices_from_string(slice_text)].detach().to(device,
                                                                                                             dtype=dtype)
-            diffusers_matched_keys.extend(ldm_diffusers_operator_map[ldm_key]['slice'])
-            ldm_matched_keys.append(ldm_key)
+            diffusers_matched_keys.update(operator['slice'])
+            ldm_matched_keys.add(ldm_key)
 
     # process the rest of the keys
-    for ldm_key in ldm_diffusers_keymap:
+    for ldm_key, diffusers_key in ldm_diffusers_keymap.items():
         # if the key is in the ldm key, we need to process it
-        if ldm_diffusers_keymap[ldm_key] in diffusers_state_dict:
-            tensor = diffusers_state_dict[ldm_diffusers_keymap[ldm_key]].detach().to(device, dtype=dtype)
+        if diffusers_key in diffusers_state_dict:
+            tensor = diffusers_state_dict[diffusers_key].detach().to(device, dtype=dtype)
             # see if we need to reshape
             if ldm_key in ldm_diffusers_shape_map:
                 tensor = tensor.view(ldm_diffusers_shape_map[ldm_key][0])
             converted_state_dict[ldm_key] = tensor
-            diffusers_matched_keys.append(ldm_diffusers_keymap[ldm_key])
-            ldm_matched_keys.append(ldm_key)
+            diffusers_matched_keys.add(diffusers_key)
+            ldm_matched_keys.add(ldm_key)
 
-    # see if any are missing from know mapping
-    mapped_diffusers_keys = list(ldm_diffusers_keymap.values())
-    mapped_ldm_keys = list(ldm_diffusers_keymap.keys())
-
-    missing_diffusers_keys = [x for x in mapped_diffusers_keys if x not in diffusers_matched_keys]
-    missing_ldm_keys = [x for x in mapped_ldm_keys if x not in ldm_matched_keys]
+    # see if any are missing from know mapping, only once every match is known
+    missing_diffusers_keys = [x for x in ldm_diffusers_keymap.values() if x not in diffusers_matched_keys]
+    missing_ldm_keys = [x for x in ldm_diffusers_keymap.keys() if x not in ldm_matched_keys]
 
     if len(missing_diffusers_keys) > 0:
         print(f"WARNING!!!! Missing {len(missing_diffusers_keys)} diffusers keys")
@@ -276,6 +304,42 @@ def load_custom_adapter_model(
         return torch.load(path_to_file, map_location=device)
 
 
+@lru_cache(maxsize=None)
+def get_network_keymap(
+        keymap_path: str,
+        use_weight_mapping: bool = False,
+        is_dora: bool = False
+) -> Tuple[Optional[dict], Optional[dict]]:
+    # the ldm to diffusers keymap for a network and its inverse, built once per process.
+    # Shared between callers, so they are read only
+    if not os.path.exists(keymap_path):
+        return None, None
+    keymap = load_keymap_mapping(keymap_path).ldm_diffusers_keymap
+
+    if use_weight_mapping:
+        # get keymap from weights
+        keymap = get_lora_keymap_from_model_keymap(keymap)
+
+    # upgrade keymaps for DoRA
+    if is_dora:
+        new_keymap = {}
+        for ldm_key, diffusers_key in keymap.items():
+            ldm_key = ldm_key.replace('.alpha', '.magnitude')
+            # ldm_key = ldm_key.replace('.lora_down.weight', '.lora_down')
+            # ldm_key = ldm_key.replace('.lora_up.weight', '.lora_up')
+
+            diffusers_key = diffusers_key.replace('.alpha', '.magnitude')
+            # diffusers_key = diffusers_key.replace('.lora_down.weight', '.lora_down')
+            # diffusers_key = diffusers_key.replace('.lora_up.weight', '.lora_up')
+
+            new_keymap[ldm_key] = diffusers_key
+
+        keymap = new_keymap
+
+    inverted_keymap = {diffusers_key: ldm_key for ldm_key, diffusers_key in keymap.items()}
+    return MappingProxyType(dict(keymap)), MappingProxyType(inverted_keymap)
+
+
 def get_lora_keymap_from_model_keymap(model_keymap: 'OrderedDict') -> 'OrderedDict':
     lora_keymap = OrderedDict()
 
@@ -40,6 +40,7 @@ def get_train_sd_device_state_preset(
         train_adapter: bool = False,
         train_embedding: bool = False,
         train_refiner: bool = False,
+        cached_text_embeddings: bool = False,
 ):
     preset = copy.deepcopy(empty_preset)
     if not cached_latents:
@@ -56,6 +57,9 @@ def get_train_sd_device_state_preset(
         preset['text_encoder']['training'] = True
         preset['text_encoder']['requires_grad'] = True
         preset['text_encoder']['device'] = device
+    elif cached_text_embeddings:
+        # prompts are pulled from the cache, keep the text encoders off the gpu
+        preset['text_encoder']['device'] = 'cpu'
     else:
         preset['text_encoder']['device'] = device
 
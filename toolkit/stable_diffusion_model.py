@@ -8,6 +8,7 @@ from typing import Union, List, Literal, Iterator
 import sys
 import os
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import yaml
 from PIL import Image
@@ -31,11 +32,15 @@ from toolkit import train_tools
 from toolkit.config_modules import ModelConfig, GenerateImageConfig
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.paths import REPOS_ROOT, KEYMAPS_ROOT
-from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
+from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds, \
+    trim_prompt_embeds_padding
+from toolkit.quantized_cache import get_quantized_cache_path, get_model_revision, get_file_hash, \
+    quantized_cache_exists, load_quantized_model, save_quantized_model
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
-from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers
+from toolkit.models.flux import FluxInputCache, get_joint_attention_mask
+from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers, load_keymap_mapping
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 from einops import rearrange, repeat
@@ -53,7 +58,7 @@ from diffusers import \
     AutoencoderKL, \
     UNet2DConditionModel
 from diffusers import PixArtAlphaPipeline, DPMSolverMultistepScheduler, PixArtSigmaPipeline
-from transformers import T5EncoderModel, BitsAndBytesConfig, UMT5EncoderModel, T5TokenizerFast
+from transformers import T5EncoderModel, BitsAndBytesConfig, UMT5EncoderModel, T5TokenizerFast, T5Config
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextModelWithProjection
 
 from toolkit.paths import ORIG_CONFIGS_ROOT, DIFFUSERS_CONFIGS_ROOT
@@ -111,6 +116,12 @@ def flush():
     gc.collect()
 
 
+# rough peak memory per sample image pixel when sizing sample batches, mostly the vae decode
+SAMPLE_BYTES_PER_PIXEL = 2560
+# merging into quantized layers dequantizes and requantizes every one of them, only worth it when sampling
+# runs at least this many denoising steps in total. Below that the unmerged lora forward is cheaper
+QUANTIZED_MERGE_MIN_STEPS = 100
+
 UNET_IN_CHANNELS = 4  # Stable Diffusion の in_channels は 4 で固定。XLも同じ。
 # VAE_SCALE_FACTOR = 8  # 2 ** (len(vae.config.block_out_channels) - 1) = 8
 
@@ -172,6 +183,16 @@ class StableDiffusion:
         self.is_pixart = model_config.is_pixart
         self.is_auraflow = model_config.is_auraflow
         self.is_flux = model_config.is_flux
+        # flux ids and rotary embeddings per input shape
+        self.flux_input_cache = FluxInputCache()
+        # reused between sample calls. The trainer turns on prompt caching when nothing it trains
+        # changes the text encoding
+        self.cache_sample_prompt_embeds = False
+        self.sample_prompt_embeds_cache = {}
+        self.sample_latents_cache = {}
+        self.sample_pipeline = None
+        self.sample_pipeline_sampler = None
+        self.sample_save_pool = ThreadPoolExecutor(max_workers=4)
 
         self.use_text_encoder_1 = model_config.use_text_encoder_1
         self.use_text_encoder_2 = model_config.use_text_encoder_2
@@ -485,18 +506,6 @@ class StableDiffusion:
                 if os.path.exists(te_folder_path):
                     base_model_path = model_path
 
-            transformer = FluxTransformer2DModel.from_pretrained(
-                transformer_path,
-                subfolder=subfolder,
-                torch_dtype=dtype,
-                # low_cpu_mem_usage=False,
-                # device_map=None
-            )
-            if not self.low_vram:
-                # for low v ram, we leave it on the cpu. Quantizes slower, but allows training on primary gpu
-                transformer.to(torch.device(self.quantize_device), dtype=dtype)
-            flush()
-
             if self.model_config.assistant_lora_path is not None:
                 if self.model_config.lora_path:
                     raise ValueError("Cannot load both assistant lora and lora at the same time")
@@ -522,81 +531,118 @@ class StableDiffusion:
                 # trigger it to get merged in
                 self.model_config.lora_path = self.model_config.assistant_lora_path
 
-            if self.model_config.lora_path is not None:
-                print("Fusing in LoRA")
-                # need the pipe for peft
-                pipe: FluxPipeline = FluxPipeline(
-                    scheduler=None,
-                    text_encoder=None,
-                    tokenizer=None,
-                    text_encoder_2=None,
-                    tokenizer_2=None,
-                    vae=None,
-                    transformer=transformer,
+            # quantized weights are cached with any fused lora, so quantizing only happens once
+            transformer_cache_path = None
+            if self.model_config.quantize and self.model_config.quantized_cache_dir is not None:
+                transformer_cache_path = get_quantized_cache_path(
+                    self.model_config.quantized_cache_dir,
+                    'flux_transformer',
+                    revision=get_model_revision(model_path),
+                    quantization='qfloat8',
+                    dtype=dtype,
+                    lora_hash=get_file_hash(self.model_config.lora_path)
+                    if self.model_config.lora_path is not None else None,
                 )
-                if self.low_vram:
-                    # we cannot fuse the loras all at once without ooming in lowvram mode, so we have to do it in parts
-                    # we can do it on the cpu but it takes about 5-10 mins vs seconds on the gpu
-                    # we are going to separate it into the two transformer blocks one at a time
-
-                    lora_state_dict = load_file(self.model_config.lora_path)
-                    single_transformer_lora = {}
-                    single_block_key = "transformer.single_transformer_blocks."
-                    double_transformer_lora = {}
-                    double_block_key = "transformer.transformer_blocks."
-                    for key, value in lora_state_dict.items():
-                        if single_block_key in key:
-                            single_transformer_lora[key] = value
-                        elif double_block_key in key:
-                            double_transformer_lora[key] = value
-                        else:
-                            raise ValueError(f"Unknown lora key: {key}. Cannot load this lora in low vram mode")
 
-                    # double blocks
-                    transformer.transformer_blocks = transformer.transformer_blocks.to(
-                        torch.device(self.quantize_device), dtype=dtype
-                    )
-                    pipe.load_lora_weights(double_transformer_lora, adapter_name=f"lora1_double")
-                    pipe.fuse_lora()
-                    pipe.unload_lora_weights()
-                    transformer.transformer_blocks = transformer.transformer_blocks.to(
-                        'cpu', dtype=dtype
-                    )
+            if transformer_cache_path is not None and quantized_cache_exists(transformer_cache_path):
+                print(f"Loading quantized transformer from {transformer_cache_path}")
+                transformer = load_quantized_model(
+                    lambda path: FluxTransformer2DModel.from_config(FluxTransformer2DModel.load_config(path)),
+                    transformer_cache_path,
+                    device=self.device_torch,
+                    dtype=dtype
+                )
+            else:
+                transformer = FluxTransformer2DModel.from_pretrained(
+                    transformer_path,
+                    subfolder=subfolder,
+                    torch_dtype=dtype,
+                    # low_cpu_mem_usage=False,
+                    # device_map=None
+                )
+                if not self.low_vram:
+                    # for low v ram, we leave it on the cpu. Quantizes slower, but allows training on primary gpu
+                    transformer.to(torch.device(self.quantize_device), dtype=dtype)
+                flush()
 
-                    # single blocks
-                    transformer.single_transformer_blocks = transformer.single_transformer_blocks.to(
-                        torch.device(self.quantize_device), dtype=dtype
-                    )
-                    pipe.load_lora_weights(single_transformer_lora, adapter_name=f"lora1_single")
-                    pipe.fuse_lora()
-                    pipe.unload_lora_weights()
-                    transformer.single_transformer_blocks = transformer.single_transformer_blocks.to(
-                        'cpu', dtype=dtype
+                if self.model_config.lora_path is not None:
+                    print("Fusing in LoRA")
+                    # need the pipe for peft
+                    pipe: FluxPipeline = FluxPipeline(
+                        scheduler=None,
+                        text_encoder=None,
+                        tokenizer=None,
+                        text_encoder_2=None,
+                        tokenizer_2=None,
+                        vae=None,
+                        transformer=transformer,
                     )
+                    if self.low_vram:
+                        # we cannot fuse the loras all at once without ooming in lowvram mode, so we have to do it in parts
+                        # we can do it on the cpu but it takes about 5-10 mins vs seconds on the gpu
+                        # we are going to separate it into the two transformer blocks one at a time
+
+                        lora_state_dict = load_file(self.model_config.lora_path)
+                        single_transformer_lora = {}
+                        single_block_key = "transformer.single_transformer_blocks."
+                        double_transformer_lora = {}
+                        double_block_key = "transformer.transformer_blocks."
+                        for key, value in lora_state_dict.items():
+                            if single_block_key in key:
+                                single_transformer_lora[key] = value
+                            elif double_block_key in key:
+                                double_transformer_lora[key] = value
+                            else:
+                                raise ValueError(f"Unknown lora key: {key}. Cannot load this lora in low vram mode")
+
+                        # double blocks
+                        transformer.transformer_blocks = transformer.transformer_blocks.to(
+                            torch.device(self.quantize_device), dtype=dtype
+                        )
+                        pipe.load_lora_weights(double_transformer_lora, adapter_name=f"lora1_double")
+                        pipe.fuse_lora()
+                        pipe.unload_lora_weights()
+                        transformer.transformer_blocks = transformer.transformer_blocks.to(
+                            'cpu', dtype=dtype
+                        )
 
-                    # cleanup
-                    del single_transformer_lora
-                    del double_transformer_lora
-                    del lora_state_dict
-                    flush()
+                        # single blocks
+                        transformer.single_transformer_blocks = transformer.single_transformer_blocks.to(
+                            torch.device(self.quantize_device), dtype=dtype
+                        )
+                        pipe.load_lora_weights(single_transformer_lora, adapter_name=f"lora1_single")
+                        pipe.fuse_lora()
+                        pipe.unload_lora_weights()
+                        transformer.single_transformer_blocks = transformer.single_transformer_blocks.to(
+                            'cpu', dtype=dtype
+                        )
 
-                else:
-                    # need the pipe to do this unfortunately for now
-                    # we have to fuse in the weights before quantizing
-                    pipe.load_lora_weights(self.model_config.lora_path, adapter_name="lora1")
-                    pipe.fuse_lora()
-                    # unfortunately, not an easier way with peft
-                    pipe.unload_lora_weights()
-            flush()
+                        # cleanup
+                        del single_transformer_lora
+                        del double_transformer_lora
+                        del lora_state_dict
+                        flush()
 
-            if self.model_config.quantize:
-                quantization_type = qfloat8
-                print("Quantizing transformer")
-                quantize(transformer, weights=quantization_type)
-                freeze(transformer)
-                transformer.to(self.device_torch)
-            else:
-                transformer.to(self.device_torch, dtype=dtype)
+                    else:
+                        # need the pipe to do this unfortunately for now
+                        # we have to fuse in the weights before quantizing
+                        pipe.load_lora_weights(self.model_config.lora_path, adapter_name="lora1")
+                        pipe.fuse_lora()
+                        # unfortunately, not an easier way with peft
+                        pipe.unload_lora_weights()
+                flush()
+
+                if self.model_config.quantize:
+                    quantization_type = qfloat8
+                    print("Quantizing transformer")
+                    quantize(transformer, weights=quantization_type)
+                    freeze(transformer)
+                    if transformer_cache_path is not None:
+                        print(f"Saving quantized transformer to {transformer_cache_path}")
+                        save_quantized_model(transformer, transformer_cache_path)
+                    transformer.to(self.device_torch)
+                else:
+                    transformer.to(self.device_torch, dtype=dtype)
 
             flush()
 
@@ -607,15 +653,37 @@ class StableDiffusion:
 
             print("Loading t5")
             tokenizer_2 = T5TokenizerFast.from_pretrained(base_model_path, subfolder="tokenizer_2", torch_dtype=dtype)
-            text_encoder_2 = T5EncoderModel.from_pretrained(base_model_path, subfolder="text_encoder_2",
-                                                            torch_dtype=dtype)
+            t5_cache_path = None
+            if self.model_config.quantized_cache_dir is not None:
+                t5_cache_path = get_quantized_cache_path(
+                    self.model_config.quantized_cache_dir,
+                    't5',
+                    revision=get_model_revision(base_model_path),
+                    quantization='qfloat8',
+                    dtype=dtype,
+                )
 
-            text_encoder_2.to(self.device_torch, dtype=dtype)
-            flush()
+            if t5_cache_path is not None and quantized_cache_exists(t5_cache_path):
+                print(f"Loading quantized T5 from {t5_cache_path}")
+                text_encoder_2 = load_quantized_model(
+                    lambda path: T5EncoderModel(T5Config.from_pretrained(path)),
+                    t5_cache_path,
+                    device=self.device_torch,
+                    dtype=dtype
+                )
+            else:
+                text_encoder_2 = T5EncoderModel.from_pretrained(base_model_path, subfolder="text_encoder_2",
+                                                                torch_dtype=dtype)
+
+                text_encoder_2.to(self.device_torch, dtype=dtype)
+                flush()
 
-            print("Quantizing T5")
-            quantize(text_encoder_2, weights=qfloat8)
-            freeze(text_encoder_2)
+                print("Quantizing T5")
+                quantize(text_encoder_2, weights=qfloat8)
+                freeze(text_encoder_2)
+                if t5_cache_path is not None:
+                    print(f"Saving quantized T5 to {t5_cache_path}")
+                    save_quantized_model(text_encoder_2, t5_cache_path)
             flush()
 
             print("Loading clip")
@@ -820,11 +888,140 @@ class StableDiffusion:
             flush()
 
     @torch.no_grad()
+    def clear_sample_cache(self):
+        self.sample_prompt_embeds_cache = {}
+        self.sample_latents_cache = {}
+        self.sample_pipeline = None
+        self.sample_pipeline_sampler = None
+
+    def encode_sample_prompt(self, prompt, prompt2=None) -> PromptEmbeds:
+        if not self.cache_sample_prompt_embeds or isinstance(self.adapter, CustomAdapter):
+            return self.encode_prompt(prompt, prompt2, force_all=True)
+        key = (prompt, prompt2)
+        if key not in self.sample_prompt_embeds_cache:
+            self.sample_prompt_embeds_cache[key] = self.encode_prompt(prompt, prompt2, force_all=True).detach()
+        # embeds are modified in place later on, never hand out the cached ones
+        return self.sample_prompt_embeds_cache[key].clone()
+
+    def can_batch_sample_images(self, image_configs: List[GenerateImageConfig]) -> bool:
+        # only plain flux sampling, adapters and the refiner need per image handling
+        return self.is_flux and self.adapter is None and self.refiner_unet is None \
+            and all([x.latents is None for x in image_configs])
+
+    def get_sample_batch_size(self, gen_config: GenerateImageConfig, max_batch_size: int) -> int:
+        if self.device_torch.type != 'cuda':
+            return max_batch_size
+        free_bytes, _ = torch.cuda.mem_get_info(self.device_torch)
+        # rough peak per image, the vae decode of the whole batch is what uses the most
+        bytes_per_image = gen_config.width * gen_config.height * SAMPLE_BYTES_PER_PIXEL
+        return max(1, min(max_batch_size, int(free_bytes * 0.8) // bytes_per_image))
+
+    def generate_flux_sample_batches(
+            self,
+            pipeline: FluxPipeline,
+            image_configs: List[GenerateImageConfig],
+            max_batch_size: int,
+            save_futures: list,
+    ):
+        # encode everything first, then run configs that only differ by prompt and seed as one batch.
+        # Every image keeps the noise from its own seed so samples match the unbatched ones
+        groups = OrderedDict()
+        for i, gen_config in enumerate(image_configs):
+            torch.manual_seed(gen_config.seed)
+            torch.cuda.manual_seed(gen_config.seed)
+            latents = self.get_flux_sample_latents(pipeline, gen_config)
+
+            conditional_embeds = self.encode_sample_prompt(gen_config.prompt, gen_config.prompt_2)
+            unconditional_embeds = self.encode_sample_prompt(
+                gen_config.negative_prompt, gen_config.negative_prompt_2
+            )
+            gen_config.post_process_embeddings(
+                conditional_embeds,
+                unconditional_embeds,
+            )
+            conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+            unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+            if self.model_config.dynamic_text_length:
+                # the pipeline does not take an attention mask, so only prompts with the same
+                # length after dropping the padding can go together
+                conditional_embeds = trim_prompt_embeds_padding(conditional_embeds)
+                unconditional_embeds = trim_prompt_embeds_padding(unconditional_embeds)
+
+            key = (
+                gen_config.width,
+                gen_config.height,
+                gen_config.num_inference_steps,
+                gen_config.guidance_scale,
+                gen_config.network_multiplier,
+                conditional_embeds.text_embeds.shape[1],
+                unconditional_embeds.text_embeds.shape[1],
+            )
+            if key not in groups:
+                groups[key] = []
+            groups[key].append((i, gen_config, conditional_embeds, unconditional_embeds, latents))
+
+        progress_bar = tqdm(total=len(image_configs), desc=f"Generating Images", leave=False)
+        for items in groups.values():
+            gen_config = items[0][1]
+            if self.network is not None:
+                self.network.multiplier = gen_config.network_multiplier
+            batch_size = self.get_sample_batch_size(gen_config, max_batch_size)
+            start = 0
+            while start < len(items):
+                chunk = items[start:start + batch_size]
+                conditional_embeds = concat_prompt_embeds([x[2] for x in chunk])
+                extra = {}
+                if self.model_config.use_flux_cfg:
+                    unconditional_embeds = concat_prompt_embeds([x[3] for x in chunk])
+                    extra['negative_prompt_embeds'] = unconditional_embeds.text_embeds
+                    extra['negative_pooled_prompt_embeds'] = unconditional_embeds.pooled_embeds
+                try:
+                    images = pipeline(
+                        prompt_embeds=conditional_embeds.text_embeds,
+                        pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                        height=gen_config.height,
+                        width=gen_config.width,
+                        num_inference_steps=gen_config.num_inference_steps,
+                        guidance_scale=gen_config.guidance_scale,
+                        latents=torch.cat([x[4] for x in chunk], dim=0),
+                        **extra
+                    ).images
+                except torch.cuda.OutOfMemoryError:
+                    if batch_size == 1:
+                        raise
+                    # the estimate was off, try again with half
+                    flush()
+                    batch_size = max(1, batch_size // 2)
+                    print(f"Out of memory generating samples, trying a batch size of {batch_size}")
+                    continue
+                for (i, item_config, _, _, _), img in zip(chunk, images):
+                    save_futures.append(self.sample_save_pool.submit(item_config.save_image, img, i))
+                start += len(chunk)
+                progress_bar.update(len(chunk))
+        progress_bar.close()
+
+    def get_flux_sample_latents(self, pipeline: FluxPipeline, gen_config: GenerateImageConfig) -> torch.Tensor:
+        # generated once per seed and size, call right after seeding
+        key = (gen_config.seed, gen_config.height, gen_config.width)
+        if key not in self.sample_latents_cache:
+            latents, _ = pipeline.prepare_latents(
+                1,
+                pipeline.transformer.config.in_channels // 4,
+                gen_config.height,
+                gen_config.width,
+                self.unet.dtype,
+                self.device_torch,
+                None,
+            )
+            self.sample_latents_cache[key] = latents
+        return self.sample_latents_cache[key].clone()
+
     def generate_images(
             self,
             image_configs: List[GenerateImageConfig],
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline, StableDiffusionXLPipeline] = None,
+            max_batch_size: int = 1,
     ):
         merge_multiplier = 1.0
         flush()
@@ -844,8 +1041,11 @@ class StableDiffusion:
             # check if we have the same network weight for all samples. If we do, we can merge in th
             # the network to drastically speed up inference
             unique_network_weights = set([x.network_multiplier for x in image_configs])
-            if len(unique_network_weights) == 1 and self.network.can_merge_in:
-                can_merge_in = True
+            can_merge_in = len(unique_network_weights) == 1 and self.network.can_merge_in
+            if can_merge_in and self.network.has_quantized_modules:
+                total_steps = sum([x.num_inference_steps for x in image_configs])
+                can_merge_in = total_steps >= QUANTIZED_MERGE_MIN_STEPS
+            if can_merge_in:
                 merge_multiplier = unique_network_weights.pop()
                 network.merge_in(merge_weight=merge_multiplier)
         else:
@@ -858,7 +1058,12 @@ class StableDiffusion:
         rng_state = torch.get_rng_state()
         cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
 
-        if pipeline is None:
+        if pipeline is None and self.sample_pipeline is not None and self.sample_pipeline_sampler == sampler:
+            # same components as last time, no need to build it again
+            pipeline = self.sample_pipeline
+            if self.is_xl:
+                pipeline.to(self.device_torch)
+        elif pipeline is None:
             noise_scheduler = self.noise_scheduler
             if sampler is not None:
                 if sampler.startswith("sample_"):  # sample_dpmpp_2m
@@ -1002,6 +1207,9 @@ class StableDiffusion:
             if sampler.startswith("sample_"):
                 pipeline.set_scheduler(sampler)
 
+            self.sample_pipeline = pipeline
+            self.sample_pipeline_sampler = sampler
+
         refiner_pipeline = None
         if self.refiner_unet:
             # build refiner pipeline
@@ -1032,8 +1240,16 @@ class StableDiffusion:
                 if self.network is not None:
                     assert self.network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
-                    gen_config = image_configs[i]
+                # images are written in the background while the next ones generate
+                save_futures = []
+                if max_batch_size > 1 and self.can_batch_sample_images(image_configs):
+                    self.generate_flux_sample_batches(pipeline, image_configs, max_batch_size, save_futures)
+                    sequential_configs = []
+                else:
+                    sequential_configs = image_configs
+
+                for i in tqdm(range(len(sequential_configs)), desc=f"Generating Images", leave=False):
+                    gen_config = sequential_configs[i]
 
                     extra = {}
                     validation_image = None
@@ -1071,6 +1287,10 @@ class StableDiffusion:
                         self.network.multiplier = gen_config.network_multiplier
                     torch.manual_seed(gen_config.seed)
                     torch.cuda.manual_seed(gen_config.seed)
+                    sample_latents = gen_config.latents
+                    if self.is_flux and sample_latents is None:
+                        # same noise the pipeline would make from the seed
+                        sample_latents = self.get_flux_sample_latents(pipeline, gen_config)
 
                     if self.adapter is not None and isinstance(self.adapter, ClipVisionAdapter) \
                             and gen_config.adapter_image_path is not None:
@@ -1102,12 +1322,12 @@ class StableDiffusion:
                     # encode the prompt ourselves so we can do fun stuff with embeddings
                     if isinstance(self.adapter, CustomAdapter):
                         self.adapter.is_unconditional_run = False
-                    conditional_embeds = self.encode_prompt(gen_config.prompt, gen_config.prompt_2, force_all=True)
+                    conditional_embeds = self.encode_sample_prompt(gen_config.prompt, gen_config.prompt_2)
 
                     if isinstance(self.adapter, CustomAdapter):
                         self.adapter.is_unconditional_run = True
-                    unconditional_embeds = self.encode_prompt(
-                        gen_config.negative_prompt, gen_config.negative_prompt_2, force_all=True
+                    unconditional_embeds = self.encode_sample_prompt(
+                        gen_config.negative_prompt, gen_config.negative_prompt_2
                     )
                     if isinstance(self.adapter, CustomAdapter):
                         self.adapter.is_unconditional_run = False
@@ -1211,6 +1431,11 @@ class StableDiffusion:
                             **extra
                         ).images[0]
                     elif self.is_flux:
+                        if self.model_config.dynamic_text_length:
+                            # the pipeline does not take an attention mask. Sample prompts are encoded
+                            # one at a time, so the padding can just be dropped
+                            conditional_embeds = trim_prompt_embeds_padding(conditional_embeds)
+                            unconditional_embeds = trim_prompt_embeds_padding(unconditional_embeds)
                         if self.model_config.use_flux_cfg:
                             img = pipeline(
                                 prompt_embeds=conditional_embeds.text_embeds,
@@ -1221,7 +1446,7 @@ class StableDiffusion:
                                 width=gen_config.width,
                                 num_inference_steps=gen_config.num_inference_steps,
                                 guidance_scale=gen_config.guidance_scale,
-                                latents=gen_config.latents,
+                                latents=sample_latents,
                                 **extra
                             ).images[0]
                         else:
@@ -1234,7 +1459,7 @@ class StableDiffusion:
                                 width=gen_config.width,
                                 num_inference_steps=gen_config.num_inference_steps,
                                 guidance_scale=gen_config.guidance_scale,
-                                latents=gen_config.latents,
+                                latents=sample_latents,
                                 **extra
                             ).images[0]
                     elif self.is_pixart:
@@ -1317,11 +1542,15 @@ class StableDiffusion:
                             image=img.unsqueeze(0)
                         ).images[0]
 
-                    gen_config.save_image(img, i)
+                    save_futures.append(self.sample_save_pool.submit(gen_config.save_image, img, i))
 
                 if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
                     self.adapter.clear_memory()
 
+                for future in save_futures:
+                    # raises if a save failed
+                    future.result()
+
         # clear pipeline and cache to reduce vram usage
         del pipeline
         if refiner_pipeline is not None:
@@ -1724,37 +1953,47 @@ class StableDiffusion:
                             pw=2
                         )
 
-                        img_ids = torch.zeros(h // 2, w // 2, 3)
-                        img_ids[..., 1] = img_ids[..., 1] + torch.arange(h // 2)[:, None]
-                        img_ids[..., 2] = img_ids[..., 2] + torch.arange(w // 2)[None, :]
-                        img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs).to(self.device_torch)
-
-                        txt_ids = torch.zeros(bs, text_embeddings.text_embeds.shape[1], 3).to(self.device_torch)
-
+                        # ids, guidance and the rotary embedding only depend on the shape, so they are
+                        # built once per shape and kept on the device
                         # # handle guidance
                         guidance_scale = 1.0  # ?
-                        if self.unet.config.guidance_embeds:
-                            guidance = torch.tensor([guidance_scale], device=self.device_torch)
-                            guidance = guidance.expand(latents.shape[0])
-                        else:
-                            guidance = None
+                        flux_inputs = self.flux_input_cache.get(
+                            batch_size=bs,
+                            height=h,
+                            width=w,
+                            text_length=text_embeddings.text_embeds.shape[1],
+                            device=self.device_torch,
+                            guidance_batch_size=latents.shape[0] if self.unet.config.guidance_embeds else None,
+                            guidance_scale=guidance_scale,
+                        )
+
+                        if text_embeddings.attention_mask is not None:
+                            # mask the text padding out of the joint attention
+                            kwargs['joint_attention_kwargs'] = {
+                                **(kwargs.get('joint_attention_kwargs', None) or {}),
+                                'attention_mask': get_joint_attention_mask(
+                                    text_embeddings.attention_mask.to(self.device_torch),
+                                    image_seq_len=latent_model_input_packed.shape[1],
+                                ),
+                            }
 
                     cast_dtype = self.unet.dtype
                     # with torch.amp.autocast(device_type='cuda', dtype=cast_dtype):
-                    noise_pred = self.unet(
-                        hidden_states=latent_model_input_packed.to(self.device_torch, cast_dtype),  # [1, 4096, 64]
-                        # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
-                        # todo make sure this doesnt change
-                        timestep=timestep / 1000,  # timestep is 1000 scale
-                        encoder_hidden_states=text_embeddings.text_embeds.to(self.device_torch, cast_dtype),
-                        # [1, 512, 4096]
-                        pooled_projections=text_embeddings.pooled_embeds.to(self.device_torch, cast_dtype),  # [1, 768]
-                        txt_ids=txt_ids,  # [1, 512, 3]
-                        img_ids=img_ids,  # [1, 4096, 3]
-                        guidance=guidance,
-                        return_dict=False,
-                        **kwargs,
-                    )[0]
+                    with self.flux_input_cache.rotary_cache(self.unet, flux_inputs):
+                        noise_pred = self.unet(
+                            hidden_states=latent_model_input_packed.to(self.device_torch, cast_dtype),  # [1, 4096, 64]
+                            # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
+                            # todo make sure this doesnt change
+                            timestep=timestep / 1000,  # timestep is 1000 scale
+                            encoder_hidden_states=text_embeddings.text_embeds.to(self.device_torch, cast_dtype),
+                            # [1, 512, 4096]
+                            pooled_projections=text_embeddings.pooled_embeds.to(self.device_torch, cast_dtype),  # [1, 768]
+                            txt_ids=flux_inputs.txt_ids,  # [1, 512, 3]
+                            img_ids=flux_inputs.img_ids,  # [1, 4096, 3]
+                            guidance=flux_inputs.guidance,
+                            return_dict=False,
+                            **kwargs,
+                        )[0]
 
                     if isinstance(noise_pred, QTensor):
                         noise_pred = noise_pred.dequantize()
@@ -1995,17 +2234,20 @@ class StableDiffusion:
                 attention_mask=attention_mask,  # not used
             )
         elif self.is_flux:
-            prompt_embeds, pooled_prompt_embeds = train_tools.encode_prompts_flux(
+            prompt_embeds, pooled_prompt_embeds, attention_mask = train_tools.encode_prompts_flux(
                 self.tokenizer,  # list
                 self.text_encoder,  # list
                 prompt,
                 truncate=not long_prompts,
                 max_length=512,
                 dropout_prob=dropout_prob,
-                attn_mask=self.model_config.attn_masking
+                attn_mask=self.model_config.attn_masking,
+                length_buckets=self.model_config.text_length_buckets if self.model_config.dynamic_text_length else None,
             )
             pe = PromptEmbeds(
-                prompt_embeds
+                prompt_embeds,
+                # only needed when the padding varies, it is passed to the transformer then
+                attention_mask=attention_mask if self.model_config.dynamic_text_length else None,
             )
             pe.pooled_embeds = pooled_prompt_embeds
             return pe
@@ -2375,9 +2617,7 @@ class StableDiffusion:
             version = 'sd2'
         mapping_filename = f"stable_diffusion_{version}.json"
         mapping_path = os.path.join(KEYMAPS_ROOT, mapping_filename)
-        with open(mapping_path, 'r') as f:
-            mapping = json.load(f)
-        ldm_diffusers_keymap = mapping['ldm_diffusers_keymap']
+        ldm_diffusers_keymap = load_keymap_mapping(mapping_path).ldm_diffusers_keymap
 
         trainable_parameters = []
 
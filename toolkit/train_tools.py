@@ -518,6 +518,7 @@ def encode_prompts_flux(
         max_length=None,
         dropout_prob=0.0,
         attn_mask: bool = False,
+        length_buckets: Union[List[int], None] = None,
 ):
     if max_length is None:
         max_length = 512
@@ -555,7 +556,7 @@ def encode_prompts_flux(
     # T5
     text_inputs = tokenizer[1](
         prompts,
-        padding="max_length",
+        padding="longest" if length_buckets is not None else "max_length",
         max_length=max_length,
         truncation=True,
         return_length=False,
@@ -563,17 +564,27 @@ def encode_prompts_flux(
         return_tensors="pt",
     )
     text_input_ids = text_inputs.input_ids
+    text_attention_mask = text_inputs.attention_mask
+
+    if length_buckets is not None:
+        # pad up to the next bucket length so only a few sequence lengths ever reach the transformer
+        seq_len = text_input_ids.shape[1]
+        bucket_len = min([length for length in length_buckets if length >= seq_len], default=max_length)
+        pad_len = max(0, min(bucket_len, max_length) - seq_len)
+        text_input_ids = torch.nn.functional.pad(text_input_ids, (0, pad_len), value=tokenizer[1].pad_token_id)
+        text_attention_mask = torch.nn.functional.pad(text_attention_mask, (0, pad_len), value=0)
 
     prompt_embeds = text_encoder[1](text_input_ids.to(device), output_hidden_states=False)[0]
 
     dtype = text_encoder[1].dtype
     prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
 
-    if attn_mask:
-        prompt_attention_mask = text_inputs["attention_mask"].unsqueeze(-1).expand(prompt_embeds.shape)
+    # padding is masked in the transformer with length buckets, zero it so it matches padding added later
+    if attn_mask or length_buckets is not None:
+        prompt_attention_mask = text_attention_mask.unsqueeze(-1).expand(prompt_embeds.shape)
         prompt_embeds = prompt_embeds * prompt_attention_mask.to(dtype=prompt_embeds.dtype, device=prompt_embeds.device)
 
-    return prompt_embeds, pooled_prompt_embeds
+    return prompt_embeds, pooled_prompt_embeds, text_attention_mask
 
 
 # for XL
@@ -752,6 +763,17 @@ def apply_snr_weight(
     return snr_adjusted_loss
 
 
+def get_timestep_indices(schedule_timesteps: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+    # index of each timestep in the schedule. Done as one comparison on the device instead of
+    # (schedule_timesteps == t).nonzero().item() per timestep, which syncs with the host every time
+    schedule_timesteps = schedule_timesteps.to(timesteps.device)
+    matches = schedule_timesteps.unsqueeze(0) == timesteps.flatten().unsqueeze(1)
+    # argmax would quietly give index 0 for a timestep that is not in the schedule. Fail like .item() did,
+    # checked on the device so it still does not sync
+    torch._assert_async(matches.any(dim=1).all())
+    return matches.int().argmax(dim=1)
+
+
 def precondition_model_outputs_flow_match(model_output, model_input, timestep_tensor, noise_scheduler):
     mo_chunks = torch.chunk(model_output, model_output.shape[0], dim=0)
     mi_chunks = torch.chunk(model_input, model_input.shape[0], dim=0)
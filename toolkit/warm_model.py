@@ -0,0 +1,63 @@
+import json
+from typing import TYPE_CHECKING, Dict, Tuple, Union
+
+import torch
+from optimum.quanto import QTensor
+
+if TYPE_CHECKING:
+    from toolkit.stable_diffusion_model import StableDiffusion
+
+# base models kept loaded between jobs when running as a worker (run.py --worker)
+_warm_models_enabled = False
+_warm_models: Dict[str, Tuple['StableDiffusion', torch.Tensor]] = {}
+
+
+def enable_warm_models():
+    global _warm_models_enabled
+    _warm_models_enabled = True
+
+
+def is_warm_models_enabled():
+    return _warm_models_enabled
+
+
+def get_warm_model_key(model_config: dict, **kwargs) -> str:
+    # anything that changes how the model is loaded must be part of the key
+    return json.dumps({'model': model_config, **kwargs}, sort_keys=True, default=str)
+
+
+@torch.no_grad()
+def get_model_fingerprint(model: torch.nn.Module) -> torch.Tensor:
+    # one sum per parameter. Cheap enough to run after every job and catches any write to the weights
+    sums = []
+    for param in model.parameters():
+        if isinstance(param, QTensor):
+            param = param.dequantize()
+        sums.append(param.detach().float().sum().cpu())
+    return torch.stack(sums)
+
+
+def get_warm_model(key: str) -> Union['StableDiffusion', None]:
+    if key in _warm_models:
+        return _warm_models[key][0]
+    return None
+
+
+def store_warm_model(key: str, sd: 'StableDiffusion'):
+    # only one base model is kept, a different one would not fit next to it anyway
+    clear_warm_models()
+    _warm_models[key] = (sd, get_model_fingerprint(sd.unet))
+
+
+def release_warm_model(key: str, sd: 'StableDiffusion'):
+    # called after the job network is removed. Make sure the job did not change the base weights
+    if key not in _warm_models:
+        return
+    _, fingerprint = _warm_models[key]
+    if not torch.equal(fingerprint, get_model_fingerprint(sd.unet)):
+        clear_warm_models()
+        raise ValueError("Base model weights changed during training, the warm model was discarded")
+
+
+def clear_warm_models():
+    _warm_models.clear()